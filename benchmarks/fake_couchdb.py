@@ -0,0 +1,469 @@
+"""
+An in-process stand-in for the parts of couchdb couchfs uses, to benchmark against
+
+"""
+import base64
+import fnmatch
+import gzip
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+from couchfs.index import collation_key
+
+CHUNK_DOC_PREFIX = 'couchfs-chunk-'
+
+# couchdb's default [attachments] compressible_types
+COMPRESSIBLE_TYPES = ('text/*', 'application/javascript', 'application/json', 'application/xml')
+
+
+def collate(key):
+    """
+    Sort key of a view key, lists compare item by item, strings the way couchdb's ICU
+    collation does and {} sorts after any string.
+    """
+    if isinstance(key, list):
+        return (2, [collate(item) for item in key])
+    if isinstance(key, dict):
+        return (3, b'')
+    if key is None:
+        return (0, b'')
+    return (1, collation_key(key))
+
+
+class Database:
+    """
+    Docs with their attachments held in memory, and the sequence each doc last changed at.
+    With compress, attachments of COMPRESSIBLE_TYPES are stored gzipped, as couchdb does,
+    and their digest is the md5 of the gzipped bytes.
+    """
+
+    def __init__(self, compress=False):
+        self.compress = compress
+        self.docs = {}
+        self.seqs = {}
+        self.seq = 0
+        self.changed = threading.Condition()
+
+    @staticmethod
+    def next_rev(doc):
+        generation = int(doc['_rev'].split('-')[0]) if doc and '_rev' in doc else 0
+        return f'{generation + 1}-{uuid.uuid4().hex}'
+
+    def save(self, doc):
+        doc['_rev'] = self.next_rev(self.docs.get(doc['_id']))
+        with self.changed:
+            self.seq += 1
+            self.docs[doc['_id']] = doc
+            self.seqs[doc['_id']] = self.seq
+            self.changed.notify_all()
+        return doc['_rev']
+
+    def conflicts(self, doc_id, rev):
+        """
+        Whether a write of doc_id based on rev conflicts, a new or deleted doc can be written without one.
+        """
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            return bool(rev)
+        if doc.get('_deleted'):
+            return bool(rev) and rev != doc['_rev']
+        return rev != doc['_rev']
+
+    def live(self, doc_id):
+        doc = self.docs.get(doc_id)
+        return doc if doc and not doc.get('_deleted') else None
+
+    @staticmethod
+    def stubs(doc):
+        doc = dict(doc)
+        if '_attachments' in doc:
+            doc['_attachments'] = {name: {key: value for key, value in attachment.items()
+                                          if key not in ('data', 'encoded')}
+                                   for name, attachment in doc['_attachments'].items()}
+            for stub in doc['_attachments'].values():
+                stub['stub'] = True
+        return doc
+
+    def attachment(self, data, content_type, revpos):
+        attachment = {'content_type': content_type, 'data': data, 'length': len(data), 'revpos': revpos}
+        media_type = (content_type or '').split(';')[0].strip()
+        if self.compress and any(fnmatch.fnmatch(media_type, pattern) for pattern in COMPRESSIBLE_TYPES):
+            data = attachment['encoded'] = gzip.compress(data, mtime=0)
+            attachment.update(encoding='gzip', encoded_length=len(data))
+        attachment['digest'] = 'md5-' + base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        return attachment
+
+    def view_rows(self, name='attachment_list'):
+        """
+        The rows of the attachment_list or attachment_digests view, (key, doc id, value).
+        """
+        rows = []
+        for doc_id, doc in self.docs.items():
+            if doc.get('_deleted') or doc_id.startswith(('_design/', CHUNK_DOC_PREFIX)):
+                continue
+            if name == 'attachment_digests':
+                rows.extend((stub['digest'], doc_id, None) for stub in (doc.get('_attachments') or {}).values()
+                            if not stub.get('encoding'))
+                rows.extend((entry['digest'], doc_id, {'chunk_size': entry['chunk_size'], 'chunks': entry['chunks']})
+                            for entry in doc.get('couchfs_files', {}).values())
+                continue
+            files = dict(doc.get('_attachments') or {}, **doc.get('couchfs_files', {}))
+            for file_name, stub in files.items():
+                rows.append(((doc_id + '/' + file_name).split('/'), doc_id, stub['length']))
+            if not files:
+                rows.append((doc_id.split('/'), doc_id, 0))
+        rows.sort(key=lambda row: (collate(row[0]), row[1]))
+        return rows
+
+
+class FakeCouchDB(ThreadingHTTPServer):
+    """
+    A threaded HTTP server answering like couchdb for db HEAD/PUT, docs, multipart doc
+    PUTs, doc COPY, attachments with Range, _all_docs, _bulk_docs, _changes, the
+    attachment_list view with its _stats reduce and the attachment_digests view. Every
+    request is delayed by latency seconds and counted. With compress, text like attachments
+    are stored and sent gzipped.
+
+        with FakeCouchDB(latency=0.005) as server:
+            client = CouchDBClient(server.uri('bench'))
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, compress=False):
+        super(FakeCouchDB, self).__init__(('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.compress = compress
+        self.dbs = {}
+        self.lock = threading.RLock()
+        self.requests = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def uri(self, db):
+        return f'couchdb://127.0.0.1:{self.server_address[1]}/{db}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients drop streamed responses they have read enough of, that's not an error
+        pass
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let them wait on delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def do_COPY(self):
+        self.dispatch('COPY')
+
+    def dispatch(self, method):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlsplit(self.path)
+        self.params = dict(parse_qsl(url.query))
+        self.body = self.read_body()
+        parts = [unquote(part) for part in url.path.lstrip('/').split('/')]
+        db_name, rest = parts[0], parts[1:]
+        if rest[:1] == ['_design'] and len(rest) >= 2:
+            rest = ['_design/' + rest[1]] + rest[2:]
+        with server.lock:
+            db = server.dbs.get(db_name)
+        if not rest:
+            return self.database(method, db_name, db)
+        if db is None:
+            return self.send_json(404, {'error': 'not_found', 'reason': 'Database does not exist.'})
+        if rest[0] in ('_all_docs', '_bulk_docs', '_changes'):
+            return getattr(self, rest[0][1:])(method, db)
+        if len(rest) >= 3 and rest[1] == '_view':
+            return self.view(db, rest[2])
+        if len(rest) == 1:
+            return self.document(method, db, rest[0])
+        return self.attachment(method, db, rest[0], '/'.join(rest[1:]))
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b''.join(body)
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send_body(self, status, body=b'', content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, status, value, headers=None):
+        self.send_body(status, json.dumps(value).encode('utf-8'), headers=headers)
+
+    def json_body(self):
+        return json.loads(self.body or b'{}')
+
+    def rev_of(self, doc=None):
+        return self.params.get('rev') or self.headers.get('If-Match', '').strip('"') or (doc or {}).get('_rev')
+
+    def database(self, method, name, db):
+        if method in ('HEAD', 'GET'):
+            if db is None:
+                return self.send_json(404, {'error': 'not_found'})
+            return self.send_json(200, {'db_name': name, 'doc_count': len(db.docs), 'update_seq': db.seq})
+        if method == 'PUT':
+            with self.server.lock:
+                if db is not None:
+                    return self.send_json(412, {'error': 'file_exists'})
+                self.server.dbs[name] = Database(self.server.compress)
+            return self.send_json(201, {'ok': True})
+        if method == 'POST' and db is not None:
+            return self.write_doc(db, self.json_body())
+        self.send_json(405, {'error': 'method_not_allowed'})
+
+    def write_doc(self, db, doc, rev=None, follows=()):
+        """
+        Saves doc if rev, or its _rev, is the current rev, keeping stubbed attachments and
+        taking `follows` attachments from the multipart bodies in order.
+        """
+        with self.server.lock:
+            if db.conflicts(doc['_id'], rev or doc.get('_rev')):
+                return self.send_json(409, {'error': 'conflict', 'reason': 'Document update conflict.'})
+            new_rev = db.save(self.with_attachments(db, doc, follows))
+        self.send_json(201, {'ok': True, 'id': doc['_id'], 'rev': new_rev}, headers={'ETag': f'"{new_rev}"'})
+
+    @staticmethod
+    def with_attachments(db, doc, follows=()):
+        """
+        doc with its stubs replaced by the stored attachments and its `follows` and inline ones stored.
+        :raises KeyError: for a stub of an attachment the current revision does not have
+        """
+        current = db.live(doc['_id'])
+        revpos = int((current or {}).get('_rev', '0-').split('-')[0]) + 1
+        follows, attachments = iter(follows), {}
+        for name, stub in (doc.get('_attachments') or {}).items():
+            if stub.get('stub'):
+                attachments[name] = (current or {}).get('_attachments', {})[name]
+            elif stub.get('follows'):
+                attachments[name] = db.attachment(next(follows), stub.get('content_type'), revpos)
+            else:
+                attachments[name] = db.attachment(base64.b64decode(stub['data']), stub.get('content_type'), revpos)
+        doc = dict(doc, _attachments=attachments)
+        if not attachments or doc.get('_deleted'):
+            del doc['_attachments']
+        return doc
+
+    def document(self, method, db, doc_id):
+        doc = db.live(doc_id)
+        if method in ('HEAD', 'GET'):
+            if doc is None:
+                return self.send_json(404, {'error': 'not_found', 'reason': 'missing'})
+            return self.send_json(200, db.stubs(doc), headers={'ETag': f'"{doc["_rev"]}"'})
+        if method == 'PUT':
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('multipart/related'):
+                doc, follows = self.multipart(content_type)
+            else:
+                doc, follows = self.json_body(), ()
+            return self.write_doc(db, dict(doc, _id=doc_id), self.rev_of(doc), follows)
+        if method == 'DELETE':
+            if doc is None:
+                return self.send_json(404, {'error': 'not_found'})
+            if self.rev_of() != doc['_rev']:
+                return self.send_json(409, {'error': 'conflict'})
+            with self.server.lock:
+                rev = db.save({'_id': doc_id, '_rev': doc['_rev'], '_deleted': True})
+            return self.send_json(200, {'ok': True, 'id': doc_id, 'rev': rev})
+        if method == 'COPY':
+            if doc is None:
+                return self.send_json(404, {'error': 'not_found'})
+            new_id, _, query = self.headers.get('Destination', '').partition('?')
+            with self.server.lock:
+                if db.conflicts(new_id, dict(parse_qsl(query)).get('rev')):
+                    return self.send_json(409, {'error': 'conflict', 'reason': 'Document update conflict.'})
+                new_rev = db.save(dict(doc, _id=new_id))
+            return self.send_json(201, {'ok': True, 'id': new_id, 'rev': new_rev}, headers={'ETag': f'"{new_rev}"'})
+        self.send_json(405, {'error': 'method_not_allowed'})
+
+    def multipart(self, content_type):
+        boundary = content_type.split('boundary=')[1].strip('"').encode('ascii')
+        segments = (b'\r\n' + self.body).split(b'\r\n--' + boundary)[1:-1]
+        bodies = [segment[segment.index(b'\r\n\r\n') + 4:] for segment in segments]
+        return json.loads(bodies[0]), bodies[1:]
+
+    def attachment(self, method, db, doc_id, name):
+        doc = db.live(doc_id)
+        attachment = (doc or {}).get('_attachments', {}).get(name)
+        if method in ('HEAD', 'GET'):
+            if attachment is None:
+                return self.send_json(404, {'error': 'not_found', 'reason': 'Document is missing attachment'})
+            return self.send_attachment(attachment)
+        if method == 'PUT':
+            with self.server.lock:
+                doc = db.live(doc_id)
+                if db.conflicts(doc_id, self.rev_of()):
+                    return self.send_json(409, {'error': 'conflict', 'reason': 'Document update conflict.'})
+                doc = dict(doc or {'_id': doc_id})
+                revpos = int(doc.get('_rev', '0-').split('-')[0]) + 1
+                doc['_attachments'] = dict(doc.get('_attachments', {}))
+                doc['_attachments'][name] = db.attachment(self.body, self.headers.get('Content-Type'), revpos)
+                new_rev = db.save(doc)
+            return self.send_json(201, {'ok': True, 'id': doc_id, 'rev': new_rev}, headers={'ETag': f'"{new_rev}"'})
+        if method == 'DELETE':
+            with self.server.lock:
+                if attachment is None:
+                    return self.send_json(404, {'error': 'not_found'})
+                if self.rev_of() != doc['_rev']:
+                    return self.send_json(409, {'error': 'conflict'})
+                doc = dict(doc, _attachments={k: v for k, v in doc['_attachments'].items() if k != name})
+                new_rev = db.save(doc)
+            return self.send_json(200, {'ok': True, 'id': doc_id, 'rev': new_rev})
+        self.send_json(405, {'error': 'method_not_allowed'})
+
+    def send_attachment(self, attachment):
+        data = attachment['data']
+        headers = {'ETag': f'"{attachment["digest"][4:]}"', 'Accept-Ranges': 'bytes'}
+        if attachment.get('encoding') and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            # sent as stored, whole, couchdb does not do ranges of compressed attachments
+            headers['Content-Encoding'] = attachment['encoding']
+            return self.send_body(200, attachment['encoded'], attachment['content_type'], headers)
+        header = self.headers.get('Range')
+        if header and header.startswith('bytes='):
+            start, _, end = header[len('bytes='):].partition('-')
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            if start >= len(data):
+                return self.send_body(416, b'', headers={'Content-Range': f'bytes */{len(data)}'})
+            headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+            return self.send_body(206, data[start:end + 1], attachment['content_type'], headers)
+        self.send_body(200, data, attachment['content_type'] or 'application/octet-stream', headers)
+
+    def all_docs(self, method, db):
+        keys = self.json_body().get('keys') if method == 'POST' else None
+        include_docs = self.params.get('include_docs') == 'true'
+        rows = []
+        with self.server.lock:
+            if keys is None:
+                # without keys only the live docs, from startkey on, limit at a time
+                startkey = json.loads(self.params.get('startkey', '""'))
+                keys = [key for key in sorted(db.docs) if key >= startkey and db.live(key)]
+                keys = keys[:int(self.params.get('limit', len(keys)))]
+            for key in keys:
+                doc = db.docs.get(key)
+                if doc is None:
+                    rows.append({'key': key, 'error': 'not_found'})
+                elif doc.get('_deleted'):
+                    rows.append({'id': key, 'key': key, 'value': {'rev': doc['_rev'], 'deleted': True}, 'doc': None})
+                else:
+                    row = {'id': key, 'key': key, 'value': {'rev': doc['_rev']}}
+                    if include_docs:
+                        row['doc'] = db.stubs(doc)
+                    rows.append(row)
+        self.send_json(200, {'total_rows': len(db.docs), 'offset': 0, 'rows': rows})
+
+    def bulk_docs(self, method, db):
+        results = []
+        for doc in self.json_body()['docs']:
+            doc.setdefault('_id', uuid.uuid4().hex)
+            with self.server.lock:
+                if db.conflicts(doc['_id'], doc.get('_rev')):
+                    results.append({'id': doc['_id'], 'error': 'conflict', 'reason': 'Document update conflict.'})
+                    continue
+                try:
+                    doc = self.with_attachments(db, doc)
+                except KeyError as error:
+                    results.append({'id': doc['_id'], 'error': 'missing_stub', 'reason': f'Missing stub {error}'})
+                    continue
+                results.append({'ok': True, 'id': doc['_id'], 'rev': db.save(doc)})
+        self.send_json(201, results)
+
+    def changes(self, method, db):
+        since = int(str(self.params.get('since', '0')).split('-')[0] or 0)
+        limit = int(self.params.get('limit', 0)) or None
+        include_docs = self.params.get('include_docs') == 'true'
+        if self.params.get('feed') == 'longpoll':
+            with db.changed:
+                db.changed.wait_for(lambda: db.seq > since, int(self.params.get('timeout', 60000)) / 1000)
+        with self.server.lock:
+            changed = sorted((seq, doc_id) for doc_id, seq in db.seqs.items() if seq > since)[:limit]
+            results = []
+            for seq, doc_id in changed:
+                doc = db.docs[doc_id]
+                result = {'seq': seq, 'id': doc_id, 'changes': [{'rev': doc['_rev']}]}
+                if doc.get('_deleted'):
+                    result['deleted'] = True
+                if include_docs:
+                    result['doc'] = db.stubs(doc)
+                results.append(result)
+            last_seq = changed[-1][0] if changed else since
+        self.send_json(200, {'results': results, 'last_seq': last_seq, 'pending': 0})
+
+    def view(self, db, name):
+        params = {name: value if name == 'startkey_docid' else json.loads(value) for name, value in self.params.items()}
+        with self.server.lock:
+            rows = db.view_rows(name)
+        if 'key' in params:
+            rows = [row for row in rows if row[0] == params['key']]
+        if 'startkey' in params:
+            start = (collate(params['startkey']), params.get('startkey_docid', ''))
+            rows = [row for row in rows if (collate(row[0]), row[1]) >= start]
+        if 'endkey' in params:
+            rows = [row for row in rows if collate(row[0]) <= collate(params['endkey'])]
+        if params.get('reduce', True) and 'group_level' in params:
+            groups = {}
+            for key, _, value in rows:
+                group = key[:params['group_level']] or None
+                stats = groups.setdefault(json.dumps(group), {'sum': 0, 'count': 0, 'min': value, 'max': value,
+                                                               'sumsqr': 0})
+                stats['sum'] += value
+                stats['count'] += 1
+                stats['min'] = min(stats['min'], value)
+                stats['max'] = max(stats['max'], value)
+                stats['sumsqr'] += value * value
+            rows = [{'key': json.loads(key), 'value': stats} for key, stats in groups.items()]
+        else:
+            rows = [{'id': doc_id, 'key': key, 'value': value} for key, doc_id, value in rows]
+        if 'limit' in params:
+            rows = rows[:params['limit']]
+        self.send_json(200, {'rows': rows})
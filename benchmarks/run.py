@@ -0,0 +1,161 @@
+"""
+Runs the couchfs benchmarks against an in-process FakeCouchDB and writes the results as JSON
+
+    python -m benchmarks.run --files 10,100 --sizes 1024,1048576 --jobs 1,8 --latency 0,0.005 -o bench.json
+
+"""
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import click
+import humanize
+
+import couchfs
+from benchmarks.fake_couchdb import FakeCouchDB
+from couchfs.api import CouchDBClient
+
+SCENARIOS = ('upload', 'ls', 'download', 'sync')
+FILES_PER_DIR = 100
+DOC_ID = 'BENCH'
+
+
+def make_tree(root, files, size):
+    """
+    Writes files random files of size bytes under root, at most FILES_PER_DIR per directory.
+    """
+    for index in range(files):
+        dir_path = os.path.join(root, f'd{index // FILES_PER_DIR:04}')
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f'f{index:06}.bin'), 'wb') as fp:
+            fp.write(os.urandom(size))
+    return root
+
+
+def touch_some(root, fraction=0.1):
+    """
+    Rewrites a fraction of the files under root so a sync has something to send.
+    :return: number of files changed
+    """
+    paths = sorted(os.path.join(dir_path, name) for dir_path, _, names in os.walk(root) for name in names)
+    changed = paths[::max(1, int(1 / fraction))]
+    for path in changed:
+        size = os.path.getsize(path)
+        with open(path, 'wb') as fp:
+            fp.write(os.urandom(size))
+    return len(changed)
+
+
+def failures(results):
+    return sum(1 for result in results if result[2] not in (200, 201, 202, 'UNCHANGED'))
+
+
+def run_case(files, size, jobs, latency, scenarios=SCENARIOS):
+    """
+    Runs the scenarios for one point of the matrix against a fresh server and database.
+    Upload always runs first, since the others need the files it stores, and is only
+    reported when asked for.
+    :return: [{scenario, files, size, jobs, latency, seconds, bytes, requests, errors, ...}]
+    """
+    work_dir = tempfile.mkdtemp(prefix='couchfs-bench-')
+    try:
+        with FakeCouchDB(latency=latency) as server:
+            client = CouchDBClient(server.uri('bench'), pool_size=max(jobs, CouchDBClient.OPTIONS['pool_size'][1]),
+                                   manifest_dir=os.path.join(work_dir, 'manifests'))
+            client.create_db()
+            client.save_doc(client.COUCHFS_VIEWS)
+            tree = make_tree(os.path.join(work_dir, 'tree'), files, size)
+            rows = []
+
+            def measure(scenario, run, moved_files=files):
+                requests = server.requests
+                started = time.perf_counter()
+                errors = run()
+                seconds = time.perf_counter() - started
+                if scenario in scenarios:
+                    rows.append({'scenario': scenario, 'files': files, 'size': size, 'jobs': jobs, 'latency': latency,
+                                 'seconds': seconds, 'bytes': moved_files * size,
+                                 'requests': server.requests - requests, 'errors': errors,
+                                 'files_per_second': moved_files / seconds if seconds else 0.0,
+                                 'bytes_per_second': moved_files * size / seconds if seconds else 0.0})
+
+            measure('upload', lambda: failures(list(client.upload(tree, DOC_ID, max_workers=jobs))))
+            if 'ls' in scenarios:
+                measure('ls', lambda: int(len(list(client.list_attachments(DOC_ID))) != files), moved_files=0)
+            if 'download' in scenarios:
+                dest = os.path.join(work_dir, 'download')
+                os.makedirs(dest)
+                measure('download', lambda: failures(list(client.download(DOC_ID, dest, max_workers=jobs))))
+            if 'sync' in scenarios:
+                changed = touch_some(tree)
+                measure('sync', lambda: failures(list(client.sync(tree, DOC_ID, max_workers=jobs))),
+                        moved_files=changed)
+            return rows
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_matrix(files, sizes, jobs, latencies, scenarios=SCENARIOS, repeat=1, echo=None):
+    """
+    :return: yields the rows of run_case for every combination, repeat times each
+    """
+    for n_files, size, n_jobs, latency, _ in itertools.product(files, sizes, jobs, latencies, range(repeat)):
+        for row in run_case(n_files, size, n_jobs, latency, scenarios):
+            if echo:
+                echo(row)
+            yield row
+
+
+def report(results, output):
+    document = {
+        'couchfs': couchfs.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'results': results,
+    }
+    with open(output, 'w') as fp:
+        json.dump(document, fp, indent=2)
+    return document
+
+
+def integers(value):
+    return [int(item) for item in value.split(',')]
+
+
+def floats(value):
+    return [float(item) for item in value.split(',')]
+
+
+@click.command()
+@click.option("--files", default='10,100', show_default=True, help="file counts, comma separated")
+@click.option("--sizes", default='1024,1048576', show_default=True, help="file sizes in bytes, comma separated")
+@click.option("--jobs", default='1,8', show_default=True, help="concurrency levels, comma separated")
+@click.option("--latency", default='0,0.005', show_default=True, help="seconds added to every request, comma separated")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS), help="only run these, default all")
+@click.option("--repeat", default=1, show_default=True, help="runs of each combination")
+@click.option("--output", "-o", default='benchmarks.json', show_default=True, help="where to write the results")
+def main(files, sizes, jobs, latency, scenarios, repeat, output):
+    """Benchmarks upload, ls, download and sync over a matrix of file counts, sizes, jobs and latencies."""
+
+    def echo(row):
+        click.echo(f'{row["scenario"]:>8} {row["files"]:>6} x {humanize.naturalsize(row["size"]):>9} '
+                   f'jobs {row["jobs"]:>2} latency {row["latency"] * 1000:>5.1f}ms '
+                   f'{row["seconds"]:>8.3f}s {row["files_per_second"]:>9.1f} files/s '
+                   f'{humanize.naturalsize(row["bytes_per_second"]):>10}/s {row["requests"]:>6} requests'
+                   + (f' {row["errors"]} errors' if row['errors'] else ''))
+
+    results = list(run_matrix(integers(files), integers(sizes), integers(jobs), floats(latency),
+                              scenarios or SCENARIOS, repeat, echo))
+    report(results, output)
+    click.echo(f'wrote {len(results)} results to {output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())  # pragma: no cover
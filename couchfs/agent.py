@@ -0,0 +1,320 @@
+"""
+A resident couchfs agent, and the console script that hands commands to it
+
+The agent keeps one CouchDBClient, with its connection pool, revision cache and a
+followed local index, and runs cli commands for the couchfs script over a unix socket.
+This module only imports the standard library until it has to run a command itself,
+so a forwarded command skips importing requests, click and humanize.
+
+"""
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+
+SOCKET_ENVIRON_KEY = 'COUCHFS_AGENT_SOCKET'
+NO_AGENT_ENVIRON_KEY = 'COUCHFS_NO_AGENT'
+URI_ENVIRON_KEY = 'COUCHDB_URI'
+# commands that must run in the calling process
+LOCAL_COMMANDS = ('agent', 'mount')
+# commands that do not read or write local paths, so they need not hold the working directory
+CONCURRENT_COMMANDS = ('ls', 'du')
+
+
+def runtime_dir():
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.cache'), 'couchfs')
+
+
+def socket_path(uri=None):
+    """
+    The socket of the agent for uri, one agent per database.
+    :param uri: connection uri, defaults to $COUCHDB_URI
+    :return: path or None when there is neither $COUCHFS_AGENT_SOCKET nor a uri
+    """
+    if os.environ.get(SOCKET_ENVIRON_KEY):
+        return os.environ[SOCKET_ENVIRON_KEY]
+    uri = uri or os.environ.get(URI_ENVIRON_KEY)
+    if not uri:
+        return None
+    return os.path.join(runtime_dir(), f'agent-{hashlib.md5(uri.encode()).hexdigest()[:16]}.sock')
+
+
+def connect(path):
+    """
+    :return: a socket connected to the agent at path, None when there is no agent
+    """
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(argv, path=None, stdout=None, stderr=None):
+    """
+    Runs a couchfs command in the agent, copying its output to stdout and stderr.
+    :param argv: the couchfs arguments, e.g. ['ls', 'DOC']
+    :param path: agent socket, defaults to socket_path()
+    :return: the exit code, None when the command has to run locally
+    """
+    if not argv or argv[0].startswith('-') or argv[0] in LOCAL_COMMANDS or os.environ.get(NO_AGENT_ENVIRON_KEY):
+        return None
+    sock = connect(path or socket_path())
+    if sock is None:
+        return None
+    streams = {'out': stdout or sys.stdout, 'err': stderr or sys.stderr}
+    with sock, sock.makefile('rwb') as channel:
+        channel.write(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n')
+        channel.flush()
+        for line in channel:
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            for name, text in message.items():
+                streams[name].write(text)
+                streams[name].flush()
+    # the agent went away half way
+    return 1
+
+
+def stop(path=None):
+    """
+    Asks the agent at path to exit.
+    :return: True if there was an agent
+    """
+    sock = connect(path or socket_path())
+    if sock is None:
+        return False
+    with sock, sock.makefile('rwb') as channel:
+        channel.write(json.dumps({'stop': True}).encode() + b'\n')
+        channel.flush()
+        channel.readline()
+    return True
+
+
+def main(argv=None):
+    """
+    The couchfs console script, forwards to a running agent or else runs the command here.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    code = forward(argv)
+    if code is not None:
+        return code
+    from couchfs.cli import couchfs
+    return couchfs.main(args=argv, prog_name='couchfs')
+
+
+class RemoteStream:
+    """
+    A text stream whose writes go to the client as {name: text} lines.
+    """
+    encoding = 'utf-8'
+    errors = 'strict'
+
+    def __init__(self, channel, lock, name):
+        self.channel = channel
+        self.lock = lock
+        self.name = name
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError(f'write() argument must be str, not {type(text).__name__}')
+        if text:
+            with self.lock:
+                self.channel.write(json.dumps({self.name: text}).encode() + b'\n')
+                self.channel.flush()
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class ThreadStream:
+    """
+    Stands in for sys.stdout or sys.stderr in the agent, so that each command thread
+    writes to its own client and every other thread to the original stream. It has
+    no buffer, so click writes text to it rather than bytes past it.
+    """
+    encoding = 'utf-8'
+    errors = 'strict'
+
+    def __init__(self, original):
+        self.original = original
+        self.local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.original
+
+    def isatty(self):
+        return self.target.isatty()
+
+    def write(self, text):
+        return self.target.write(text)
+
+    def flush(self):
+        return self.target.flush()
+
+
+class Agent:
+    """
+    Serves couchfs commands on a unix socket with one shared CouchDBClient. The client
+    gets a local index when it has none, kept up to date by following the _changes feed,
+    so ls and du are local lookups. Commands that may touch local paths run one at a
+    time in the caller's working directory, ls and du run side by side.
+
+        with Agent(CouchDBClient(), socket_path()) as agent:
+            agent.serve_forever()
+    """
+
+    def __init__(self, client, path, index_path=None):
+        """
+        :param client: CouchDBClient shared by every command
+        :param path: unix socket to listen on
+        :param index_path: where to keep the index if the client has none
+        """
+        import socketserver
+        from couchfs.index import Index
+
+        self.client = client
+        self.path = path
+        if client.index is None:
+            index_path = index_path or os.path.join(runtime_dir(), os.path.basename(path).replace('.sock', '.sqlite'))
+            client.index = Index(client, index_path)
+        self.cwd = os.getcwd()
+        self.cwd_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.ready = threading.Event()
+        self.stdout, self.stderr = ThreadStream(sys.stdout), ThreadStream(sys.stderr)
+        self.streams_lock = threading.Lock()
+        if connect(path) is not None:
+            raise OSError(f'an agent is already listening on {path}')
+        os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                agent.handle(self.rfile, self.wfile)
+
+        # the socket is made 0600 as it is bound, a chmod after would leave it open to others until then
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def serve_forever(self):
+        self.install_streams()
+        self.client.index.update()
+        follower = threading.Thread(target=self.client.index.follow, args=(lambda doc_ids: None, self.stopped),
+                                    daemon=True)
+        follower.start()
+        self.ready.set()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            with self.streams_lock:
+                if sys.stdout is self.stdout:
+                    sys.stdout = self.stdout.original
+                if sys.stderr is self.stderr:
+                    sys.stderr = self.stderr.original
+
+    def install_streams(self):
+        """
+        Puts the ThreadStreams in sys, again if anything swapped them out since.
+        """
+        with self.streams_lock:
+            if sys.stdout is not self.stdout:
+                self.stdout.original, sys.stdout = sys.stdout, self.stdout
+            if sys.stderr is not self.stderr:
+                self.stderr.original, sys.stderr = sys.stderr, self.stderr
+
+    def shutdown(self):
+        self.stopped.set()
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def close(self):
+        self.stopped.set()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def handle(self, rfile, wfile):
+        request = json.loads(rfile.readline() or b'{}')
+        if request.get('stop'):
+            wfile.write(b'{"exit": 0}\n')
+            self.shutdown()
+            return
+        from requests import RequestException
+
+        argv = request.get('argv') or []
+        if not argv or argv[0] in LOCAL_COMMANDS:
+            wfile.write(b'{"exit": null}\n')
+            return
+        self.install_streams()
+        lock = threading.Lock()
+        stdout, stderr = self.stdout, self.stderr
+        stdout.local.stream = RemoteStream(wfile, lock, 'out')
+        stderr.local.stream = RemoteStream(wfile, lock, 'err')
+        try:
+            if argv[0] in CONCURRENT_COMMANDS:
+                code = self.run(argv)
+            else:
+                with self.cwd_lock:
+                    os.chdir(request.get('cwd') or self.cwd)
+                    try:
+                        code = self.run(argv)
+                    finally:
+                        os.chdir(self.cwd)
+                # so an ls straight after an upload lists what it stored
+                try:
+                    self.client.index.update()
+                except RequestException:
+                    pass
+        finally:
+            stdout.local.stream = stderr.local.stream = None
+        with lock:
+            wfile.write(json.dumps({'exit': code}).encode() + b'\n')
+
+    def run(self, argv):
+        """
+        Runs the couchfs command argv with the shared client.
+        :return: exit code
+        """
+        import traceback
+        from couchfs.cli import couchfs
+
+        try:
+            couchfs.main(args=argv, prog_name='couchfs', obj=self.client)
+        except SystemExit as exit:
+            if exit.code is None or isinstance(exit.code, int):
+                return exit.code or 0
+            print(exit.code, file=sys.stderr)
+            return 1
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            return 1
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -4,17 +4,39 @@ A  client api for couchdb attachments
 """
 
 """Main module."""
+import base64
+import codecs
+import contextvars
+import json
 import logging
 import fnmatch
+import functools
+import hashlib
 import io
 import mimetypes
 import os
 import pathlib
 import re
+import shutil
 import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from contextlib import contextmanager
+from itertools import islice
+from operator import itemgetter
+from urllib.parse import parse_qsl
 
-import requests
+from requests import HTTPError, RequestException
+
+from couchfs.attachment import AttachmentFile
+from couchfs.blobcache import BlobCache, DigestMismatch
+from couchfs.index import CHUNK_DOC_PREFIX, Index, doc_files, plain_digest
+from couchfs.manifest import Manifest, md5_digest
+from couchfs.stats import RequestStats
+from couchfs.throttle import BULK, Throttle, prioritized
+from couchfs.transport import RetryPolicy, Transport, counting_retries, release
 
 logger = logging.getLogger(__file__)
 echo = logger.info
@@ -32,17 +54,343 @@ class BadConnectionURI(CouchDBClientException):
     """A valid URL is required."""
 
 
+class BadClientOption(CouchDBClientException):
+    """An unknown or badly formed client option."""
+
+
+def as_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def as_timeout(value):
+    if value is None or value in ('', 'none', 'None'):
+        return None
+    return float(value)
+
+
+def split_doc_path(path):
+    """
+    'TAKIS/takis/asgi.py' -> ('TAKIS', 'takis/asgi.py')
+    """
+    doc_id, _, file_name = path.lstrip('/').partition('/')
+    return doc_id, file_name
+
+
+def key_range(prefix):
+    """
+    The attachment_list view keys of every path starting with prefix.
+    'TAKIS/takis/' -> (['TAKIS', 'takis'], ['TAKIS', 'takis', {}])
+    'TAKIS/ta' -> (['TAKIS', 'ta'], ['TAKIS', 'ta\\ufff0'])
+    '' -> (None, None)
+    """
+    if not prefix:
+        return None, None
+    *segments, partial = prefix.split('/')
+    if partial:
+        return segments + [partial], segments + [partial + '\ufff0']
+    return segments, segments + [{}]
+
+
+def iter_view_rows(chunks):
+    """
+    Parses the rows of a couchdb view response as its body arrives, so the first row
+    can be used before the last one is read.
+    :param chunks: the body as an iterable of bytes
+    :return: yields each row
+    """
+    decode = codecs.getincrementaldecoder('utf-8')().decode
+    decoder = json.JSONDecoder()
+    buffer, in_rows = '', False
+    for chunk in chunks:
+        buffer += decode(chunk)
+        if not in_rows:
+            start = buffer.find('"rows"')
+            bracket = buffer.find('[', start) if start != -1 else -1
+            if bracket == -1:
+                continue
+            buffer, in_rows = buffer[bracket + 1:], True
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,')
+            if not buffer:
+                break
+            if buffer[0] == ']':
+                return
+            try:
+                row, end = decoder.raw_decode(buffer)
+            except ValueError:
+                break
+            yield row
+            buffer = buffer[end:]
+    if buffer.strip():
+        raise ValueError(f'truncated view response: {buffer[:80]!r}')
+
+
+def attachment_stub(docs, path):
+    """
+    The stub of the attachment, or chunked file, at path, a doc id followed by the attachment name, in {doc_id: doc}.
+    """
+    doc_id, file_name = split_doc_path(path)
+    return doc_files(docs.get(doc_id, {})).get(file_name)
+
+
+def unchanged(stub, file_path, manifest):
+    """
+    Whether the attachment stub holds what the local file_path does. The digest of an attachment
+    couchdb stores compressed is of the gzipped bytes, so that one is compared on its length and
+    the digest the file was last synced with instead.
+    """
+    if not stub or stub.get('length') != os.path.getsize(file_path):
+        return False
+    if stub.get('encoding'):
+        return manifest.synced(file_path) == stub.get('digest')
+    return stub.get('digest') == manifest.digest(file_path)
+
+
+def map_unordered(fn, jobs, max_workers=1):
+    """
+    Calls fn(*job) for every job, yielding the results in completion order.
+    Jobs are pulled lazily so at most 2 * max_workers of them are in flight.
+    Workers run in a copy of the caller's context, so they keep its priority.
+    """
+    if max_workers <= 1:
+        for job in jobs:
+            yield fn(*job)
+        return
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for job in jobs:
+            pending.add(executor.submit(contextvars.copy_context().run, fn, *job))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+class TransferResult(tuple):
+    """
+    The (src, dst, status, reason) of an upload or a download. It unpacks like a
+    plain 4-tuple, with the bytes moved, the time taken, the md5 digest of the bytes,
+    whether it matched the server's digest (None when there was nothing to check)
+    and the number of requests that had to be sent again as attributes.
+    """
+
+    def __new__(cls, src, dst, status, reason, size=0, seconds=0.0, digest=None, verified=None, retries=0):
+        result = super(TransferResult, cls).__new__(cls, (src, dst, status, reason))
+        result.size = size
+        result.seconds = seconds
+        result.digest = digest
+        result.verified = verified
+        result.retries = retries
+        return result
+
+    src = property(itemgetter(0))
+    dst = property(itemgetter(1))
+    status = property(itemgetter(2))
+    reason = property(itemgetter(3))
+
+    @property
+    def rate(self):
+        """bytes per second"""
+        return self.size / self.seconds if self.seconds else 0.0
+
+
+def counts_retries(method):
+    """
+    Sets the retries of the TransferResult, or list of them, method returns to the retries made while it ran.
+    """
+    @functools.wraps(method)
+    def counted(*args, **kwargs):
+        with counting_retries() as retries:
+            result = method(*args, **kwargs)
+        for transfer in result if isinstance(result, list) else [result]:
+            if isinstance(transfer, TransferResult):
+                transfer.retries = retries.count
+        return result
+    return counted
+
+
+def drop_files(names):
+    """
+    :return: a doc change, for update_doc or bulk_update, dropping the attachments and chunked files names
+    """
+    def change(doc):
+        for name in names:
+            doc.get('_attachments', {}).pop(name, None)
+            doc.get('couchfs_files', {}).pop(name, None)
+    return change
+
+
+def add_file(name, entry):
+    """
+    :return: a doc change adding the chunked file entry as name, replacing any attachment of the same name
+    """
+    def change(doc):
+        doc.setdefault('couchfs_files', {})[name] = entry
+        doc.get('_attachments', {}).pop(name, None)
+    return change
+
+
+def delete_doc(doc):
+    doc['_deleted'] = True
+
+
+class HashingReader:
+    """
+    Wraps a file object so the md5 of everything read through it is computed as it is sent,
+    at the pace of throttle when given one.
+    """
+
+    def __init__(self, fp, chunk_size=64 * 1024, throttle=None):
+        self.fp = fp
+        self.throttle = throttle
+        self.chunk_size = chunk_size
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+        self.md5.update(data)
+        self.size += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+    def tell(self):
+        return self.fp.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.md5 = hashlib.md5()
+        self.size = 0
+        return self.fp.seek(offset, whence)
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    @property
+    def mode(self):
+        return getattr(self.fp, 'mode', 'rb')
+
+    @property
+    def digest(self):
+        return md5_digest(self.md5)
+
+
+def content_encoded(headers):
+    return headers.get('Content-Encoding', 'identity') != 'identity'
+
+
+def server_digest(headers):
+    """
+    The couchdb style digest of an attachment from its Content-MD5 header, or ETag
+    when that holds a base64 md5, or None. None as well for an attachment couchdb
+    sends compressed, its digest is the md5 of the compressed bytes, not of the body.
+    """
+    if content_encoded(headers):
+        return None
+    value = headers.get('Content-MD5') or headers.get('ETag', '').strip('"')
+    if len(value) == 24 and value.endswith('=='):
+        return f'md5-{value}'
+
+
+class RevisionCache:
+    """
+    The latest known revision of each doc, fed from write responses so that
+    a write does not need a HEAD first, plus a lock per doc so concurrent
+    writers to the same doc take turns instead of fighting over revisions.
+    The bodies of docs fetched or written whole are kept too, and handed out
+    while their rev is still the latest known one.
+    """
+
+    def __init__(self):
+        self._revs = {}
+        self._docs = {}
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def get(self, doc_id):
+        return self._revs.get(doc_id)
+
+    def set(self, doc_id, rev):
+        rev = rev.strip('"')
+        self._revs[doc_id] = rev
+        return rev
+
+    def set_doc(self, doc):
+        """
+        Remembers doc, as json so later changes to it don't show, and its rev.
+        """
+        self._docs[doc['_id']] = (doc['_rev'], json.dumps(doc))
+        self.set(doc['_id'], doc['_rev'])
+
+    def latest_doc(self, doc_id):
+        """
+        :return: a copy of the doc remembered at the latest known rev, or None
+        """
+        rev, body = self._docs.get(doc_id, (None, None))
+        return json.loads(body) if rev is not None and rev == self._revs.get(doc_id) else None
+
+    def discard(self, doc_id):
+        self._revs.pop(doc_id, None)
+        self._docs.pop(doc_id, None)
+
+    def clear(self):
+        self._revs.clear()
+        self._docs.clear()
+
+    def lock(self, doc_id):
+        with self._guard:
+            return self._locks.setdefault(doc_id, threading.RLock())
+
+
 class CouchDBClient:
     URI_ENVIRON_KEY = 'COUCHDB_URI'
     CONNECTION_RE = 'couchdb(s)?://((\w+)\:(.+)@)?([\w\.]+)(:(\d+))?/(\w+)'
     URI_RE = re.compile(CONNECTION_RE)
+    # options that can be passed to the constructor or in the uri query string,
+    # e.g. couchdb://host:5984/db?pool_size=20&timeout=30
+    OPTIONS = {
+        'pool_size': (int, Transport.DEFAULT_POOL_SIZE),
+        'pool_connections': (int, Transport.DEFAULT_POOL_CONNECTIONS),
+        'keep_alive': (as_bool, True),
+        'timeout': (as_timeout, None),
+        'connect_timeout': (as_timeout, Transport.DEFAULT_CONNECT_TIMEOUT),
+        'batch_bytes': (int, 8 * 1024 * 1024),
+        'batch_files': (int, 1000),
+        'inline_bytes': (int, 4 * 1024),
+        'view_page_size': (int, 1000),
+        'verify': (as_bool, False),
+        'manifest_dir': (os.path.expanduser, os.path.expanduser('~/.cache/couchfs/manifests')),
+        'index': (os.path.expanduser, None),
+        'blob_cache': (os.path.expanduser, None),
+        'blob_cache_bytes': (int, 1024 * 1024 * 1024),
+        'chunk_threshold': (int, 0),
+        'chunk_size': (int, 16 * 1024 * 1024),
+        'chunk_workers': (int, 4),
+        'dedup': (as_bool, False),
+        'dedup_min_bytes': (int, 64 * 1024),
+        'bandwidth': (int, 0),
+        'adaptive': (as_bool, False),
+        'retries': (int, 3),
+        'conflict_retries': (int, 5),
+        'retry_backoff': (float, 0.5),
+        'retry_max_backoff': (float, 30.0),
+    }
 
-    def __init__(self, uri=None):
+    def __init__(self, uri=None, transport=None, **options):
         if uri is None:
             uri = os.environ.get(self.URI_ENVIRON_KEY)
         if not uri:
             key = self.URI_ENVIRON_KEY
             raise URLRequired(f'You can set environment varialble {key}')
+        uri, _, query = uri.partition('?')
         scheme, userid, psswd, host, port, db = self.parse_connection_uri(uri)
         if userid and psswd:
             self.auth = (userid, psswd)
@@ -50,26 +398,149 @@ class CouchDBClient:
             self.auth = None
         self.db = db
         self.db_uri = f'{scheme}://{host}{port}/{self.db}'
+        self.options = self.parse_options(dict(parse_qsl(query), **options))
+        self.retry = RetryPolicy(self.options['retries'], self.options['conflict_retries'],
+                                 self.options['retry_backoff'], self.options['retry_max_backoff'])
+        if transport is None:
+            transport = Transport(auth=self.auth, pool_size=self.options['pool_size'],
+                                  pool_connections=self.options['pool_connections'],
+                                  keep_alive=self.options['keep_alive'], timeout=self.options['timeout'],
+                                  connect_timeout=self.options['connect_timeout'], retry=self.retry)
+        self.transport = transport
+        self.throttle = Throttle(self.options['bandwidth'], self.options['pool_size'], self.options['adaptive'])
+        if self.options['adaptive']:
+            # first, so the time waiting for a slot is not counted as latency by later hooks
+            self.transport.hooks.insert(0, self.throttle)
+        self.revs = RevisionCache()
+        self.index = Index(self, self.options['index']) if self.options['index'] else None
+        self.blobs = None
+        if self.options['blob_cache']:
+            self.blobs = BlobCache(self.options['blob_cache'], self.options['blob_cache_bytes'])
+
+    def parse_options(self, options):
+        """
+        Converts and validates client options against OPTIONS, filling in defaults.
+        :param options: {name: value} from the uri query string and constructor
+        :return {name: value}:
+        """
+        parsed = {}
+        for name, value in options.items():
+            if name not in self.OPTIONS:
+                raise BadClientOption(f'unknown option {name}, use one of {", ".join(self.OPTIONS)}')
+            convert, _ = self.OPTIONS[name]
+            try:
+                parsed[name] = convert(value)
+            except (TypeError, ValueError):
+                raise BadClientOption(f'bad value {value!r} for option {name}')
+        for name, (_, default) in self.OPTIONS.items():
+            parsed.setdefault(name, default)
+        return parsed
 
     def check_db(self):
-        response = requests.head(f"{self.db_uri}", auth=self.auth)
+        response = self.transport.head(f"{self.db_uri}")
         return response.status_code == 200
 
     def create_db(self):
-        response = requests.put(f"{self.db_uri}", auth=self.auth)
+        response = self.transport.put(f"{self.db_uri}")
         response.raise_for_status()
 
     def save_doc(self, doc):
         _id = doc['_id']
         doc_uri = f'{self.db_uri}/{_id}'
-        response = requests.head(doc_uri, auth=self.auth)
-        if response.status_code == 200:
-            rev = response.headers['ETag']
-            headers = {'If-Match': rev[1:-1]}
-            response = requests.put(doc_uri, json=doc, headers=headers, auth=self.auth)
-        elif response.status_code == 404:
-            response = requests.post(self.db_uri, json=doc, auth=self.auth)
-        response.raise_for_status()
+        with self.revs.lock(_id):
+            rev = self.doc_rev(_id)
+            if rev is None:
+                response = self.transport.post(self.db_uri, json=doc)
+            else:
+                response = self.transport.put(doc_uri, json=doc, headers={'If-Match': rev})
+            attempt = 0
+            while response.status_code == 409 and attempt < self.retry.conflicts:
+                attempt += 1
+                self.conflict_wait(attempt, 'PUT', doc_uri)
+                rev = self.doc_rev(_id, refresh=True)
+                response = self.transport.put(doc_uri, json=doc, headers={'If-Match': rev} if rev else {})
+            response.raise_for_status()
+            self.remember_rev(_id, response)
+
+    def doc_rev(self, doc_id, refresh=False):
+        """
+        The latest known revision of a doc, from the revision cache or else a HEAD.
+        :param doc_id: id
+        :param refresh: skip the cache
+        :return: rev or None if the doc does not exist
+        """
+        rev = None if refresh else self.revs.get(doc_id)
+        if rev is None:
+            response = self.transport.head(f'{self.db_uri}/{doc_id}')
+            if response.status_code == 404:
+                self.revs.discard(doc_id)
+                return None
+            response.raise_for_status()
+            rev = self.revs.set(doc_id, response.headers['ETag'])
+        return rev
+
+    def ensure_doc(self, doc_id, refresh=False):
+        """
+        The latest revision of a doc, creating an empty doc if there is none.
+        :param doc_id: id
+        :param refresh: skip the revision cache
+        :return: rev
+        """
+        rev = self.doc_rev(doc_id, refresh)
+        if rev is None:
+            response = self.transport.post(f'{self.db_uri}', json=dict(_id=doc_id))
+            if response.status_code == 409:
+                return self.doc_rev(doc_id, refresh=True)
+            response.raise_for_status()
+            rev = self.remember_rev(doc_id, response)
+        return rev
+
+    def remember_rev(self, doc_id, response):
+        """
+        Feeds the revision cache from the response of a write to doc_id.
+        :return: the new rev or None if the response did not carry one
+        """
+        try:
+            rev = response.json().get('rev')
+        except ValueError:
+            rev = None
+        rev = rev or response.headers.get('ETag')
+        if rev:
+            return self.revs.set(doc_id, rev)
+        self.revs.discard(doc_id)
+
+    def conflict_wait(self, attempt, method, url):
+        """
+        Waits before the attempt-th write after a conflict, see RetryPolicy.conflict_wait, and tells
+        the hooks with a retried method that the request is sent again, as the transport does.
+        """
+        for hook in list(self.transport.hooks):
+            if hasattr(hook, 'retried'):
+                hook.retried(method, url)
+        self.retry.conflict_wait(attempt)
+
+    def add_hook(self, hook):
+        """
+        Calls hook.request_started and hook.request_finished around every request of this client,
+        see Transport.
+        :return: hook
+        """
+        self.transport.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        """
+        Stops calling a hook added with add_hook.
+        """
+        self.transport.hooks.remove(hook)
+
+    def collect_stats(self, trace=False):
+        """
+        Starts counting the requests of this client per endpoint.
+        :param trace: also keep a trace event per request for RequestStats.dump_trace
+        :return: RequestStats, read it with summary() or format()
+        """
+        return self.add_hook(RequestStats(trace=trace))
 
 
     def parse_connection_uri(self, uri):
@@ -88,123 +559,1069 @@ class CouchDBClient:
             raise BadConnectionURI(f'use a connections like {self.CONNECTION_RE}')
 
     def list_attachments(self, *patterns):
-        regexs = []
+        """
+        Lists the attachments whose path starts with, or glob matches, any of patterns.
+        Only the view rows under the literal prefix of each pattern are fetched.
+        :return: yields file_path, file_size
+        """
+        if not patterns:
+            yield from self.run_view()
+            return
+        for prefix, regexs in self.pattern_prefixes(patterns):
+            startkey, endkey = key_range(prefix)
+            for file_path, file_size in self.run_view(startkey=startkey, endkey=endkey):
+                if any(regex.match(file_path) for regex in regexs):
+                    yield file_path, file_size
+
+    def pattern_prefixes(self, patterns):
+        """
+        Groups patterns under their literal (wildcard free) prefixes, dropping any prefix
+        that starts with another one so that no view row is fetched twice.
+        :return: [(prefix, [regex])]
+        """
+        groups = {}
         for pattern in patterns:
-            if self.WILDCARD_RE.search(pattern):
-                regex = re.compile(fnmatch.translate(pattern))
+            pattern = pattern.lstrip('/')
+            if match := self.WILDCARD_RE.search(pattern):
+                prefix, regex = pattern[:match.start()], re.compile(fnmatch.translate(pattern))
             else:
-                regex = re.compile(fnmatch.translate(pattern)[:-2])
-            regexs.append(regex)
-        for file_path, file_size in self.run_view():
-            if not regexs or any([regex.search(file_path) for regex in regexs]):
-                yield file_path, file_size
+                prefix, regex = pattern, re.compile(fnmatch.translate(pattern)[:-2])
+            groups.setdefault(prefix, []).append(regex)
+        merged = []
+        for prefix in sorted(groups):
+            if merged and prefix.startswith(merged[-1][0]):
+                merged[-1][1].extend(groups[prefix])
+            else:
+                merged.append((prefix, groups[prefix]))
+        return merged
 
     def run_view(self, **args):
-        params = {'reduce': False, 'include_docs': False}
+        """
+        Runs the attachment_list view.
+        :param depth: group the reduce to this many path segments
+        :param startkey: first key, a list of path segments
+        :param endkey: last key, a list of path segments
+        :return: yields file_path, value
+        """
+        if self.index is not None:
+            self.index.refresh()
+            yield from self.index.run_view(**args)
+            return
+        params = {'reduce': 'false', 'include_docs': 'false'}
         if 'depth' in args:
             params['group_level'] = args['depth']
-            params['reduce'] = True
-        response = requests.get(f"{self.db_uri}/_design/couchfs_views/_view/attachment_list", params=params, auth=self.auth)
-        response.raise_for_status()
-        for doc in response.json()['rows']:
-            yield '/'.join(doc['key']), doc['value']
+            params['reduce'] = 'true'
+        for key in ('startkey', 'endkey'):
+            if args.get(key) is not None:
+                params[key] = json.dumps(args[key])
+        page_size = self.options['view_page_size']
+        params['limit'] = page_size + 1
+        url = f"{self.db_uri}/_design/couchfs_views/_view/attachment_list"
+        while True:
+            count, next_row = 0, None
+            with self.transport.get(url, params=params, stream=True) as response:
+                response.raise_for_status()
+                for doc in iter_view_rows(response.iter_content(chunk_size=self.CHUNK_SIZE)):
+                    count += 1
+                    if count > page_size:
+                        next_row = doc
+                    else:
+                        yield '/'.join(doc['key'] or []), doc['value']
+            if next_row is None:
+                return
+            params['startkey'] = json.dumps(next_row['key'])
+            if params['reduce'] == 'false':
+                params['startkey_docid'] = next_row['id']
 
-    def download(self, src, dst, dry_run=False):
-        for src, dst in self.download_srcdst(src, dst):
-            if dry_run:
-                yield src, dst, 'DRY RUN', response
-            else:
-                uri = f'{self.db_uri}/{src}'
-                response = requests.get(uri, auth=self.auth)
-                yield uri, dst, response.status_code, response.reason
+    def disk_usage(self, path='', depth=0):
+        """
+        Sums up the attachments under path with the _stats reduce of the attachment_list view,
+        so only one row per directory comes back instead of one per attachment.
+        :param path: doc id followed by an optional path, '' for the whole database
+        :param depth: how many levels below path to break the totals down to
+        :return: yields path, count, total bytes, smallest, largest
+        """
+        path = path.strip('/')
+        startkey, endkey = key_range(f'{path}/' if path else '')
+        group_level = (len(startkey) if startkey else 0) + depth
+        for dir_path, stats in self.run_view(depth=group_level, startkey=startkey, endkey=endkey):
+            yield dir_path, stats['count'], stats['sum'], stats['min'], stats['max']
+
+    def download(self, src, dst, dry_run=False, max_workers=1, priority=BULK):
+        """
+        Downloads the attachments matching src into the local directory dst.
+        Directories are created up front, then each attachment is streamed to a
+        temporary file next to its destination and renamed into place when complete.
+        :param src: doc id followed by an optional path or glob
+        :param dst: local directory
+        :param dry_run: only yield what would be downloaded
+        :param max_workers: number of files downloaded at the same time
+        :param priority: of its requests when the throttle makes them wait, lower goes first
+        :return: yields TransferResult(file_url, dest_path, status, reason) as each download completes
+        """
+        jobs = list(self.download_srcdst(src, dst))
+        if dry_run:
+            for file_path, dest_path in jobs:
+                yield file_path, dest_path, 'DRY RUN', ''
+            return
+        for dir_path in sorted({os.path.dirname(dest_path) for _, dest_path in jobs}):
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+        yield from map_unordered(prioritized(self.download_path, priority), jobs, max_workers)
 
     WILDCARD_RE = re.compile('[\*\?\[\]]+')
 
-    def download_srcdst(self, src, dst, dry_run=False):
-        if match := self.WILDCARD_RE.search(src):
+    def download_srcdst(self, src, dst):
+        """
+        Matches src against the attachment_list view and maps every match to a path under dst.
+        The bare doc id the view has for a doc without files is no file and is left out.
+        'TAKIS/takis/*.py', 'dump' -> 'TAKIS/takis/asgi.py', 'dump/asgi.py'
+        'TAKIS/takis', 'dump' -> 'TAKIS/takis/media/t126.jpg', 'dump/media/t126.jpg'
+        """
+        src = src.strip('/')
+        root = self.path_root(src)
+        for file_path in self.matching_paths(src):
+            if not split_doc_path(file_path)[1]:
+                continue
+            if file_path == root:
+                dest_path = os.path.join(dst, os.path.basename(file_path))
+            else:
+                dest_path = os.path.join(dst, file_path[len(root):].lstrip('/'))
+            yield file_path, dest_path
+
+    def path_root(self, src, glob=True):
+        """
+        The part of src that the paths it matches are mapped relative to.
+        'TAKIS/takis/*.py' -> 'TAKIS/takis', 'TAKIS/takis' -> 'TAKIS/takis'
+        """
+        if glob and (match := self.WILDCARD_RE.search(src)):
+            return src[:match.start()].rpartition('/')[0]
+        return src
+
+    def matching_paths(self, src, glob=True):
+        """
+        The attachment_list view paths src matches: the path itself and everything below it or, with glob, what
+        the glob matches. A doc without files shows up as its bare doc id.
+        :return: yields file_path
+        """
+        if glob and self.WILDCARD_RE.search(src):
             regex = re.compile(fnmatch.translate(src))
-            is_copying_files = True
+            prefix, _ = self.pattern_prefixes([src])[0]
         else:
-            regex = re.compile(fnmatch.translate(src)[:-2])
-            sub_regex = re.compile(src)
-
-            is_copying_files = False
-        for file_path, _ in self.ls():
-            if regex.search(file_path):
-                if is_copying_files:
-                    match = self.WILDCARD_RE.search(src)
-                    dst_file_path = file_path[match.span()[0]:]
-                    if dst_file_path.startswith('/'):
-                        dst_file_path = file_path[1:]
-                    dest_path = os.path.join(dst, dst_file_path)
-                else:
-                    dst_file_path = file_path[len(src):]
-                    if file_path.startswith('/'):
-                        dst_file_path = dst_file_path[1:]
-                    dest_path = os.path.join(dst, dst_file_path[1:])
-                if not dest_path.startswith('dump'):
-                    print('NO DUMP', is_copying_files, dst, file_path[len(src):])
-                    # break
-                yield file_path, dest_path
+            regex = re.compile(re.escape(src) + '(/|$)' if src else '')
+            prefix = src
+        startkey, endkey = key_range(prefix)
+        for file_path, _ in self.run_view(startkey=startkey, endkey=endkey):
+            if regex.match(file_path):
+                yield file_path
+
+    @counts_retries
+    def download_path(self, file_path, dest_path, digest=None):
+        """
+        Streams one attachment to dest_path through a temporary file in the same directory,
+        computing its md5 on the way. The file is only renamed into place if that matches
+        digest, or else the Content-MD5 couchdb sent. A compressed attachment is not checked,
+        couchdb's digest is of the compressed bytes, which requests decodes.
+        :param digest: the plain_digest of the attachment stub if known
+        :return: TransferResult(file_url, dest_path, status, reason) with the size, time taken and digest
+        """
+        uri = f'{self.db_uri}/{file_path}'
+        if self.blobs is not None:
+            result = self.download_cached(uri, dest_path, digest)
+            if result is not None:
+                return result
+        tmp_path = None
+        start = time.monotonic()
+        md5 = hashlib.md5()
+        try:
+            with self.transport.get(uri, stream=True) as response:
+                if response.status_code == 404:
+                    release(response)
+                    manifest = self.chunk_manifest(file_path)
+                    if manifest:
+                        return self.download_chunked(uri, dest_path, manifest)
+                if response.status_code != 200:
+                    return TransferResult(uri, dest_path, response.status_code, response.reason)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path) or '.',
+                                                prefix=f'.{os.path.basename(dest_path)}.', suffix='.part')
+                with os.fdopen(fd, 'wb') as fp:
+                    size = self.stream_to_file(response, fp, md5)
+            expected = None if content_encoded(response.headers) else digest or server_digest(response.headers)
+            actual = md5_digest(md5)
+            if expected and expected != actual:
+                os.unlink(tmp_path)
+                return TransferResult(uri, dest_path, 'BAD DIGEST', f'expected {expected} got {actual}',
+                                      size, time.monotonic() - start, actual, verified=False)
+            os.replace(tmp_path, dest_path)
+        except (RequestException, OSError) as error:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return TransferResult(uri, dest_path, 'ERROR', str(error))
+        return TransferResult(uri, dest_path, response.status_code, response.reason,
+                              size=size, seconds=time.monotonic() - start, digest=actual,
+                              verified=True if expected else None)
+
+    def download_cached(self, uri, dest_path, digest=None):
+        """
+        download_path through the blob cache, the attachment is only fetched if no
+        attachment with the same digest was before.
+        :return: TransferResult, or None when the attachment can't be cached
+        """
+        start = time.monotonic()
+        tmp_path = None
+        try:
+            digest = digest or self.attachment_digest(uri)
+            if not self.blobs.cacheable(digest):
+                return None
+            blob_path = self.blobs.fetch(digest, lambda fp: self.download_to_file(uri, fp))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path) or '.',
+                                            prefix=f'.{os.path.basename(dest_path)}.', suffix='.part')
+            with os.fdopen(fd, 'wb') as fp, open(blob_path, 'rb') as blob:
+                shutil.copyfileobj(blob, fp, self.CHUNK_SIZE)
+            os.replace(tmp_path, dest_path)
+        except DigestMismatch as error:
+            return TransferResult(uri, dest_path, 'BAD DIGEST', str(error), verified=False)
+        except (RequestException, OSError) as error:
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return TransferResult(uri, dest_path, 'ERROR', str(error))
+        return TransferResult(uri, dest_path, 200, 'OK', size=os.path.getsize(dest_path),
+                              seconds=time.monotonic() - start, digest=digest, verified=True)
+
+    def attachment_digest(self, url):
+        """
+        The digest of the attachment at url, from the local index if there is one or
+        else from the ETag of a HEAD request, so no body is transferred.
+        :return: 'md5-...' or None if it is not known
+        """
+        if self.index is not None and url.startswith(f'{self.db_uri}/'):
+            self.index.refresh()
+            entry = self.index.stat(url[len(self.db_uri) + 1:])
+            if entry is not None:
+                return entry[1]
+        response = self.transport.head(url)
+        if response.status_code != 200:
+            return None
+        return server_digest(response.headers)
+
+    def cached_attachment(self, url, digest=None):
+        """
+        The path of the attachment in the blob cache, fetching it on a miss.
+        :param digest: the digest of the attachment stub if known, saves asking for it
+        :return: the path, or None when there is no cache or the attachment can't be cached
+        :raises DigestMismatch: when couchdb sent something else than digest
+        """
+        if self.blobs is None:
+            return None
+        digest = digest or self.attachment_digest(url)
+        if not self.blobs.cacheable(digest):
+            return None
+        return self.blobs.fetch(digest, lambda fp: self.download_to_file(url, fp))
+
+    CHUNK_SIZE = 64 * 1024
 
     def download_file(self, url, dest):
         with open(dest, 'wb') as f:
             return self.download_to_file(url, f)
 
     def download_to_file(self, url, file_obj):
-        with requests.get(url, stream=True, auth=self.auth) as r:
+        with self.transport.get(url, stream=True) as r:
+            if r.status_code == 404:
+                release(r)
+                manifest = self.chunk_manifest(url[len(self.db_uri) + 1:])
+                if manifest:
+                    return sum(self.download_to_file(self.chunk_url(chunk_id), file_obj)
+                               for chunk_id in manifest['chunks'])
             r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    file_obj.write(chunk)
+            return self.stream_to_file(r, file_obj)
+
+    def chunk_url(self, chunk_id):
+        return f'{self.db_uri}/{chunk_id}/data'
+
+    def chunk_manifest(self, path):
+        """
+        The couchfs_files manifest entry of a chunked file, from the doc remembered at its
+        latest known rev if it is in there.
+        :param path: doc id followed by the file name
+        :return: {'length', 'digest', 'content_type', 'chunk_size', 'chunks'} or None
+        """
+        doc_id, file_name = split_doc_path(path)
+        if not file_name:
+            return None
+        manifest = self.cached_manifest(path)
+        if manifest is not None:
+            return manifest
+        doc = self.get_doc(doc_id)
+        return doc.get('couchfs_files', {}).get(file_name) if doc else None
+
+    def cached_manifest(self, path):
+        """
+        chunk_manifest without any request, None when the doc at its latest rev, which the
+        index knows if there is one, is not remembered or has no such chunked file.
+        """
+        doc_id, file_name = split_doc_path(path)
+        if self.index is not None:
+            entry = self.index.stat(path)
+            if entry is not None and entry[3] != self.revs.get(doc_id):
+                return None
+        doc = self.revs.latest_doc(doc_id)
+        return doc.get('couchfs_files', {}).get(file_name) if doc and file_name else None
+
+    def download_chunked(self, uri, dest_path, manifest):
+        """
+        Downloads the chunks of a chunked file in parallel into a temporary file next to dest_path.
+        The temporary file is named after the file's digest and kept when a chunk fails, so
+        downloading again only fetches the chunks that are not already in it.
+        :return: TransferResult(file_url, dest_path, status, reason)
+        """
+        start = time.monotonic()
+        digest = manifest['digest']
+        tmp_path = os.path.join(os.path.dirname(dest_path) or '.',
+                                f'.{os.path.basename(dest_path)}.{base64.b64decode(digest[4:]).hex()}.part')
+        chunk_size = manifest['chunk_size']
+        jobs = [(chunk_id, index * chunk_size) for index, chunk_id in enumerate(manifest['chunks'])]
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, manifest['length'])
+
+            def fetch(chunk_id, offset):
+                size = min(chunk_size, manifest['length'] - offset)
+                if hashlib.md5(os.pread(fd, size, offset)).hexdigest() == chunk_id[len(CHUNK_DOC_PREFIX):]:
+                    return 0
+                data = self.get_chunk(chunk_id)
+                os.pwrite(fd, data, offset)
+                return len(data)
+
+            fetched = sum(map_unordered(fetch, jobs, self.options['chunk_workers']))
+        except (RequestException, OSError, ValueError) as error:
+            return TransferResult(uri, dest_path, 'ERROR', str(error))
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, dest_path)
+        return TransferResult(uri, dest_path, 200, 'OK', size=fetched, seconds=time.monotonic() - start,
+                              digest=digest, verified=True)
+
+    def get_chunk(self, chunk_id, offset=0, size=None):
+        """
+        The bytes of a chunk, or of a range of it, checked against the chunk id when whole.
+        :raises ValueError: when a whole chunk does not match its id
+        """
+        headers = {} if size is None else {'Range': f'bytes={offset}-{offset + size - 1}'}
+        response = self.transport.get(self.chunk_url(chunk_id), headers=headers)
+        response.raise_for_status()
+        data = response.content
+        self.throttle.consume(len(data))
+        if size is None:
+            if hashlib.md5(data).hexdigest() != chunk_id[len(CHUNK_DOC_PREFIX):]:
+                raise ValueError(f'chunk {chunk_id} is corrupt')
+        elif response.status_code != 206:
+            data = data[offset:offset + size]
+        return data
+
+    def stream_to_file(self, response, file_obj, md5=None):
+        size = 0
+        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+            if chunk:
+                self.throttle.consume(len(chunk))
+                file_obj.write(chunk)
+                size += len(chunk)
+                if md5 is not None:
+                    md5.update(chunk)
+        return size
 
     @contextmanager
-    def get_attachment(self, url, in_memory=False):
+    def get_attachment(self, url, in_memory=False, lazy=False):
+        """
+        The attachment at url as bytes, a temporary file removed on exit or, with lazy, an
+        AttachmentFile that only fetches the ranges read from it.
+        """
+        blob_path = self.cached_attachment(url)
+        if blob_path is not None:
+            with open(blob_path, 'rb') as fp:
+                yield fp.read() if in_memory else fp
+            return
+        if in_memory:
+            with self.open_attachment(url, buffering=0) as fp:
+                yield fp.readall()
+            return
+        if lazy:
+            with self.open_attachment(url) as fp:
+                yield fp
+            return
+        fp = tempfile.NamedTemporaryFile(delete=False)
         try:
-            if in_memory:
-                bytes_fp = io.BytesIO()
-                self.download_to_file(url, bytes_fp)
-                yield bytes_fp.getvalue()
-            else:
-                fp = tempfile.NamedTemporaryFile(delete=False)
-                self.download_to_file(url, fp)
-                fp.close()
-                yield open(fp.name, 'rb')
+            self.download_to_file(url, fp)
+            fp.close()
+            with open(fp.name, 'rb') as tmp_fp:
+                yield tmp_fp
         finally:
-            if in_memory:
-                bytes_fp.close()
-            else:
-                os.unlink(fp.name)
+            os.unlink(fp.name)
+
+    def open_attachment(self, url, size=None, buffering=io.DEFAULT_BUFFER_SIZE):
+        """
+        A lazy, seekable, read only file object on the attachment at url.
+        :param size: the attachment length if known
+        :param buffering: 0 for the raw AttachmentFile, else the io.BufferedReader buffer size
+        """
+        if size is None and self.index is not None and url.startswith(f'{self.db_uri}/'):
+            entry = self.index.stat(url[len(self.db_uri) + 1:])
+            size = entry[0] if entry is not None else None
+        raw = AttachmentFile(self, url, size)
+        return io.BufferedReader(raw, buffering) if buffering else raw
 
     def get_attachment_as_bytes(self, url):
-        return requests.get(url, stream=True, auth=self.auth).content
+        return self.transport.get(url).content
+
+    def read_range(self, url, offset, size):
+        """
+        Reads size bytes of an attachment from offset with an HTTP Range request.
+        :return: bytes, fewer than size at the end of the attachment
+        """
+        if size <= 0:
+            return b''
+        blob_path = self.local_blob(url)
+        if blob_path is not None:
+            with open(blob_path, 'rb') as fp:
+                return os.pread(fp.fileno(), size, offset)
+        # a chunked file read before goes straight to its chunks, without the 404 and the doc
+        manifest = url.startswith(f'{self.db_uri}/') and self.cached_manifest(url[len(self.db_uri) + 1:])
+        if manifest:
+            return self.read_chunks(manifest, offset, size)
+        response = self.transport.get(url, headers={'Range': f'bytes={offset}-{offset + size - 1}'})
+        if response.status_code == 404 and (manifest := self.chunk_manifest(url[len(self.db_uri) + 1:])):
+            return self.read_chunks(manifest, offset, size)
+        if response.status_code == 416:
+            return b''
+        response.raise_for_status()
+        if response.status_code == 206:
+            return response.content
+        return response.content[offset:offset + size]
+
+    def read_chunks(self, manifest, offset, size):
+        """
+        read_range over the chunks of a chunked file, one Range request per chunk the range touches.
+        """
+        chunk_size, data = manifest['chunk_size'], []
+        end = min(offset + size, manifest['length'])
+        while offset < end:
+            index, chunk_offset = divmod(offset, chunk_size)
+            length = min(chunk_size - chunk_offset, end - offset)
+            data.append(self.get_chunk(manifest['chunks'][index], chunk_offset, length))
+            offset += length
+        return b''.join(data)
+
+    def local_blob(self, url):
+        """
+        The cached blob of url when the local index knows its digest, without any request.
+        """
+        if self.blobs is None or self.index is None or not url.startswith(f'{self.db_uri}/'):
+            return None
+        entry = self.index.stat(url[len(self.db_uri) + 1:])
+        return self.blobs.get(entry[1]) if entry is not None else None
+
+    def upload(self, src, dst, dry_run=False, max_workers=1, batch=False, priority=BULK):
+        """
+        Uploads src, a file or a directory tree, under dst.
+        :param src: local path
+        :param dst: doc id followed by an optional path
+        :param dry_run: only yield what would be uploaded
+        :param max_workers: number of uploads at the same time. Writes to one doc wait for each other,
+            each makes a new revision, so a tree, which always goes into a single doc, is batched
+            when there is more than one
+        :param batch: write small files for the same doc together, see upload_batch
+        :param priority: of its requests when the throttle makes them wait, lower goes first
+        :return: yields file_name, file_url, upload status, upload message as each upload completes
+        """
+        jobs = self.upload_srcdst(src, dst)
+        if dry_run:
+            for file_path, dest_path in jobs:
+                yield file_path, dest_path, 'DRY RUN', ''
+        elif batch or max_workers > 1 and os.path.isdir(src):
+            docs = {}
+            batches = ((doc_id, files, docs) for doc_id, files in self.batch_srcdst(jobs))
+            for results in map_unordered(prioritized(self.upload_batch, priority), batches, max_workers):
+                yield from results
+        else:
+            yield from self.upload_paths(jobs, max_workers, priority)
+
+    def upload_paths(self, jobs, max_workers=1, priority=BULK):
+        """
+        Uploads (file_path, dest_path) jobs into any number of docs. The jobs are read
+        view_page_size at a time, as the uploads need them, and the revs of each window's
+        docs are fetched, and the missing docs created, with ensure_docs before it starts.
+        :return: yields TransferResult as each upload completes
+        """
+        jobs, ensured = iter(jobs), set()
+
+        def prefetched():
+            for window in iter(lambda: list(islice(jobs, self.options['view_page_size'])), []):
+                doc_ids = {split_doc_path(dest_path)[0] for _, dest_path in window} - ensured
+                try:
+                    self.ensure_docs(doc_ids)
+                except RequestException:
+                    # only a prefetch, each upload still finds or creates its doc
+                    pass
+                ensured.update(doc_ids)
+                yield from window
+
+        yield from map_unordered(prioritized(self.upload_path, priority), prefetched(), max_workers)
+
+    def batch_srcdst(self, jobs):
+        """
+        Groups (file_path, dest_path) jobs by doc id into batches that stay within the
+        batch_bytes and batch_files options. A file bigger than batch_bytes is a batch on its own.
+        :return: yields doc_id, [(file_path, file_name, size)]
+        """
+        max_bytes, max_files = self.options['batch_bytes'], self.options['batch_files']
+        batches = {}
+        for file_path, dest_path in jobs:
+            doc_id, file_name = split_doc_path(dest_path)
+            size = os.path.getsize(file_path)
+            if size > max_bytes or self.chunked(size):
+                yield doc_id, [(file_path, file_name, size)]
+                continue
+            files = batches.setdefault(doc_id, [])
+            if files and (len(files) >= max_files or sum(f[2] for f in files) + size > max_bytes):
+                yield doc_id, files
+                files = batches[doc_id] = []
+            files.append((file_path, file_name, size))
+        for doc_id, files in batches.items():
+            if files:
+                yield doc_id, files
+
+    @counts_retries
+    def upload_batch(self, doc_id, files, docs=None):
+        """
+        Writes several files into one doc with a single multipart/related PUT, so the whole
+        batch costs one revision. Files up to the inline_bytes option are sent inline as base64.
+        :param doc_id: id
+        :param files: [(file_path, file_name, size)]
+        :param docs: {doc_id: doc} bodies known from earlier batches, saves a GET per batch
+        :return: [(file_name, file_url, upload status, upload message)]
+        """
+        doc_uri = f'{self.db_uri}/{doc_id}'
+        if len(files) == 1 and (files[0][2] > self.options['batch_bytes'] or self.chunked(files[0][2])):
+            file_path, file_name, _ = files[0]
+            return [self.upload_path(file_path, f'{doc_id}/{file_name}')]
+        docs = {} if docs is None else docs
+        with self.revs.lock(doc_id):
+            try:
+                attachments, parts, digests = {}, [], {}
+                for file_path, file_name, _ in files:
+                    with open(file_path, 'rb') as src_fp:
+                        data = src_fp.read()
+                    digests[file_name] = md5_digest(hashlib.md5(data))
+                    content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+                    if len(data) <= self.options['inline_bytes']:
+                        attachments[file_name] = {'content_type': content_type,
+                                                  'data': base64.b64encode(data).decode('ascii')}
+                    else:
+                        attachments[file_name] = {'content_type': content_type, 'length': len(data), 'follows': True}
+                        parts.append(data)
+                doc = self.merge_attachments(docs.get(doc_id) or self.get_doc(doc_id), doc_id, attachments)
+                response = self.put_multipart(doc_uri, doc, parts)
+                attempt = 0
+                while response.status_code == 409 and attempt < self.retry.conflicts:
+                    attempt += 1
+                    self.conflict_wait(attempt, 'PUT', doc_uri)
+                    doc = self.merge_attachments(self.get_doc(doc_id), doc_id, attachments)
+                    response = self.put_multipart(doc_uri, doc, parts)
+                response.raise_for_status()
+            except (CouchDBClientException, RequestException, OSError) as error:
+                docs.pop(doc_id, None)
+                return [TransferResult(file_name, f'{doc_uri}/{file_name}', 'ERROR', str(error))
+                        for _, file_name, _ in files]
+            doc['_rev'] = self.remember_rev(doc_id, response)
+            for file_name, _, _ in files:
+                doc['_attachments'][file_name] = {'stub': True}
+            if doc['_rev']:
+                docs[doc_id] = doc
+            else:
+                docs.pop(doc_id, None)
+        return [TransferResult(file_name, f'{doc_uri}/{file_name}', response.status_code, response.reason,
+                               size=size, digest=digests[file_name])
+                for _, file_name, size in files]
+
+    @staticmethod
+    def merge_attachments(doc, doc_id, attachments):
+        """
+        Adds attachments after the existing stubs of doc, replacing any with the same name,
+        so the `follows` entries keep the order of their multipart bodies.
+        """
+        doc = dict(doc or {'_id': doc_id})
+        doc['_attachments'] = {name: stub for name, stub in doc.get('_attachments', {}).items()
+                               if name not in attachments}
+        doc['_attachments'].update(attachments)
+        return doc
+
+    def get_doc(self, doc_id):
+        """
+        Fetches a doc with stubs for its attachments, remembering its rev.
+        :return: doc or None if it does not exist
+        """
+        response = self.transport.get(f'{self.db_uri}/{doc_id}')
+        if response.status_code == 404:
+            self.revs.discard(doc_id)
+            return None
+        response.raise_for_status()
+        doc = response.json()
+        self.revs.set_doc(doc)
+        return doc
 
-    def upload(self, src, dst, dry_run=False):
+    def put_multipart(self, doc_uri, doc, parts):
+        """
+        PUTs doc followed by the bodies of its `follows` attachments, in order.
+        """
+        if not parts:
+            return self.transport.put(doc_uri, json=doc)
+        boundary = uuid.uuid4().hex
+        body = [f'--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode('utf-8'),
+                json.dumps(doc).encode('utf-8')]
+        for data in parts:
+            body.extend([f'\r\n--{boundary}\r\n\r\n'.encode('utf-8'), data])
+        body.append(f'\r\n--{boundary}--'.encode('utf-8'))
+        headers = {'Content-Type': f'multipart/related; boundary="{boundary}"'}
+        body = b''.join(body)
+        self.throttle.consume(len(body))
+        return self.transport.put(doc_uri, data=body, headers=headers)
+
+    def upload_srcdst(self, src, dst):
         src = os.path.abspath(src)
         if os.path.isfile(src):
-            if dry_run:
-                yield src, dst, 'DRY RUN', ''
-            else:
-                with open(src, 'rb') as src_fp:
-                    yield self.upload_file(src_fp, os.path.join(dst, os.path.basename(src)))
+            yield src, os.path.join(dst, os.path.basename(src))
         elif os.path.isdir(src):
             p = pathlib.Path(src).resolve()
             for (dirpath, dirs, files) in os.walk(src):
                 for filename in files:
                     file_path = os.path.join(dirpath, filename)
                     pp = file_path[len(p.parent.as_posix()) + 1:]
-                    dest_path = os.path.join(dst, pp)
-                    if dry_run:
-                        yield file_path, dest_path, 'DRY RUN', ''
+                    yield file_path, os.path.join(dst, pp)
+
+    @counts_retries
+    def upload_path(self, file_path, dest_path):
+        try:
+            with open(file_path, 'rb') as src_fp:
+                return self.upload_file(src_fp, dest_path)
+        except (CouchDBClientException, RequestException, OSError) as error:
+            doc_id, file_name = split_doc_path(dest_path)
+            return TransferResult(file_name, f'{self.db_uri}/{doc_id}/{file_name}', 'ERROR', str(error))
+
+    def sync(self, src, dst, delete=False, dry_run=False, max_workers=1, priority=BULK):
+        """
+        Makes dst match src, only transferring files that are new or whose size or digest changed.
+        When src is a local path it is uploaded to dst, otherwise src is downloaded to the local dst.
+        Attachment digests come from the docs' stubs, fetched in bulk, local digests from a Manifest.
+        :param src: local path or doc id followed by an optional path or glob
+        :param dst: doc id followed by an optional path or local directory
+        :param delete: also delete what is in dst but no longer in src
+        :param dry_run: only yield what would be transferred or deleted
+        :param max_workers: number of files transferred at the same time
+        :param priority: of its requests when the throttle makes them wait, lower goes first
+        :return: yields TransferResult(src, dst, status, reason), status is UNCHANGED for skipped files
+        """
+        if os.path.exists(src):
+            yield from self.sync_up(src, dst, delete, dry_run, max_workers, priority)
+        else:
+            yield from self.sync_down(src, dst, delete, dry_run, max_workers, priority)
+
+    def sync_up(self, src, dst, delete=False, dry_run=False, max_workers=1, priority=BULK):
+        src = os.path.abspath(src)
+        jobs = list(self.upload_srcdst(src, dst))
+        remote_root = os.path.join(dst, os.path.basename(src))
+        docs = self.fetch_docs({split_doc_path(dest_path)[0] for _, dest_path in jobs} |
+                               {split_doc_path(remote_root)[0]})
+        root = src if os.path.isdir(src) else os.path.dirname(src)
+        with Manifest(root, self.options['manifest_dir']) as manifest:
+            changed = []
+            for file_path, dest_path in jobs:
+                if unchanged(attachment_stub(docs, dest_path), file_path, manifest):
+                    yield TransferResult(file_path, dest_path, 'UNCHANGED', '')
+                else:
+                    changed.append((file_path, dest_path))
+            removed = []
+            if delete and os.path.isdir(src):
+                doc_id, prefix = split_doc_path(remote_root)
+                uploaded = {split_doc_path(dest_path) for _, dest_path in jobs}
+                removed = [f'{doc_id}/{name}' for name in doc_files(docs.get(doc_id, {}))
+                           if name.startswith(f'{prefix}/') and (doc_id, name) not in uploaded]
+            if dry_run:
+                for file_path, dest_path in changed:
+                    yield TransferResult(file_path, dest_path, 'DRY RUN', 'upload')
+                for path in removed:
+                    yield TransferResult(path, '', 'DRY RUN', 'delete')
+                return
+            self.create_docs({split_doc_path(dest_path)[0] for _, dest_path in changed} - set(docs))
+
+            def upload(file_path, dest_path):
+                return file_path, self.upload_path(file_path, dest_path)
+
+            uploaded = {}
+            for file_path, result in map_unordered(prioritized(upload, priority), changed, max_workers):
+                if result.status in (201, 202) and result.digest:
+                    manifest.set(file_path, result.digest)
+                    uploaded[file_path] = result
+                yield result
+            # what couchdb stored compressed is known by the digest it gave it
+            docs = self.fetch_docs({split_doc_path(dest_path)[0] for file_path, dest_path in changed
+                                    if file_path in uploaded})
+            for file_path, dest_path in changed:
+                stub = attachment_stub(docs, dest_path) or {}
+                if file_path in uploaded and stub.get('encoding'):
+                    manifest.set(file_path, uploaded[file_path].digest, synced=stub['digest'])
+            for path in removed:
+                yield self.delete_attachment(path)
+
+    def sync_down(self, src, dst, delete=False, dry_run=False, max_workers=1, priority=BULK):
+        jobs = list(self.download_srcdst(src, dst))
+        docs = self.fetch_docs({split_doc_path(file_path)[0] for file_path, _ in jobs})
+        with Manifest(dst, self.options['manifest_dir']) as manifest:
+            changed, synced = [], {}
+            for file_path, dest_path in jobs:
+                stub = attachment_stub(docs, file_path) or {}
+                synced[dest_path] = stub.get('digest')
+                if os.path.isfile(dest_path) and unchanged(stub, dest_path, manifest):
+                    yield TransferResult(file_path, dest_path, 'UNCHANGED', '')
+                else:
+                    changed.append((file_path, dest_path, plain_digest(stub)))
+            removed = []
+            if delete and os.path.isdir(dst):
+                wanted = {os.path.abspath(dest_path) for _, dest_path in jobs}
+                for dirpath, _, files in os.walk(dst):
+                    removed.extend(os.path.join(dirpath, filename) for filename in files
+                                   if os.path.abspath(os.path.join(dirpath, filename)) not in wanted)
+            if dry_run:
+                for file_path, dest_path, _ in changed:
+                    yield TransferResult(file_path, dest_path, 'DRY RUN', 'download')
+                for path in removed:
+                    yield TransferResult('', path, 'DRY RUN', 'delete')
+                return
+            for dir_path in sorted({os.path.dirname(dest_path) for _, dest_path, _ in changed}):
+                if dir_path:
+                    os.makedirs(dir_path, exist_ok=True)
+            for result in map_unordered(prioritized(self.download_path, priority), changed, max_workers):
+                if result.status == 200:
+                    manifest.set(result.dst, result.digest, synced=synced.get(result.dst))
+                yield result
+            for path in removed:
+                os.remove(path)
+                manifest.discard(path)
+                yield TransferResult('', path, 'DELETED', '')
+
+    def fetch_docs(self, doc_ids):
+        """
+        Fetches docs, with stubs for their attachments, with one _all_docs request per view_page_size ids.
+        :return: {doc_id: doc} for the docs that exist
+        """
+        doc_ids, docs = sorted(doc_ids), {}
+        page_size = self.options['view_page_size']
+        for start in range(0, len(doc_ids), page_size):
+            response = self.transport.post(f'{self.db_uri}/_all_docs', params={'include_docs': 'true'},
+                                           json={'keys': doc_ids[start:start + page_size]})
+            response.raise_for_status()
+            for row in response.json()['rows']:
+                if row.get('doc'):
+                    docs[row['id']] = row['doc']
+                    self.revs.set(row['id'], row['doc']['_rev'])
+        return docs
+
+    def ensure_docs(self, doc_ids):
+        """
+        ensure_doc for many docs at once, their revs come from one _all_docs request per
+        view_page_size ids and the missing docs are created by one _bulk_docs request per
+        view_page_size docs, instead of a HEAD and a POST per doc.
+        :return: {doc_id: rev} for the docs that exist now
+        """
+        doc_ids, revs, missing = sorted(doc_ids), {}, []
+        page_size = self.options['view_page_size']
+        for start in range(0, len(doc_ids), page_size):
+            response = self.transport.post(f'{self.db_uri}/_all_docs', json={'keys': doc_ids[start:start + page_size]})
+            response.raise_for_status()
+            for row in response.json()['rows']:
+                value = row.get('value') or {}
+                if 'error' in row or value.get('deleted'):
+                    missing.append(row['key'])
+                else:
+                    revs[row['id']] = self.revs.set(row['id'], value['rev'])
+        revs.update(self.create_docs(missing))
+        return revs
+
+    def create_docs(self, doc_ids):
+        """
+        Creates empty docs with one _bulk_docs request per view_page_size ids. A doc that
+        could not be created, e.g. because it was in the meantime, is left to ensure_doc.
+        :return: {doc_id: rev} of the docs created
+        """
+        doc_ids, revs = sorted(doc_ids), {}
+        page_size = self.options['view_page_size']
+        for start in range(0, len(doc_ids), page_size):
+            docs = [{'_id': doc_id} for doc_id in doc_ids[start:start + page_size]]
+            response = self.transport.post(f'{self.db_uri}/_bulk_docs', json={'docs': docs})
+            response.raise_for_status()
+            for result in response.json():
+                if result.get('rev'):
+                    revs[result['id']] = self.revs.set(result['id'], result['rev'])
+        return revs
+
+    def delete_attachment(self, path):
+        """
+        Deletes the attachment at path, a doc id followed by the attachment name.
+        :return: TransferResult(path, file_url, status, reason)
+        """
+        doc_id, file_name = split_doc_path(path)
+        file_uri = f'{self.db_uri}/{doc_id}/{file_name}'
+        with self.revs.lock(doc_id):
+            response = self.transport.delete(file_uri, headers={'If-Match': self.doc_rev(doc_id)})
+            attempt = 0
+            while response.status_code == 409 and attempt < self.retry.conflicts:
+                attempt += 1
+                self.conflict_wait(attempt, 'DELETE', file_uri)
+                response = self.transport.delete(file_uri, headers={'If-Match': self.doc_rev(doc_id, refresh=True)})
+            if response.status_code == 404 and self.chunk_manifest(path):
+                # the chunks are left, other files may share them
+                response = self.update_doc(doc_id, lambda doc: doc['couchfs_files'].pop(file_name, None))
+            response.raise_for_status()
+            self.remember_rev(doc_id, response)
+        return TransferResult(path, file_uri, response.status_code, response.reason)
+
+    def remove(self, pattern, dry_run=False, glob=True):
+        """
+        Deletes the attachments and chunked files matching pattern, as ls matches it, with one
+        _bulk_docs request per view_page_size docs rather than a DELETE per attachment. A bare
+        doc id deletes the whole doc, and so does a glob matching a doc without files. The
+        chunks of chunked files are left, other files may share them, collect_chunks deletes
+        the ones nothing refers to any more.
+        :param pattern: doc id followed by an optional path or glob
+        :param dry_run: only yield what would be deleted
+        :param glob: treat wildcards in pattern as a glob, False for a literal path
+        :return: yields TransferResult(path, file_url, status, reason), status 200 for each path deleted
+        :raises CouchDBClientException: for an empty pattern, that would remove every doc
+        """
+        pattern = pattern.strip('/')
+        if not pattern:
+            raise CouchDBClientException('refusing to remove every doc, name a doc, a path or a glob such as *')
+        paths = list(self.matching_paths(pattern, glob))
+        if dry_run:
+            for path in paths:
+                yield TransferResult(path, f'{self.db_uri}/{path}', 'DRY RUN', '')
+            return
+        removed = {}
+        for path in paths:
+            doc_id, file_name = split_doc_path(path)
+            removed.setdefault(doc_id, set()).add(file_name)
+        changes = {doc_id: [delete_doc if doc_id == pattern or '' in names else drop_files(names)]
+                   for doc_id, names in removed.items()}
+        statuses = self.bulk_update(changes)
+        for path in paths:
+            status, reason = statuses[split_doc_path(path)[0]]
+            yield TransferResult(path, f'{self.db_uri}/{path}', 200 if status == 201 else status,
+                                 'Deleted' if status == 201 else reason)
+
+    def collect_chunks(self, dry_run=False):
+        """
+        Deletes the chunk docs that no couchfs_files entry refers to any more, remove, move and
+        delete_attachment leave them since other files may share them. Every doc is read, one
+        _all_docs page of view_page_size docs at a time, and the chunks deleted with bulk_update.
+        Run it while nothing uploads, the chunks of a file whose entry is not saved yet are not
+        referred to either.
+        :param dry_run: only yield what would be deleted
+        :return: yields TransferResult(chunk_id, chunk_url, status, reason), status 200 for each chunk deleted
+        """
+        referenced, chunk_ids = set(), []
+        page_size = self.options['view_page_size']
+        params = {'include_docs': 'true', 'limit': page_size + 1}
+        while True:
+            response = self.transport.get(f'{self.db_uri}/_all_docs', params=params)
+            response.raise_for_status()
+            rows = response.json()['rows']
+            for row in rows[:page_size]:
+                if row['id'].startswith(CHUNK_DOC_PREFIX):
+                    chunk_ids.append(row['id'])
+                for entry in (row.get('doc') or {}).get('couchfs_files', {}).values():
+                    referenced.update(entry.get('chunks', []))
+            if len(rows) <= page_size:
+                break
+            params['startkey'] = json.dumps(rows[page_size]['id'])
+        unreferenced = [chunk_id for chunk_id in chunk_ids if chunk_id not in referenced]
+        if dry_run:
+            for chunk_id in unreferenced:
+                yield TransferResult(chunk_id, f'{self.db_uri}/{chunk_id}', 'DRY RUN', '')
+            return
+        statuses = self.bulk_update({chunk_id: [delete_doc] for chunk_id in unreferenced})
+        for chunk_id in unreferenced:
+            status, reason = statuses[chunk_id]
+            yield TransferResult(chunk_id, f'{self.db_uri}/{chunk_id}', 200 if status == 201 else status,
+                                 'Deleted' if status == 201 else reason)
+
+    def move(self, src, dst, dry_run=False, max_workers=1, glob=True, priority=BULK):
+        """
+        Moves the attachments and chunked files matching src to dst, mapped by move_srcdst, without
+        sending through the client what couchdb can move itself. A whole doc goes to a doc id that is
+        free with a COPY and a DELETE, and chunked files by moving their couchfs_files entries, with
+        one _bulk_docs request per view_page_size docs. couchdb can't rename an attachment, so plain
+        attachments are copied through a temporary file, max_workers at a time, and then dropped
+        from their docs in bulk. A source is only dropped once its copy is stored.
+        :param src: doc id followed by an optional path or glob
+        :param dst: doc id followed by an optional path, a trailing / moves a file into it
+        :param dry_run: only yield what would be moved
+        :param glob: treat wildcards in src as a glob, False for a literal path
+        :param priority: of the copies when the throttle makes them wait, lower goes first
+        :return: yields TransferResult(path, dest_path, status, reason), status 201 for each path moved
+        :raises CouchDBClientException: for an empty src
+        """
+        if not src.strip('/'):
+            raise CouchDBClientException('refusing to move every doc, name a doc, a path or a glob such as *')
+        moves = [(path, dest_path) for path, dest_path in self.move_srcdst(src, dst, glob)
+                 if split_doc_path(path)[1] and path != dest_path]
+        if dry_run:
+            for path, dest_path in moves:
+                yield TransferResult(path, dest_path, 'DRY RUN', '')
+            return
+        src, dst = src.strip('/'), dst.strip('/')
+        whole_doc = not split_doc_path(src)[1] and not (glob and self.WILDCARD_RE.search(src))
+        if whole_doc and not split_doc_path(dst)[1] and src != dst:
+            response = self.move_doc(src, dst)
+            if response is not None:
+                for path, dest_path in moves:
+                    yield TransferResult(path, dest_path, *((201, 'Moved with its doc') if response.ok else
+                                                            (response.status_code, response.reason)))
+                return
+        docs = self.fetch_docs({split_doc_path(path)[0] for path, _ in moves})
+        relinked, copied = [], []
+        for path, dest_path in moves:
+            doc_id, file_name = split_doc_path(path)
+            (relinked if file_name in docs.get(doc_id, {}).get('couchfs_files', {}) else copied).append(
+                (path, dest_path))
+        results = {result.src: result
+                   for result in map_unordered(prioritized(self.copy_attachment, priority), copied, max_workers)}
+        added = {}
+        for path, dest_path in relinked:
+            doc_id, file_name = split_doc_path(path)
+            dest_id, dest_name = split_doc_path(dest_path)
+            added.setdefault(dest_id, []).append(add_file(dest_name, docs[doc_id]['couchfs_files'][file_name]))
+        statuses = self.bulk_update(added, create=True)
+        for path, dest_path in relinked:
+            results[path] = TransferResult(path, dest_path, *statuses[split_doc_path(dest_path)[0]])
+        # drop the sources that are stored at their destination, but not a file that another one moved onto
+        dropped, targets = {}, {dest_path for _, dest_path in moves}
+        for path, result in results.items():
+            if result.status in (200, 201, 202) and path not in targets:
+                doc_id, file_name = split_doc_path(path)
+                dropped.setdefault(doc_id, set()).add(file_name)
+        # a whole doc moved file by file, onto a doc that was taken, goes once all its files did
+        if whole_doc and all(result.status in (200, 201, 202) for result in results.values()):
+            dropped[src] = ''
+        statuses = self.bulk_update({doc_id: [drop_files(names) if names else delete_doc]
+                                     for doc_id, names in dropped.items()})
+        for path, dest_path in moves:
+            result = results[path]
+            status, reason = statuses.get(split_doc_path(path)[0], (201, ''))
+            if result.status in (200, 201, 202) and status != 201:
+                result = TransferResult(path, dest_path, status, f'copied but not removed, {reason}')
+            yield TransferResult(path, dest_path, result.status, result.reason, result.size, result.seconds,
+                                 result.digest, retries=result.retries)
+
+    def move_srcdst(self, src, dst, glob=True):
+        """
+        Matches src like remove and maps every match to a path under dst. A single file is renamed to
+        dst unless dst is a bare doc id or ends with a /.
+        'TAKIS/takis/*.py', 'OTHER/py' -> 'TAKIS/takis/asgi.py', 'OTHER/py/asgi.py'
+        'TAKIS/takis', 'OTHER' -> 'TAKIS/takis/media/t126.jpg', 'OTHER/media/t126.jpg'
+        'TAKIS/takis/asgi.py', 'TAKIS/app.py' -> 'TAKIS/takis/asgi.py', 'TAKIS/app.py'
+        """
+        src, into = src.strip('/'), dst.endswith('/') or not split_doc_path(dst.strip('/'))[1]
+        dst = dst.strip('/')
+        root = self.path_root(src, glob)
+        for file_path in self.matching_paths(src, glob):
+            if file_path == root:
+                yield file_path, f'{dst}/{file_path.rpartition("/")[2]}' if into else dst
+            else:
+                yield file_path, f'{dst}/{file_path[len(root):].lstrip("/")}'
+
+    def move_doc(self, doc_id, new_id):
+        """
+        Moves a whole doc, attachments and all, inside couchdb with a COPY to new_id and a DELETE of doc_id.
+        :return: the response of the DELETE, None when new_id is taken or the COPY failed
+        """
+        response = self.transport.copy(f'{self.db_uri}/{doc_id}', headers={'Destination': new_id})
+        if response.status_code not in (201, 202):
+            return None
+        self.remember_rev(new_id, response)
+        doc_uri = f'{self.db_uri}/{doc_id}'
+        with self.revs.lock(doc_id):
+            response = self.transport.delete(doc_uri, headers={'If-Match': self.doc_rev(doc_id)})
+            attempt = 0
+            while response.status_code == 409 and attempt < self.retry.conflicts:
+                attempt += 1
+                self.conflict_wait(attempt, 'DELETE', doc_uri)
+                response = self.transport.delete(doc_uri, headers={'If-Match': self.doc_rev(doc_id, refresh=True)})
+            self.revs.discard(doc_id)
+        return response
+
+    @counts_retries
+    def copy_attachment(self, file_path, dest_path):
+        """
+        Copies an attachment, or a chunked file as a plain one, to dest_path through a temporary file.
+        :return: TransferResult(file_path, dest_path, status, reason) of the upload
+        """
+        try:
+            with tempfile.TemporaryFile() as fp:
+                self.download_to_file(f'{self.db_uri}/{file_path}', fp)
+                fp.seek(0)
+                result = self.upload_file(fp, dest_path)
+        except (RequestException, OSError) as error:
+            return TransferResult(file_path, dest_path, 'ERROR', str(error))
+        return TransferResult(file_path, dest_path, result.status, result.reason, result.size, result.seconds,
+                              result.digest)
+
+    def bulk_update(self, changes, create=False):
+        """
+        update_doc for many docs at once. The docs are fetched by fetch_docs, changed and saved with
+        one _bulk_docs request per view_page_size docs, and the ones that conflicted fetched, changed
+        and saved again.
+        :param changes: {doc_id: [change(doc)]}
+        :param create: change a new doc when doc_id does not exist, or else leave it out
+        :return: {doc_id: (status, reason)}, 201 for each doc saved
+        """
+        statuses, pending = {}, sorted(changes)
+        page_size = self.options['view_page_size']
+        for attempt in range(self.retry.conflicts + 1):
+            if not pending:
+                break
+            if attempt:
+                self.conflict_wait(attempt, 'POST', f'{self.db_uri}/_bulk_docs')
+            docs, batch, conflicted = self.fetch_docs(pending), [], []
+            for doc_id in pending:
+                doc = docs.get(doc_id) or ({'_id': doc_id} if create else None)
+                if doc is None:
+                    statuses[doc_id] = (404, 'Not Found')
+                    continue
+                for change in changes[doc_id]:
+                    change(doc)
+                batch.append(doc)
+            for start in range(0, len(batch), page_size):
+                response = self.transport.post(f'{self.db_uri}/_bulk_docs',
+                                               json={'docs': batch[start:start + page_size]})
+                response.raise_for_status()
+                for result in response.json():
+                    if result.get('rev'):
+                        statuses[result['id']] = (201, 'Created')
+                        self.revs.set(result['id'], result['rev'])
                     else:
-                        yield self.upload_file(file_path, dest_path)
+                        statuses[result['id']] = (409 if result.get('error') == 'conflict' else result.get('error'),
+                                                  result.get('reason'))
+                        if result.get('error') == 'conflict':
+                            conflicted.append(result['id'])
+            pending = conflicted
+        return statuses
 
     def upload_bytes_file(self, src_bytes, dst):
         with tempfile.NamedTemporaryFile() as src_fp:
             src_fp.name = os.path.basename(dst)
             src_fp.write(src_bytes)
+            src_fp.seek(0)
             return self.upload_file(src_fp, dst)
 
+    @counts_retries
     def upload_file(self, src, dst):
         """
         Uploads a file using dst as the doc/bucket id
@@ -212,29 +1629,175 @@ class CouchDBClient:
         :param dst: id
         :return: file_name, file_url, upload status, upload message
         """
-        doc_id = [segment for segment in dst.split('/') if segment][0]
-        file_name = '/'.join(dst.split('/')[1:])
+        doc_id, file_name = split_doc_path(dst)
         doc_uri = f'{self.db_uri}/{doc_id}'
         file_uri = f'{doc_uri}/{file_name}'
-        response = requests.head(f'{doc_uri}', auth=self.auth)
+        major, _ = mimetypes.guess_type(file_name)
+        start = src.tell() if src.seekable() else None
+        if (self.options['chunk_threshold'] or self.options['dedup']) and start is not None:
+            size = src.seek(0, io.SEEK_END) - start
+            src.seek(start)
+            if self.options['chunk_threshold'] and size > self.options['chunk_threshold']:
+                return self.upload_chunked(src, dst, size, major or 'application/octet-stream')
+            if self.chunked(size):
+                copy = self.stored_copy(src, start)
+                if copy is not None:
+                    return self.upload_chunked(src, dst, size, major or 'application/octet-stream', copy)
+        started = time.monotonic()
+        with self.revs.lock(doc_id):
+            try:
+                rev = self.ensure_doc(doc_id)
+            except HTTPError as error:
+                return TransferResult(file_name, f'{file_uri}', error.response.status_code, error.response.reason)
+            headers = {'Content-type': major or 'application/octet-stream', 'If-Match': rev}
+            body = HashingReader(src, throttle=self.throttle)
+            response = self.transport.put(f'{file_uri}', data=body, headers=headers)
+            attempt = 0
+            while response.status_code == 409 and start is not None and attempt < self.retry.conflicts:
+                attempt += 1
+                self.conflict_wait(attempt, 'PUT', file_uri)
+                src.seek(start)
+                headers['If-Match'] = self.ensure_doc(doc_id, refresh=True)
+                body = HashingReader(src, throttle=self.throttle)
+                response = self.transport.put(f'{file_uri}', data=body, headers=headers)
+            response.raise_for_status()
+            self.remember_rev(doc_id, response)
+        result = TransferResult(file_name, f'{file_uri}', response.status_code, response.reason,
+                                size=body.size, seconds=time.monotonic() - started, digest=body.digest)
+        if self.options['verify']:
+            result = self.verify_upload(result)
+        return result
+
+    def chunked(self, size):
+        """
+        Whether a file of size bytes may be uploaded as chunks, see upload_chunked. Above
+        chunk_threshold it always is, with dedup from dedup_min_bytes when a copy is stored.
+        """
+        return bool(self.options['chunk_threshold'] and size > self.options['chunk_threshold']
+                    or self.options['dedup'] and size >= self.options['dedup_min_bytes'])
+
+    def stored_copy(self, src, start):
+        """
+        Looks a file with the content of src up by its digest in the attachment_digests view,
+        reading src from start and back.
+        :return: {'digest'} for a copy stored as an attachment, with the copy's 'chunk_size' and
+            'chunks' when it is a chunked file, or None when there is no copy
+        """
+        md5 = hashlib.md5()
+        for data in iter(lambda: src.read(self.CHUNK_SIZE), b''):
+            md5.update(data)
+        src.seek(start)
+        digest = md5_digest(md5)
+        response = self.transport.get(f'{self.db_uri}/_design/couchfs_views/_view/attachment_digests',
+                                      params={'key': json.dumps(digest)})
         if response.status_code == 404:
-            response = requests.post(f'{self.db_uri}', json=dict(_id=doc_id), auth=self.auth)
-            if response.status_code != 201:
-                return file_name, f'{file_uri}', response.status_code, response.reason
-            rev = response.json()['rev']
-        else:
-            rev = response.headers['ETag']
-        major, _ = mimetypes.guess_type(src.name)
-        headers = {'Content-type': f'{major}', 'If-Match': rev[1:-1]}
-        response = requests.put(f'{file_uri}', data=src, headers=headers, auth=self.auth)
+            # a design doc from before the view, run couchfs init
+            return None
         response.raise_for_status()
-        return file_name, f'{file_uri}', response.status_code, response.reason
+        copies = [row['value'] or {} for row in response.json()['rows']]
+        if not copies:
+            return None
+        return dict(max(copies, key=lambda copy: bool(copy.get('chunks'))), digest=digest)
+
+    def upload_chunked(self, src, dst, size, content_type, copy=None):
+        """
+        Uploads a large file as chunk_size chunks, each in a doc of its own named after its md5
+        so chunks upload in parallel without revision conflicts and a chunk already stored is not
+        sent again, which also resumes a failed upload. The file is then described in the
+        couchfs_files manifest of the dst doc, replacing any attachment of the same name.
+        :param copy: stored_copy of the file, its chunks are reused when it is a chunked file
+        :return: TransferResult(file_name, file_url, status, reason) with the size, time taken and digest
+        """
+        doc_id, file_name = split_doc_path(dst)
+        file_uri = f'{self.db_uri}/{doc_id}/{file_name}'
+        chunk_size = self.options['chunk_size']
+        started = time.monotonic()
+        md5 = hashlib.md5()
+
+        def chunks():
+            for index in range((size + chunk_size - 1) // chunk_size):
+                data = src.read(chunk_size)
+                md5.update(data)
+                yield index, data
+
+        if copy and copy.get('chunks'):
+            chunk_ids, chunk_size, digest = copy['chunks'], copy['chunk_size'], copy['digest']
+            reused = len(chunk_ids)
+        else:
+            try:
+                stored = dict(map_unordered(self.put_chunk, chunks(), self.options['chunk_workers']))
+            except RequestException as error:
+                return TransferResult(file_name, file_uri, 'ERROR', str(error))
+            chunk_ids = [stored[index][0] for index in range(len(stored))]
+            reused = sum(1 for _, sent in stored.values() if not sent)
+            digest = md5_digest(md5)
+        entry = {'length': size, 'digest': digest, 'content_type': content_type,
+                 'chunk_size': chunk_size, 'chunks': chunk_ids}
+
+        response = self.update_doc(doc_id, add_file(file_name, entry))
+        reason = f'{response.reason}, {reused} of {len(chunk_ids)} chunks already stored' if reused else response.reason
+        return TransferResult(file_name, file_uri, response.status_code, reason,
+                              size=size, seconds=time.monotonic() - started, digest=entry['digest'])
+
+    def put_chunk(self, index, data):
+        """
+        Stores a chunk unless a chunk with the same content already is.
+        :return: index, (chunk doc id, whether it was sent)
+        """
+        chunk_id = CHUNK_DOC_PREFIX + hashlib.md5(data).hexdigest()
+        url = self.chunk_url(chunk_id)
+        if self.transport.head(url).status_code == 200:
+            return index, (chunk_id, False)
+        self.throttle.consume(len(data))
+        response = self.transport.put(url, data=data, headers={'Content-Type': 'application/octet-stream'})
+        # 409, the same chunk was stored in the meantime
+        if response.status_code != 409:
+            response.raise_for_status()
+        return index, (chunk_id, response.status_code != 409)
+
+    def update_doc(self, doc_id, change):
+        """
+        Applies change(doc) to the latest revision of doc_id, or to a new doc, and saves it,
+        fetching it again on a conflict. The doc this client last fetched or saved is used
+        while its rev is the latest known, so many changes to one doc cost a PUT each, not a GET too.
+        :return: the response of the PUT
+        """
+        doc_uri = f'{self.db_uri}/{doc_id}'
+        with self.revs.lock(doc_id):
+            for attempt in range(self.retry.conflicts + 1):
+                if attempt:
+                    self.conflict_wait(attempt, 'PUT', doc_uri)
+                doc = (not attempt and self.revs.latest_doc(doc_id)) or self.get_doc(doc_id) or {'_id': doc_id}
+                change(doc)
+                response = self.transport.put(doc_uri, json=doc)
+                if response.status_code != 409:
+                    break
+            response.raise_for_status()
+            doc['_rev'] = self.remember_rev(doc_id, response)
+            if doc['_rev']:
+                self.revs.set_doc(doc)
+        return response
+
+    def verify_upload(self, result):
+        """
+        Compares the digest computed while uploading with the one couchdb stored.
+        :param result: TransferResult of upload_file
+        :return: TransferResult, with status BAD DIGEST on a mismatch
+        """
+        response = self.transport.head(result.dst)
+        expected = server_digest(response.headers) if response.status_code == 200 else None
+        if expected is None:
+            return result
+        if expected != result.digest:
+            return TransferResult(result.src, result.dst, 'BAD DIGEST', f'sent {result.digest} stored {expected}',
+                                  result.size, result.seconds, result.digest, verified=False)
+        return TransferResult(*result, size=result.size, seconds=result.seconds, digest=result.digest, verified=True)
 
 
     @classmethod
-    def init_db(cls, logger=echo):
+    def init_db(cls, logger=echo, client=None):
         echo('connecting to couchdb')
-        client = cls()
+        client = client or cls()
         logger('checking the db')
         if not client.check_db():
             logger('creating the db')
@@ -248,8 +1811,11 @@ class CouchDBClient:
       "_id": "_design/couchfs_views",
       "views": {
         "attachment_list": {
-          "map": "function (doc) {\n if (doc._attachments) {\n   for (const file_name in doc._attachments) {\n      emit((doc._id+'/'+file_name).split('/'), doc._attachments[file_name].length);\n  }\n} else {\n  emit(doc._id.split('/'), 0)\n}\n}",
+          "map": "function (doc) {\n if (doc._id.indexOf('couchfs-chunk-') === 0) {\n  return;\n }\n var empty = true;\n for (const file_name in doc._attachments) {\n   empty = false;\n   emit((doc._id+'/'+file_name).split('/'), doc._attachments[file_name].length);\n }\n for (const file_name in doc.couchfs_files) {\n   empty = false;\n   emit((doc._id+'/'+file_name).split('/'), doc.couchfs_files[file_name].length);\n }\n if (empty) {\n  emit(doc._id.split('/'), 0)\n }\n}",
           "reduce": "_stats"
+        },
+        "attachment_digests": {
+          "map": "function (doc) {\n if (doc._id.indexOf('couchfs-chunk-') === 0) {\n  return;\n }\n for (const file_name in doc._attachments) {\n   const stub = doc._attachments[file_name];\n   if (!stub.encoding) {\n     emit(stub.digest, null);\n   }\n }\n for (const file_name in doc.couchfs_files) {\n   const entry = doc.couchfs_files[file_name];\n   emit(entry.digest, {chunk_size: entry.chunk_size, chunks: entry.chunks});\n }\n}"
         }
       },
       "language": "javascript"
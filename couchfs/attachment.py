@@ -0,0 +1,131 @@
+"""
+A read only, seekable file object over a couchdb attachment
+
+"""
+import io
+
+from couchfs.transport import release
+
+
+class AttachmentFile(io.RawIOBase):
+    """
+    Reads an attachment over HTTP without downloading it first. Nothing is requested
+    until the first read, sequential reads stream one response and a seek elsewhere
+    starts a new one with a Range request from there, so a zipfile or an image header
+    costs only the bytes read, chunked files only the chunks read. Wrap it in
+    io.BufferedReader, as CouchDBClient.open_attachment does, for small reads and readline.
+    """
+
+    def __init__(self, client, url, size=None):
+        """
+        :param client: CouchDBClient
+        :param url: attachment url
+        :param size: the attachment length if known, saves a request on seeks from the end
+        """
+        super(AttachmentFile, self).__init__()
+        self.client = client
+        self.url = url
+        self.name = url
+        self.size = size
+        self.position = 0
+        self.response = None
+        # the couchfs_files entry when the attachment is a chunked file
+        self.manifest = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def length(self):
+        if self.size is None:
+            response = self.client.transport.head(self.url, headers={'Accept-Encoding': 'identity'})
+            if response.status_code == 404 and self.manifest is None:
+                self.manifest = self.client.chunk_manifest(self.url[len(self.client.db_uri) + 1:])
+                if self.manifest is not None:
+                    self.size = self.manifest['length']
+                    return self.size
+            response.raise_for_status()
+            self.size = int(response.headers['Content-Length'])
+        return self.size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length()
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'invalid whence {whence}')
+        if offset < 0:
+            raise OSError(22, 'negative seek position')
+        if offset != self.position:
+            self.drop_response()
+            self.position = offset
+        return self.position
+
+    def open_response(self):
+        """
+        Starts streaming from position, with a Range request unless that is the start.
+        """
+        headers = {'Accept-Encoding': 'identity'}
+        if self.position:
+            headers['Range'] = f'bytes={self.position}-'
+        response = self.client.transport.get(self.url, headers=headers, stream=True)
+        if response.status_code == 404:
+            release(response)
+            self.manifest = self.client.chunk_manifest(self.url[len(self.client.db_uri) + 1:])
+            if self.manifest is not None:
+                self.size = self.manifest['length']
+                return None
+        if response.status_code == 416:
+            response.close()
+            self.size = self.position if self.size is None else self.size
+            return None
+        response.raise_for_status()
+        if response.status_code == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                self.size = int(total)
+        else:
+            if 'Content-Length' in response.headers:
+                self.size = int(response.headers['Content-Length'])
+            # the server ignored the Range, skip up to position
+            skip = self.position
+            while skip:
+                skipped = len(response.raw.read(min(skip, 1024 * 1024)))
+                if not skipped:
+                    break
+                skip -= skipped
+        self.response = response
+        return response
+
+    def drop_response(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if self.size is not None and self.position >= self.size:
+            return 0
+        response = self.response or (self.manifest is None and self.open_response())
+        if self.manifest is not None:
+            data = self.client.read_chunks(self.manifest, self.position, len(buffer))
+            buffer[:len(data)] = data
+            self.position += len(data)
+            return len(data)
+        if not response:
+            return 0
+        count = response.raw.readinto(buffer)
+        self.client.throttle.consume(count)
+        self.position += count
+        return count
+
+    def close(self):
+        self.drop_response()
+        super(AttachmentFile, self).close()
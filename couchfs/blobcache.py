@@ -0,0 +1,149 @@
+"""
+A local cache of attachment bodies keyed by their couchdb digest
+
+"""
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+
+from couchfs.manifest import md5_digest
+
+
+class DigestMismatch(ValueError):
+    """The bytes fetched for a blob do not have the digest they were fetched for."""
+
+
+class HashingWriter:
+    """
+    Wraps a file object so the md5 of everything written through it is computed on the way.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.fp.write(data)
+
+
+class BlobCache:
+    """
+    Attachment bodies stored once per digest under cache_dir, so the same content under
+    any number of paths, docs or processes is fetched once. Blobs are written to a
+    temporary file, checked against their digest and renamed into place, so a blob in
+    the cache is always complete. Every hit touches the blob's mtime and the least
+    recently used blobs are evicted once the cache grows past max_bytes.
+    Only couchdb's md5 digests are used as keys, anything else is not cached.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # digest -> Event set once the thread fetching it is done
+        self.fetching = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.blobs())
+
+    @staticmethod
+    def cacheable(digest):
+        return bool(digest) and digest.startswith('md5-')
+
+    def path(self, digest):
+        name = base64.b64decode(digest[4:]).hex()
+        return os.path.join(self.cache_dir, name[:2], name)
+
+    def blobs(self):
+        """
+        :return: yields path, size, mtime of every blob
+        """
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.part'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime_ns
+
+    def get(self, digest):
+        """
+        :return: the path of the cached blob, or None
+        """
+        if not self.cacheable(digest):
+            return None
+        path = self.path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fetch(self, digest, fill):
+        """
+        The path of the blob, calling fill(file_obj) to write it first if it is not cached.
+        Concurrent fetches of the same digest wait for the first one instead of fetching again.
+        :raises DigestMismatch: when what fill wrote does not match digest
+        """
+        while True:
+            path = self.get(digest)
+            if path is not None:
+                return path
+            with self.lock:
+                event = self.fetching.get(digest)
+                if event is None:
+                    # a fetch may have finished since the get above
+                    path = self.get(digest)
+                    if path is not None:
+                        return path
+                    event = self.fetching[digest] = threading.Event()
+                    break
+            event.wait()
+        try:
+            return self.put(digest, fill)
+        finally:
+            with self.lock:
+                del self.fetching[digest]
+            event.set()
+
+    def put(self, digest, fill):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                writer = HashingWriter(fp)
+                fill(writer)
+            actual = md5_digest(writer.md5)
+            if actual != digest:
+                raise DigestMismatch(f'expected {digest} got {actual}')
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self.lock:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used blobs until the cache fits in max_bytes.
+        """
+        with self.lock:
+            for path, size, _ in sorted(self.blobs(), key=lambda blob: blob[2]):
+                if self.size <= self.max_bytes:
+                    return
+                if path == keep:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                self.size -= size
@@ -1,27 +1,89 @@
 """Console script for couchfs."""
 import sys
+import time
 
 import click
 import humanize
 
 from couchfs import api
+from couchfs.agent import Agent, socket_path, stop
+from couchfs.stats import RequestStats
 
 
 @click.group()
-def couchfs():
-    pass
+@click.option(
+    "--stats", is_flag=True, help="print request counts and latencies per endpoint to stderr when done"
+)
+@click.option(
+    "--stats_json", type=click.Path(dir_okay=False), help="write the request stats as JSON to this file"
+)
+@click.option(
+    "--trace", type=click.Path(dir_okay=False), help="write a trace event per request to this file"
+)
+@click.pass_context
+def couchfs(ctx, stats, stats_json, trace):
+    if not (stats or stats_json or trace):
+        return
+    # the client is made here so every command uses the one the collector hooks into
+    client = ctx.obj = couchdb_client()
+    collector = client.add_hook(RequestStats(trace=bool(trace)))
+
+    def report():
+        client.remove_hook(collector)
+        if stats:
+            click.echo(collector.format(), err=True)
+        if stats_json:
+            collector.dump_json(stats_json)
+        if trace:
+            collector.dump_trace(trace)
+
+    ctx.call_on_close(report)
+
+
+def couchdb_client():
+    """
+    The agent's CouchDBClient when the command runs in one, else a new client.
+    """
+    ctx = click.get_current_context(silent=True)
+    return (ctx and ctx.find_object(api.CouchDBClient)) or api.CouchDBClient()
+
+def retries(result):
+    count = getattr(result, 'retries', 0)
+    return f' ({count} retries)' if count else ''
+
 
 @click.command()
 def init():
-    api.CouchDBClient.init_db(logger=click.echo)
+    api.CouchDBClient.init_db(logger=click.echo, client=couchdb_client())
 
 
 @click.command()
+@click.option(
+    "--stream", is_flag=True, help="print rows as they arrive instead of lining up the whole listing"
+)
+@click.option(
+    "--width", default=50, show_default=True, help="starting path column width for --stream"
+)
+@click.option(
+    "--depth", "-d", type=int, help="only show totals this many levels below each path"
+)
 @click.argument('patterns', nargs=-1)
-def ls(patterns):
+def ls(patterns, stream, width, depth):
+    if depth is not None:
+        client = couchdb_client()
+        for pattern in patterns or ['']:
+            for dir_path, count, total, _, _ in client.disk_usage(pattern, depth):
+                click.echo(f'{dir_path + "/":{width}} {humanize.naturalsize(total):>10} {count:>8} files')
+        return
+    if stream:
+        for file_path, size in couchdb_client().list_attachments(*patterns):
+            # the column only ever grows, so a long path shifts the rows after it, not the ones already printed
+            width = max(width, len(file_path) + 3)
+            click.echo(f'{file_path:{width}} {humanize.naturalsize(size):>10}')
+        return
     rows = []
     max_len = 0
-    for file_path, size in api.CouchDBClient().list_attachments(*patterns):
+    for file_path, size in couchdb_client().list_attachments(*patterns):
         max_len = max(max_len, len(file_path))
         rows.append((file_path, size))
     ftr = '{file_path:%d} {size:>10}' % (max_len+3)
@@ -29,6 +91,21 @@ def ls(patterns):
         click.echo(ftr.format(file_path=file_path, size=humanize.naturalsize(size)))
 
 
+@couchfs.command(short_help="show disk usage.")
+@click.option(
+    "--depth", "-d", default=0, show_default=True, help="break the totals down this many levels below each path"
+)
+@click.argument('paths', nargs=-1)
+def du(paths, depth):
+    """shows the count, total, smallest and largest size of the attachments under each path.
+    """
+    client = couchdb_client()
+    for path in paths or ['']:
+        for dir_path, count, total, smallest, largest in client.disk_usage(path, depth):
+            click.echo(f'{humanize.naturalsize(total):>10} {count:>8} {humanize.naturalsize(smallest):>10} '
+                       f'{humanize.naturalsize(largest):>10}  {dir_path or "/"}')
+
+
 @couchfs.command(short_help="upload files.")
 @click.option(
     "--doc_per_path", is_flag=False, help="forcibly copy over an existing managed file"
@@ -36,33 +113,174 @@ def ls(patterns):
 @click.option(
     "--dry_run", is_flag=True, help="forcibly copy over an existing managed file"
 )
+@click.option(
+    "--jobs", "-j", default=1, show_default=True,
+    help="number of uploads at the same time, a tree goes into one doc so with more than one it is batched"
+)
+@click.option(
+    "--batch", is_flag=True, help="write small files for the same document in one request"
+)
 @click.argument("src", type=click.Path())
 @click.argument("dst", type=click.Path())
-def upload(src, dst, doc_per_path, dry_run):
+def upload(src, dst, doc_per_path, dry_run, jobs, batch):
     """uploads from src to dst.
     """
-    for src, dst, status,reason in api.CouchDBClient().upload(src, dst, dry_run):
-        click.echo(f'{src} {dst} {status}:{reason}')
+    for result in couchdb_client().upload(src, dst, dry_run, max_workers=jobs, batch=batch):
+        src, dst, status, reason = result
+        click.echo(f'{src} {dst} {status}:{reason}{retries(result)}')
 couchfs.add_command(ls)
 couchfs.add_command(upload)
 
-@couchfs.command(short_help="upload files.")
+@couchfs.command(short_help="download files.")
 @click.option(
     "--doc_per_path", is_flag=False, help="forcibly copy over an existing managed file"
 )
 @click.option(
-    "--dry_run", is_flag=False, help="forcibly copy over an existing managed file"
+    "--dry_run", is_flag=True, help="only show what would be downloaded"
+)
+@click.option(
+    "--jobs", "-j", default=1, show_default=True, help="number of files to download at the same time"
 )
 @click.argument("src", type=click.Path())
 @click.argument("dst", type=click.Path())
-def download(src, dst, doc_per_path, dry_run):
-    """uploads from src to dst.
+def download(src, dst, doc_per_path, dry_run, jobs):
+    """downloads from src to dst.
+    """
+    started = time.monotonic()
+    total = 0
+    for result in couchdb_client().download(src, dst, dry_run, max_workers=jobs):
+        src, dst, status, reason = result
+        if getattr(result, 'size', 0):
+            total += result.size
+            click.echo(f'{src} {dst} {status}:{reason} {humanize.naturalsize(result.rate)}/s{retries(result)}')
+        else:
+            click.echo(f'{src} {dst} {status}:{reason}{retries(result)}')
+    if total:
+        elapsed = time.monotonic() - started
+        click.echo(f'{humanize.naturalsize(total)} in {elapsed:.1f}s {humanize.naturalsize(total / elapsed)}/s')
+@couchfs.command(short_help="sync files.")
+@click.option(
+    "--delete", is_flag=True, help="delete files that are no longer in src from dst"
+)
+@click.option(
+    "--dry_run", is_flag=True, help="only show what would be transferred or deleted"
+)
+@click.option(
+    "--jobs", "-j", default=1, show_default=True, help="number of files to transfer at the same time"
+)
+@click.argument("src", type=click.Path())
+@click.argument("dst", type=click.Path())
+def sync(src, dst, delete, dry_run, jobs):
+    """syncs src to dst, only transferring new or changed files.
+    An existing local src is uploaded, anything else is downloaded into the local dst.
+    """
+    unchanged = 0
+    for result in couchdb_client().sync(src, dst, delete, dry_run, max_workers=jobs):
+        src, dst, status, reason = result
+        if status == 'UNCHANGED':
+            unchanged += 1
+        else:
+            click.echo(f'{src} {dst} {status}:{reason}{retries(result)}')
+    click.echo(f'{unchanged} unchanged')
+
+
+@couchfs.command(short_help="remove files.")
+@click.option(
+    "--dry_run", is_flag=True, help="only show what would be removed"
+)
+@click.argument('patterns', nargs=-1, required=True)
+def rm(patterns, dry_run):
+    """removes the files matching each pattern, as ls matches them, with bulk requests. A bare doc id removes the doc.
+    The chunks of large and deduplicated files stay, other files may share them, `couchfs gc` deletes unused ones.
     """
-    for src, dst, status,reason in api.CouchDBClient().download(src, dst):
-        click.echo(f'{src} {dst} {status}:{reason}')
+    if any(not pattern.strip('/') for pattern in patterns):
+        raise click.UsageError('an empty pattern would remove every doc, use * to mean that')
+    client = couchdb_client()
+    for pattern in patterns:
+        for src, _, status, reason in client.remove(pattern, dry_run):
+            click.echo(f'{src} {status}:{reason}')
+
+
+@couchfs.command(short_help="move files.")
+@click.option(
+    "--dry_run", is_flag=True, help="only show what would be moved"
+)
+@click.option(
+    "--jobs", "-j", default=1, show_default=True, help="number of files to copy at the same time"
+)
+@click.argument("src")
+@click.argument("dst")
+def mv(src, dst, dry_run, jobs):
+    """moves the files matching src to dst inside the database. Whole docs and chunked files move without
+    their bytes leaving the server, plain attachments are copied through this machine.
+    """
+    if not src.strip('/'):
+        raise click.UsageError('an empty src would move every doc, use * to mean that')
+    for result in couchdb_client().move(src, dst, dry_run, max_workers=jobs):
+        src, dst, status, reason = result
+        click.echo(f'{src} {dst} {status}:{reason}{retries(result)}')
+
+
+@couchfs.command(short_help="delete unused chunks.")
+@click.option(
+    "--dry_run", is_flag=True, help="only show what would be deleted"
+)
+def gc(dry_run):
+    """deletes the chunks of large and deduplicated files that no file refers to any more, e.g. after rm.
+    Reads every doc, run it while nothing uploads.
+    """
+    for chunk_id, _, status, reason in couchdb_client().collect_chunks(dry_run):
+        click.echo(f'{chunk_id} {status}:{reason}')
+
+
+@couchfs.command(short_help="mount the database.")
+@click.option(
+    "--ttl", default=30.0, show_default=True, help="seconds to cache listings and file sizes"
+)
+@click.option(
+    "--negative_ttl", default=5.0, show_default=True, help="seconds to remember paths that do not exist"
+)
+@click.option(
+    "--block_size", default=256 * 1024, show_default=True, help="bytes fetched and cached per block"
+)
+@click.option(
+    "--cache_size", default=64 * 1024 * 1024, show_default=True, help="bytes of blocks to keep in memory"
+)
+@click.option(
+    "--readahead", default=8 * 1024 * 1024, show_default=True, help="max bytes to read ahead of sequential reads"
+)
+@click.option(
+    "--dirty_bytes", default=256 * 1024 * 1024, show_default=True, help="max bytes written but not yet uploaded"
+)
+@click.argument("mountpoint", type=click.Path(exists=True, file_okay=False))
+def mount(mountpoint, ttl, negative_ttl, block_size, cache_size, readahead, dirty_bytes):
+    """mounts the database at mountpoint with FUSE, documents are the top level directories.
+    """
+    from couchfs import fuse
+    fuse.mount(couchdb_client(), mountpoint, ttl=ttl, negative_ttl=negative_ttl, block_size=block_size,
+               cache_bytes=cache_size, max_readahead=readahead, dirty_bytes=dirty_bytes)
+
+
+@couchfs.command(short_help="keep connections and listings warm for other commands.")
+@click.option(
+    "--socket", "path", type=click.Path(dir_okay=False), help="unix socket to listen on, defaults to one per $COUCHDB_URI"
+)
+@click.option(
+    "--stop", "stop_agent", is_flag=True, help="stop the running agent"
+)
+def agent(path, stop_agent):
+    """runs a resident agent that later couchfs commands hand themselves to, sharing its connections,
+    revision cache and a local index that follows the database's changes. Set COUCHFS_NO_AGENT=1 to bypass it.
+    """
+    path = path or socket_path()
+    if stop_agent:
+        click.echo('stopped' if stop(path) else 'no agent running')
+        return
+    with Agent(couchdb_client(), path) as resident:
+        click.echo(f'listening on {path}', err=True)
+        resident.serve_forever()
+
 
-    # for src, dst, status,reason in couchfs.CouchDBClient().download(src, dst):
-    #     click.echo(f'{src} {dst} {status}:{reason}')
 couchfs.add_command(ls)
 couchfs.add_command(upload)
 couchfs.add_command(download)
@@ -1,23 +1,240 @@
 from __future__ import print_function, absolute_import, division
 
+import itertools
+import os
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from errno import EBADF, EBUSY, EIO, ENOENT, ENOTDIR, ENOTEMPTY, EISDIR, EPERM
 from sys import argv, exit
 try:
-    from refuse.high import Operations, LoggingMixIn
-except ImportError:
-    from unittest.mock import MagicMock
-    class LoggingMixIn(MagicMock):
+    from refuse.high import FUSE, FuseOSError, Operations, LoggingMixIn
+except (ImportError, OSError):
+    # refuse is optional and raises OSError when libfuse is missing, the
+    # operations still work without it, they just can't be mounted
+    FUSE = None
+
+    class FuseOSError(OSError):
+        def __init__(self, errno):
+            super(FuseOSError, self).__init__(errno, os.strerror(errno))
+
+    class LoggingMixIn:
         pass
-    class Operations(MagicMock):
+
+    class Operations:
         pass
 
+
+class MetadataCache:
+    """
+    An in memory directory tree of the attachments, built from the attachment_list view.
+    The doc ids at the top cost one grouped view query, each doc's tree one key range
+    query, and both are kept for ttl seconds. Paths found missing are remembered for
+    negative_ttl seconds so tools probing for files don't each cost a round trip.
+    """
+
+    def __init__(self, client, ttl=30.0, negative_ttl=5.0, clock=time.monotonic):
+        self.client = client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.docs = (0, None)
+        self.trees = {}
+        self.missing = {}
+
+    def doc_ids(self):
+        with self.lock:
+            expires, doc_ids = self.docs
+            if doc_ids is None or expires <= self.clock():
+                doc_ids = {path: None for path, _ in self.client.run_view(depth=1)}
+                self.docs = (self.clock() + self.ttl, doc_ids)
+            return doc_ids
+
+    def tree(self, doc_id):
+        """
+        The directory tree of doc_id, {name: subtree} for directories and the size for files.
+        """
+        with self.lock:
+            expires, tree = self.trees.get(doc_id, (0, None))
+            if tree is None or expires <= self.clock():
+                tree = {}
+                for file_path, size in self.client.run_view(startkey=[doc_id], endkey=[doc_id, {}]):
+                    *dirs, name = file_path.split('/')[1:] or ['']
+                    if not name:
+                        continue
+                    node = tree
+                    for segment in dirs:
+                        node = node.setdefault(segment, {})
+                    node[name] = size
+                self.trees[doc_id] = (self.clock() + self.ttl, tree)
+            return tree
+
+    def lookup(self, path):
+        """
+        :param path: '/doc_id/dir/file'
+        :return: a dict of entries for a directory, the size for a file or None if there is nothing at path
+        """
+        path = path.strip('/')
+        if not path:
+            return self.doc_ids()
+        with self.lock:
+            if self.missing.get(path, 0) > self.clock():
+                return None
+            doc_id, *segments = path.split('/')
+            node = self.tree(doc_id) if doc_id in self.doc_ids() else None
+            for segment in segments:
+                node = node.get(segment) if isinstance(node, dict) else None
+            if node is None:
+                self.missing[path] = self.clock() + self.negative_ttl
+            return node
+
+    def invalidate(self, path=None):
+        """
+        Forgets what is cached for the doc of path, or everything.
+        """
+        with self.lock:
+            doc_id = path.strip('/').split('/')[0] if path else ''
+            if doc_id:
+                self.trees.pop(doc_id, None)
+                self.missing = {p: e for p, e in self.missing.items() if p.split('/')[0] != doc_id}
+                if doc_id not in (self.docs[1] or {}):
+                    self.docs = (0, None)
+            else:
+                self.docs = (0, None)
+                self.trees.clear()
+                self.missing.clear()
+
+
+class BlockCache:
+    """
+    A bounded LRU of fixed size blocks of attachment bodies, keyed by (path, block number).
+    """
+
+    def __init__(self, block_size=256 * 1024, max_bytes=64 * 1024 * 1024):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, index):
+        with self.lock:
+            block = self.blocks.get((path, index))
+            if block is not None:
+                self.blocks.move_to_end((path, index))
+            return block
+
+    def put(self, path, index, block):
+        with self.lock:
+            old = self.blocks.pop((path, index), None)
+            self.size += len(block) - (len(old) if old is not None else 0)
+            self.blocks[(path, index)] = block
+            while self.size > self.max_bytes and self.blocks:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, path):
+        """
+        Drops the blocks of path and of any file below it.
+        """
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for key in [key for key in self.blocks if key[0] == path or key[0].startswith(prefix)]:
+                self.size -= len(self.blocks.pop(key))
+
+
+class Spool:
+    """
+    The local copy of a file open for writing. Every handle open on the path shares it
+    and it is uploaded in one go when the file is flushed or released.
+    """
+
+    def __init__(self, path, spool_dir=None):
+        self.path = path
+        self.file = tempfile.NamedTemporaryFile(dir=spool_dir, prefix='couchfs-')
+        self.lock = threading.RLock()
+        self.opens = 0
+        self.dirty = False
+        self.upload = None
+        self.error = None
+        # why it could not be filled with what couchdb has, a handle on it is useless
+        self.broken = None
+
+    @property
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def write(self, data, offset):
+        with self.lock:
+            self.wait()
+            written = os.pwrite(self.file.fileno(), data, offset)
+            self.dirty = True
+            return written
+
+    def read(self, size, offset):
+        return os.pread(self.file.fileno(), size, offset)
+
+    def truncate(self, length):
+        with self.lock:
+            self.wait()
+            self.file.truncate(length)
+            self.dirty = True
+
+    def wait(self):
+        """
+        Waits for the upload in flight, if any, so it is not changed under it.
+        """
+        upload = self.upload
+        if upload is not None:
+            wait([upload])
+
+
 class FuseOperations(LoggingMixIn, Operations):
     '''
-    A simple SFTP filesystem. Requires paramiko: http://www.lag.net/paramiko/
-    You need to be able to login to remote host without entering a password.
+    A couchdb filesystem, documents are the top level directories and their attachments
+    the files below them. storage is a couchfs.api.CouchDBClient.
     '''
 
-    def __init__(self, storage):
+    def __init__(self, storage, ttl=30.0, negative_ttl=5.0, block_size=256 * 1024, cache_bytes=64 * 1024 * 1024,
+                 max_readahead=8 * 1024 * 1024, dirty_bytes=256 * 1024 * 1024, upload_workers=4, spool_dir=None):
         self.storage = storage
+        # write back: open for writing path -> Spool, and fh -> Spool, both under spools_lock
+        self.spools = {}
+        self.handles = {}
+        self.spools_lock = threading.Lock()
+        self.next_fh = itertools.count(1)
+        self.spool_dir = spool_dir
+        self.uploads = ThreadPoolExecutor(max_workers=upload_workers)
+        self.max_dirty_bytes = dirty_bytes
+        self.dirty_bytes = 0
+        self.dirty = threading.Condition()
+        self.metadata = MetadataCache(storage, ttl, negative_ttl)
+        self.blocks = BlockCache(block_size, cache_bytes)
+        self.max_readahead = max_readahead
+        # path -> (offset the next sequential read starts at, readahead window in bytes)
+        self.readahead = {}
+        self.mounted_at = time.time()
+        self.uid, self.gid = os.getuid(), os.getgid()
+        # with a local index, follow the _changes feed and drop what changed as it happens
+        self.stop = threading.Event()
+        if getattr(storage, 'index', None) is not None:
+            storage.index.update()
+            threading.Thread(target=storage.index.follow, args=(self.changed, self.stop), daemon=True).start()
+
+    def changed(self, doc_ids):
+        for doc_id in doc_ids:
+            self.metadata.invalidate(f'/{doc_id}')
+            self.blocks.invalidate(f'/{doc_id}')
+
+    def stat(self, node):
+        times = dict(st_atime=self.mounted_at, st_mtime=self.mounted_at, st_ctime=self.mounted_at)
+        if isinstance(node, dict):
+            return dict(st_mode=stat.S_IFDIR | 0o755, st_nlink=2, st_size=0, st_uid=self.uid, st_gid=self.gid, **times)
+        return dict(st_mode=stat.S_IFREG | 0o644, st_nlink=1, st_size=node, st_uid=self.uid, st_gid=self.gid, **times)
 
     def chmod(self, path, mode):
         raise NotImplemented()
@@ -25,51 +242,348 @@ class FuseOperations(LoggingMixIn, Operations):
     def chown(self, path, uid, gid):
         raise NotImplemented()
 
-    def create(self, path, mode):
-        raise NotImplemented()
+    def create(self, path, mode, fi=None):
+        return self.open_spool(path, prefill=False)
 
     def destroy(self, path):
-        raise NotImplemented()
+        with self.spools_lock:
+            spools = list(self.spools.values())
+        for spool in spools:
+            self.schedule_upload(spool)
+        self.uploads.shutdown(wait=True)
+        self.stop.set()
+
+    def lookup(self, path):
+        """
+        Like MetadataCache.lookup, with the files open for writing laid over it.
+        """
+        path = '/' + path.strip('/')
+        with self.spools_lock:
+            spool = self.spools.get(path)
+            spooled = list(self.spools)
+        if spool is not None:
+            return spool.size
+        node = self.metadata.lookup(path)
+        prefix = path.rstrip('/') + '/'
+        children = [p[len(prefix):].split('/') for p in spooled if p.startswith(prefix)]
+        if children and (node is None or isinstance(node, dict)):
+            node = dict(node or {})
+            for parts in children:
+                # a spooled file directly under path, or a directory leading to one
+                node.setdefault(parts[0], 0 if len(parts) == 1 else {})
+        return node
 
     def getattr(self, path, fh=None):
-        raise NotImplemented()
+        node = self.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        return self.stat(node)
 
     def mkdir(self, path, mode):
         raise NotImplemented()
 
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return self.open_spool(path, prefill=not flags & os.O_TRUNC)
+        if self.lookup(path) is None:
+            raise FuseOSError(ENOENT)
+        return next(self.next_fh)
+
+    def open_spool(self, path, prefill):
+        """
+        Opens a write handle on path, sharing the Spool of any other write handle on it.
+        A new spool is registered first and filled after, holding its lock, so concurrent
+        opens of a path share one spool and wait until it is filled.
+        :param prefill: copy what couchdb has into a new spool first
+        :return: fh
+        """
+        path = '/' + path.strip('/')
+        with self.spools_lock:
+            spool = self.spools.get(path)
+            created = spool is None
+            if created:
+                spool = self.spools[path] = Spool(path, self.spool_dir)
+                # nobody else has it yet, so this can't wait, and lock order doesn't matter
+                spool.lock.acquire()
+            spool.opens += 1
+            fh = next(self.next_fh)
+            self.handles[fh] = spool
+        if created:
+            try:
+                if prefill and isinstance(self.metadata.lookup(path), int):
+                    self.storage.download_to_file(self.url(path), spool.file)
+                    spool.file.flush()
+            except Exception as error:
+                spool.broken = error
+            finally:
+                spool.lock.release()
+        else:
+            # until whoever created it has filled it
+            with spool.lock:
+                pass
+        if spool.broken is not None:
+            self.drop_handle(fh)
+            raise FuseOSError(EIO)
+        return fh
+
+    def drop_handle(self, fh):
+        """
+        Forgets a handle on a broken spool, and the spool with the last one.
+        """
+        with self.spools_lock:
+            spool = self.handles.pop(fh)
+            spool.opens -= 1
+            if spool.opens == 0 and self.spools.get(spool.path) is spool:
+                del self.spools[spool.path]
+                spool.file.close()
+
+    def write(self, path, data, offset, fh):
+        spool = self.handles.get(fh)
+        if spool is None:
+            raise FuseOSError(EBADF)
+        return spool.write(data, offset)
+
+    def truncate(self, path, length, fh=None):
+        spool = self.handles.get(fh) or self.spools.get('/' + path.strip('/'))
+        if spool is not None:
+            spool.truncate(length)
+            return
+        fh = self.open_spool(path, prefill=length > 0)
+        self.handles[fh].truncate(length)
+        self.release(path, fh)
+
+    def flush(self, path, fh):
+        spool = self.handles.get(fh)
+        if spool is not None:
+            self.schedule_upload(spool)
+
+    def fsync(self, path, datasync, fh):
+        spool = self.handles.get(fh)
+        if spool is None:
+            return
+        upload = self.schedule_upload(spool)
+        if upload is not None:
+            wait([upload])
+        if spool.error is not None:
+            raise FuseOSError(EIO)
+
+    def release(self, path, fh):
+        with self.spools_lock:
+            spool = self.handles.pop(fh, None)
+        if spool is None:
+            return
+        self.schedule_upload(spool)
+        with self.spools_lock:
+            spool.opens -= 1
+            last = spool.opens == 0
+        if last:
+            if spool.upload is None:
+                self.close_spool(spool)
+            else:
+                spool.upload.add_done_callback(lambda _: self.close_spool(spool))
+
+    def close_spool(self, spool):
+        # spool.lock before spools_lock, open_spool never waits for a spool's lock holding spools_lock
+        with spool.lock, self.spools_lock:
+            if spool.opens == 0 and not spool.dirty and self.spools.get(spool.path) is spool:
+                del self.spools[spool.path]
+                spool.file.close()
+
+    def schedule_upload(self, spool):
+        """
+        Uploads a dirty spool in the background. Blocks while more than max_dirty_bytes
+        are waiting to be uploaded.
+        :return: the Future of the upload in flight, or None
+        """
+        with spool.lock:
+            if not spool.dirty:
+                return spool.upload
+            spool.wait()
+            size = spool.size
+            with self.dirty:
+                self.dirty.wait_for(lambda: self.dirty_bytes == 0 or self.dirty_bytes + size <= self.max_dirty_bytes)
+                self.dirty_bytes += size
+            spool.dirty = False
+            spool.upload = self.uploads.submit(self.upload_spool, spool, size)
+            return spool.upload
+
+    def upload_spool(self, spool, size):
+        try:
+            with open(spool.file.name, 'rb') as fp:
+                result = self.storage.upload_file(fp, spool.path.strip('/'))
+            # upload_file reports most failures, e.g. a 403 or a failed chunk, in its result
+            if result.status not in (201, 202):
+                raise IOError(f'{spool.path} {result.status}: {result.reason}')
+            spool.error = None
+        except Exception as error:
+            # left dirty so the next flush or fsync tries again, not under spool.lock
+            # as its holder may be waiting on this upload
+            spool.error = error
+            spool.dirty = True
+        finally:
+            self.metadata.invalidate(spool.path)
+            self.blocks.invalidate(spool.path)
+            with self.dirty:
+                self.dirty_bytes -= size
+                self.dirty.notify_all()
+
     def read(self, path, size, offset, fh):
-        raise NotImplemented()
+        spool = self.handles.get(fh) or self.spools.get('/' + path.strip('/'))
+        if spool is not None:
+            return spool.read(size, offset)
+        file_size = self.metadata.lookup(path)
+        if file_size is None:
+            raise FuseOSError(ENOENT)
+        if isinstance(file_size, dict):
+            raise FuseOSError(EISDIR)
+        end = min(offset + size, file_size)
+        if offset >= end:
+            return b''
+        block_size = self.blocks.block_size
+        first, last = offset // block_size, (end - 1) // block_size
+        window = self.readahead_window(path, offset, end)
+        indexes = range(first, last + 1)
+        blocks = [self.blocks.get(path, index) for index in indexes]
+        if None in blocks:
+            fetched = self.fetch_blocks(path, first, min(last + window // block_size, (file_size - 1) // block_size))
+            blocks = [block if block is not None else fetched.get(index) or self.fetch_block(path, index)
+                      for index, block in zip(indexes, blocks)]
+        start = offset - first * block_size
+        return b''.join(blocks)[start:start + end - offset]
+
+    def readahead_window(self, path, offset, end):
+        """
+        Doubles the readahead of path, up to max_readahead, while it is read sequentially
+        and drops it on the first random read.
+        """
+        next_offset, window = self.readahead.get(path, (None, 0))
+        if offset == next_offset:
+            window = min(max(window * 2, self.blocks.block_size), self.max_readahead)
+        else:
+            window = 0
+        self.readahead[path] = (end, window)
+        return window
+
+    def fetch_blocks(self, path, first, last):
+        """
+        Fetches the blocks between first and last that are not cached, with one Range
+        request per run of missing blocks.
+        :return: {index: block} of the fetched blocks
+        """
+        block_size = self.blocks.block_size
+        fetched = {}
+        index = first
+        while index <= last:
+            if self.blocks.get(path, index) is not None:
+                index += 1
+                continue
+            run_end = index
+            while run_end < last and self.blocks.get(path, run_end + 1) is None:
+                run_end += 1
+            data = self.storage.read_range(self.url(path), index * block_size, (run_end - index + 1) * block_size)
+            for n in range(index, run_end + 1):
+                block = data[(n - index) * block_size:(n - index + 1) * block_size]
+                self.blocks.put(path, n, block)
+                fetched[n] = block
+            index = run_end + 1
+        return fetched
+
+    def fetch_block(self, path, index):
+        block_size = self.blocks.block_size
+        block = self.storage.read_range(self.url(path), index * block_size, block_size)
+        self.blocks.put(path, index, block)
+        return block
+
+    def url(self, path):
+        return f'{self.storage.db_uri}/{path.strip("/")}'
 
     def readdir(self, path, fh):
-        raise NotImplemented()
+        node = self.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        if not isinstance(node, dict):
+            raise FuseOSError(ENOTDIR)
+        return ['.', '..'] + list(node)
 
     def readlink(self, path):
         raise NotImplemented()
 
     def rename(self, old, new):
-        raise NotImplemented()
+        """
+        Moves inside couchdb with storage.move, a top level directory is a doc and moves as a whole.
+        """
+        old, new = '/' + old.strip('/'), '/' + new.strip('/')
+        node, target = self.lookup(old), self.lookup(new)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        with self.spools_lock:
+            busy = old in self.spools
+        if busy:
+            raise FuseOSError(EBUSY)
+        if not isinstance(node, dict) and (isinstance(target, dict) or new.count('/') == 1):
+            raise FuseOSError(EISDIR if target is not None else EPERM)
+        if isinstance(node, dict) and target is not None and not isinstance(target, dict):
+            raise FuseOSError(ENOTDIR)
+        self.apply(self.storage.move, old, new, glob=False)
 
     def rmdir(self, path):
-        raise NotImplemented()
+        node = self.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        if not isinstance(node, dict):
+            raise FuseOSError(ENOTDIR)
+        if node:
+            raise FuseOSError(ENOTEMPTY)
+        # only a doc without files is an empty directory, the ones below it exist while they hold files
+        self.apply(self.storage.remove, path, glob=False)
 
-    def symlink(self, target, source):
-        raise NotImplemented()
+    def apply(self, operation, *paths, **kwargs):
+        """
+        Runs storage operation on paths and forgets what was cached about them.
+        :raises FuseOSError: EIO when any path failed
+        """
+        try:
+            results = list(operation(*[path.strip('/') for path in paths], **kwargs))
+        except Exception:
+            raise FuseOSError(EIO)
+        finally:
+            for path in paths:
+                # a doc that went away is still in the cached list of docs
+                self.metadata.invalidate(path if '/' in path.strip('/') else None)
+                self.blocks.invalidate(path)
+        if any(result.status not in (200, 201, 202) for result in results):
+            raise FuseOSError(EIO)
 
-    def truncate(self, path, length, fh=None):
+    def symlink(self, target, source):
         raise NotImplemented()
 
     def unlink(self, path):
-        raise NotImplemented()
+        path = '/' + path.strip('/')
+        node = self.lookup(path)
+        if node is None:
+            raise FuseOSError(ENOENT)
+        if isinstance(node, dict):
+            raise FuseOSError(EISDIR)
+        with self.spools_lock:
+            busy = path in self.spools
+        if busy:
+            raise FuseOSError(EBUSY)
+        self.apply(self.storage.remove, path, glob=False)
 
     def utimens(self, path, times=None):
         raise NotImplemented()
 
-    def write(self, path, data, offset, fh):
-        raise NotImplemented()
 
 
+def mount(client, mountpoint, foreground=True, **options):
+    if FUSE is None:
+        raise RuntimeError('mounting needs refuse and libfuse, pip install couchfs[full]')
+    return FUSE(FuseOperations(client, **options), mountpoint, foreground=foreground, nothreads=False)
+
 
 if __name__ == '__main__':
     if len(argv) != 3:
-        print('usage: %s <host> <mountpoint>' % argv[0])
-        exit(1)
\ No newline at end of file
+        print('usage: %s <couchdb_uri> <mountpoint>' % argv[0])
+        exit(1)
+    from couchfs.api import CouchDBClient
+    mount(CouchDBClient(argv[1]), argv[2])
\ No newline at end of file
@@ -0,0 +1,295 @@
+"""
+A local SQLite index of the attachments, kept current from the database _changes feed
+
+"""
+import json
+import os
+import sqlite3
+import threading
+import unicodedata
+
+from requests import RequestException
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT,
+    content_type TEXT,
+    rev TEXT,
+    key BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_doc_id ON files (doc_id);
+CREATE INDEX IF NOT EXISTS files_key ON files (key);
+'''
+
+# kept apart from SCHEMA, the version is read before the files table is made
+STATE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+# bumped when what the rows hold changes, an index of another version is read again from scratch
+VERSION = '4'
+
+# sorts after any path in sqlite's binary collation
+LAST_CHAR = '\U0010ffff'
+
+# the ascii characters in the order couchdb's ICU collation gives them, upper case letters
+# sort with their lower case ones and only come after them when nothing else differs
+ICU_ORDER = '\t\n\x0b\x0c\r _-,;:!?.\'"()[]{}@*/\\&#%`^+<=>|~$0123456789abcdefghijklmnopqrstuvwxyz'
+ICU_WEIGHTS = {char: weight for weight, char in enumerate(ICU_ORDER, 2)}
+
+# the docs holding the chunks of large files, see CouchDBClient.upload_chunked
+CHUNK_DOC_PREFIX = 'couchfs-chunk-'
+
+
+def doc_files(doc):
+    """
+    The files of a doc, its attachment stubs and the entries of its chunked files manifest,
+    which carry the same length, digest and content_type keys.
+    :return: {file_name: stub}
+    """
+    return dict(doc.get('_attachments') or {}, **doc.get('couchfs_files', {}))
+
+
+def plain_digest(stub):
+    """
+    The digest of a file's bytes as they are read, None for an attachment couchdb stores
+    compressed (text and json by default), whose digest is the md5 of the gzipped bytes.
+    """
+    return None if stub.get('encoding') else stub.get('digest')
+
+
+def doc_rows(doc):
+    """
+    The index rows of a doc, one per file or a single empty one for a doc without
+    any, the same paths the attachment_list view emits.
+    :return: yields (path, doc_id, size, digest, content_type, rev)
+    """
+    doc_id, rev = doc['_id'], doc.get('_rev')
+    if doc_id.startswith(CHUNK_DOC_PREFIX):
+        return
+    files = doc_files(doc)
+    if not files:
+        yield doc_id, doc_id, 0, None, None, rev
+        return
+    for file_name, stub in files.items():
+        yield f'{doc_id}/{file_name}', doc_id, stub.get('length', 0), plain_digest(stub), stub.get('content_type'), rev
+
+
+def weight(value):
+    return value.to_bytes(3, 'big')
+
+
+def collation_key(text):
+    """
+    Bytes that sort like text does in couchdb's ICU collation, by letter first ignoring accents
+    and case, then by accents and then by case, so 'a' < 'A' < 'b' < 'B' and '_' < '-' < '.'.
+    Ascii follows ICU's order, other characters their code point after it.
+    """
+    primary, secondary, tertiary = [], [], []
+    for char in unicodedata.normalize('NFD', text):
+        if unicodedata.combining(char):
+            if secondary:
+                secondary[-1] = max(secondary[-1], ord(char))
+            continue
+        lower = char.lower()
+        if lower not in ICU_WEIGHTS and ord(char) < 32:
+            # control characters are ignored
+            continue
+        primary.append(ICU_WEIGHTS.get(lower, 0x100 + ord(lower)))
+        secondary.append(2)
+        tertiary.append(3 if char != lower else 2)
+    # 1 ends a level, so a string sorts before the longer ones it starts
+    return b'\x00\x00\x01'.join(b''.join(map(weight, level)) for level in (primary, secondary, tertiary))
+
+
+def sort_key(path):
+    """
+    Bytes that sort like the view key of path, which couchdb compares segment by segment,
+    so 'DOC/a/x.txt' sorts before 'DOC/a.txt' although '/' sorts after '.'.
+    """
+    return b''.join(collation_key(segment) + weight(0) for segment in path.split('/'))
+
+
+def range_prefix(startkey, endkey):
+    """
+    The path prefix of a view key range made by key_range, or the doc tree range
+    [doc_id] to [doc_id, {}].
+    :return: (prefix, also match the prefix without its trailing '/')
+    """
+    if not startkey:
+        return '', False
+    if endkey and endkey[-1] == {}:
+        return '/'.join(startkey) + '/', True
+    return '/'.join(startkey), False
+
+
+class Index:
+    """
+    Mirrors what the attachment_list view returns in a SQLite file, path -> size, digest,
+    content type and doc rev. The first update reads the whole _changes feed, later ones
+    only what changed since the sequence stored with the rows, so listings and sizes are
+    local lookups. It answers run_view with the same rows as CouchDBClient.run_view.
+    """
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.following = False
+        with self.lock, self.db:
+            self.db.executescript(STATE_SCHEMA)
+            if self.state('db_uri') != client.db_uri or self.state('version') != VERSION:
+                self.reset()
+            else:
+                self.db.executescript(SCHEMA)
+
+    def state(self, name, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, value))
+
+    @property
+    def since(self):
+        return json.loads(self.state('since', '0'))
+
+    def reset(self):
+        """
+        Drops every row, the next update reads the _changes feed from the start.
+        """
+        with self.lock, self.db:
+            # dropped rather than emptied, an index of an older version may lack a column
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute('DELETE FROM state')
+            self.db.executescript(SCHEMA)
+            self.set_state('db_uri', self.client.db_uri)
+            self.set_state('version', VERSION)
+
+    def apply(self, changes):
+        """
+        Replaces the rows of each changed doc.
+        :param changes: _changes results with include_docs
+        :return: set of changed doc ids
+        """
+        doc_ids = set()
+        for change in changes:
+            doc_id = change['id']
+            if doc_id.startswith(('_design/', CHUNK_DOC_PREFIX)):
+                continue
+            doc_ids.add(doc_id)
+            self.db.execute('DELETE FROM files WHERE doc_id = ?', (doc_id,))
+            doc = change.get('doc')
+            if change.get('deleted') or not doc or doc.get('_deleted'):
+                continue
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (row + (sort_key(row[0]),) for row in doc_rows(doc)))
+        return doc_ids
+
+    def update(self, feed='normal', timeout=None):
+        """
+        Reads the _changes feed from the stored sequence on, a page at a time.
+        :param feed: 'normal', or 'longpoll' to wait up to timeout seconds for a change
+        :return: set of changed doc ids
+        """
+        page_size = self.client.options['view_page_size']
+        params = {'include_docs': 'true', 'style': 'main_only', 'limit': page_size, 'feed': feed}
+        if timeout is not None:
+            params['timeout'] = int(timeout * 1000)
+        changed = set()
+        while True:
+            # not locked while waiting on couchdb, a long poll would block every lookup
+            with self.lock:
+                params['since'] = self.since
+            response = self.client.transport.get(f'{self.client.db_uri}/_changes', params=params)
+            response.raise_for_status()
+            body = response.json()
+            with self.lock, self.db:
+                changed |= self.apply(body['results'])
+                self.set_state('since', json.dumps(body['last_seq']))
+            if len(body['results']) < page_size:
+                return changed
+            params['feed'] = 'normal'
+
+    def refresh(self):
+        """
+        Brings the index up to date unless follow is already doing so.
+        """
+        if not self.following:
+            self.update()
+
+    def follow(self, on_change, stop, timeout=30.0, retry=5.0):
+        """
+        Long polls the _changes feed until stop is set, calling on_change with the set of
+        changed doc ids after each batch.
+        :param stop: threading.Event
+        """
+        self.following = True
+        try:
+            while not stop.is_set():
+                try:
+                    changed = self.update(feed='longpoll', timeout=timeout)
+                except RequestException:
+                    stop.wait(retry)
+                    continue
+                if changed:
+                    on_change(changed)
+        finally:
+            self.following = False
+
+    def rows(self, startkey=None, endkey=None):
+        prefix, exact = range_prefix(startkey, endkey)
+        query = 'SELECT path, size FROM files WHERE path >= ? AND path < ?'
+        args = [prefix, prefix + LAST_CHAR]
+        if exact:
+            query += ' OR path = ?'
+            args.append(prefix[:-1])
+        with self.lock:
+            return self.db.execute(query + ' ORDER BY key', args).fetchall()
+
+    def run_view(self, **args):
+        """
+        Answers an attachment_list view query from the index.
+        :param depth: group to this many path segments, values are _stats dicts
+        :param startkey: first key, a list of path segments
+        :param endkey: last key, a list of path segments
+        :return: yields file_path, value
+        """
+        rows = self.rows(args.get('startkey'), args.get('endkey'))
+        if 'depth' not in args:
+            yield from rows
+            return
+        groups = {}
+        for path, size in rows:
+            key = '/'.join(path.split('/')[:args['depth']])
+            stats = groups.get(key)
+            if stats is None:
+                groups[key] = {'sum': size, 'count': 1, 'min': size, 'max': size, 'sumsqr': size * size}
+                continue
+            stats['sum'] += size
+            stats['count'] += 1
+            stats['min'] = min(stats['min'], size)
+            stats['max'] = max(stats['max'], size)
+            stats['sumsqr'] += size * size
+        yield from groups.items()
+
+    def stat(self, path):
+        """
+        :return: (size, digest, content_type, rev) of the attachment at path or None
+        """
+        with self.lock:
+            return self.db.execute('SELECT size, digest, content_type, rev FROM files WHERE path = ?',
+                                   (path.strip('/'),)).fetchone()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,96 @@
+"""
+A local record of file digests, so files that have not changed are not hashed again
+
+"""
+import base64
+import hashlib
+import json
+import os
+import tempfile
+
+
+def md5_digest(md5):
+    """
+    The couchdb attachment `digest` of an md5 hash object, e.g. 'md5-XUFAKrxLKna5cZ2REBfFkg=='
+    """
+    return 'md5-' + base64.b64encode(md5.digest()).decode('ascii')
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5_digest(md5)
+
+
+class Manifest:
+    """
+    Remembers the digest of every file under a local root together with the size and
+    mtime it was computed for and, once synced, the digest of the attachment it was
+    synced with. Kept outside the tree, in manifest_dir, so it is never synced itself.
+    """
+
+    def __init__(self, root, manifest_dir):
+        self.root = os.path.abspath(root)
+        name = hashlib.sha1(self.root.encode('utf-8')).hexdigest()
+        self.path = os.path.join(manifest_dir, f'{name}.json')
+        self.dirty = False
+        try:
+            with open(self.path) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+    def key(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self.root)
+
+    def digest(self, file_path):
+        """
+        The digest of file_path, only reading the file if its size or mtime changed.
+        """
+        stat = os.stat(file_path)
+        entry = self.entries.get(self.key(file_path))
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['digest']
+        digest = file_digest(file_path)
+        self.set(file_path, digest, stat)
+        return digest
+
+    def synced(self, file_path):
+        """
+        The digest of the attachment file_path was last synced with, None if the file changed since.
+        """
+        stat = os.stat(file_path)
+        entry = self.entries.get(self.key(file_path))
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry.get('synced')
+        return None
+
+    def set(self, file_path, digest, stat=None, synced=None):
+        stat = stat or os.stat(file_path)
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+        if synced:
+            entry['synced'] = synced
+        self.entries[self.key(file_path)] = entry
+        self.dirty = True
+
+    def discard(self, file_path):
+        if self.entries.pop(self.key(file_path), None):
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.part')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,166 @@
+"""
+Request counters, latency histograms and trace events, fed by Transport hooks
+
+"""
+import json
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+# upper bounds of the latency histogram buckets in milliseconds, the last bucket is everything slower
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+DB_ENDPOINTS = ('_all_docs', '_bulk_docs', '_bulk_get', '_changes', '_find')
+
+
+def endpoint(method, url):
+    """
+    The kind of couchdb endpoint a request goes to, e.g. 'PUT attachment' or 'GET view'.
+    """
+    segments = [segment for segment in urlsplit(url).path.split('/') if segment]
+    if len(segments) <= 1:
+        kind = 'db'
+    elif segments[1] in DB_ENDPOINTS:
+        kind = segments[1]
+    elif segments[1] == '_design':
+        kind = 'view' if '_view' in segments else 'design'
+    elif segments[1].startswith('couchfs-chunk-'):
+        kind = 'chunk'
+    else:
+        kind = 'doc' if len(segments) == 2 else 'attachment'
+    return f'{method} {kind}'
+
+
+def content_length(headers):
+    try:
+        return int(headers.get('Content-Length') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class EndpointStats:
+    """
+    Counts, bytes, errors and a latency histogram for one endpoint.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.sent = 0
+        self.received = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.statuses = {}
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, seconds, status, sent, received):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.sent += sent
+        self.received += received
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status == 'error' or (isinstance(status, int) and status >= 400):
+            self.errors += 1
+        milliseconds = seconds * 1000
+        self.histogram[next((i for i, bound in enumerate(BUCKETS_MS) if milliseconds <= bound), len(BUCKETS_MS))] += 1
+
+    def percentile(self, fraction):
+        """
+        The upper bound, in milliseconds, of the bucket holding the fraction-th request.
+        """
+        rank, seen = fraction * self.count, 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max_seconds * 1000
+        return 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count, 'errors': self.errors, 'retries': self.retries,
+            'bytes_sent': self.sent, 'bytes_received': self.received,
+            'seconds': self.seconds, 'mean_ms': self.seconds * 1000 / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.5), 'p90_ms': self.percentile(0.9), 'p99_ms': self.percentile(0.99),
+            'max_ms': self.max_seconds * 1000,
+            'statuses': {str(status): count for status, count in self.statuses.items()},
+            'histogram_ms': dict(zip([str(bound) for bound in BUCKETS_MS] + ['inf'], self.histogram)),
+        }
+
+
+class RequestStats:
+    """
+    A Transport hook keeping EndpointStats per endpoint and, with trace, a Chrome trace
+    event per request (load the file in chrome://tracing or Perfetto). Latency is the
+    time until the response headers arrived, streamed bodies are read after that.
+
+        stats = client.collect_stats()
+        client.download('TAKIS', 'dump')
+        print(stats.format())
+    """
+
+    def __init__(self, trace=False, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.trace = [] if trace else None
+
+    def request_started(self, method, url):
+        return self.clock()
+
+    def request_finished(self, method, url, started, response=None, error=None):
+        """
+        :param started: what request_started returned
+        :param response: the requests.Response, None when the request raised error
+        """
+        finished = self.clock()
+        name = endpoint(method, url)
+        status = response.status_code if response is not None else 'error'
+        sent = content_length(response.request.headers) if response is not None else 0
+        received = content_length(response.headers) if response is not None else 0
+        with self.lock:
+            self.endpoints.setdefault(name, EndpointStats()).add(finished - started, status, sent, received)
+            if self.trace is not None:
+                self.trace.append({
+                    'name': name, 'cat': 'http', 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                    'ts': (started - self.started) * 1e6, 'dur': (finished - started) * 1e6,
+                    'args': {'url': url, 'status': status, 'sent': sent, 'received': received,
+                             'error': repr(error) if error is not None else None},
+                })
+
+    def retried(self, method, url):
+        """
+        Counts a request that is sent again, e.g. after a conflict or a timeout.
+        """
+        with self.lock:
+            self.endpoints.setdefault(endpoint(method, url), EndpointStats()).retries += 1
+
+    def summary(self):
+        """
+        :return: {endpoint: {count, errors, retries, bytes_sent, bytes_received, seconds, mean_ms, p50_ms, ...}}
+        """
+        with self.lock:
+            return {name: stats.as_dict() for name, stats in sorted(self.endpoints.items())}
+
+    def format(self):
+        lines = [f'{"endpoint":<20} {"count":>7} {"errors":>6} {"retries":>7} {"sent":>11} {"received":>11} '
+                 f'{"mean ms":>8} {"p50 ms":>7} {"p90 ms":>7} {"p99 ms":>7} {"max ms":>8}']
+        for name, stats in self.summary().items():
+            lines.append(f'{name:<20} {stats["count"]:>7} {stats["errors"]:>6} {stats["retries"]:>7} '
+                         f'{stats["bytes_sent"]:>11} {stats["bytes_received"]:>11} {stats["mean_ms"]:>8.1f} '
+                         f'{stats["p50_ms"]:>7.0f} {stats["p90_ms"]:>7.0f} {stats["p99_ms"]:>7.0f} '
+                         f'{stats["max_ms"]:>8.1f}')
+        return '\n'.join(lines)
+
+    def dump_json(self, path):
+        with open(path, 'w') as fp:
+            json.dump({'seconds': self.clock() - self.started, 'endpoints': self.summary()}, fp, indent=2)
+
+    def dump_trace(self, path):
+        with self.lock:
+            events = list(self.trace or [])
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
@@ -0,0 +1,200 @@
+"""
+Bandwidth and concurrency limits, with priorities, for the requests of a CouchDBClient
+
+"""
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from couchfs.stats import content_length
+
+# lower goes first
+INTERACTIVE = 0
+BULK = 10
+
+PRIORITY = contextvars.ContextVar('couchfs_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def priority(value):
+    """
+    Runs the requests made inside the block, and in map_unordered workers started from it, at value.
+    """
+    token = PRIORITY.set(value)
+    try:
+        yield value
+    finally:
+        PRIORITY.reset(token)
+
+
+def prioritized(fn, value):
+    """
+    :return: fn running at priority value, e.g. for map_unordered
+    """
+    def call(*args, **kwargs):
+        with priority(value):
+            return fn(*args, **kwargs)
+    return call
+
+
+class Queue:
+    """
+    Waiters taking turns by priority, then arrival, on a shared Condition.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+    @contextmanager
+    def turn(self, value):
+        """
+        Holds the condition, with entry queued, until the block ends; is_first tells whether it is entry's turn.
+        """
+        entry = (value, next(self.counter))
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            try:
+                yield entry
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def is_first(self, entry):
+        return self.waiting[0] == entry
+
+
+class TokenBucket(Queue):
+    """
+    Lets rate bytes a second through on average, in bursts of up to burst bytes.
+    Waiting callers are let through in priority order.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, count, value=None):
+        """
+        Waits until count bytes may be sent or received. More than burst bytes at once
+        are let through as soon as the bucket is full, and paid back by the next callers.
+        """
+        if count <= 0:
+            return
+        value = PRIORITY.get() if value is None else value
+        with self.turn(value) as entry:
+            needed = min(count, self.burst)
+            while True:
+                self.refill()
+                if self.is_first(entry) and self.tokens >= needed:
+                    break
+                self.condition.wait((needed - self.tokens) / self.rate if self.is_first(entry) else None)
+            self.tokens -= count
+
+
+class AdaptiveLimit(Queue):
+    """
+    An AIMD limit on the requests in flight. It starts at minimum and doubles every round
+    trip until the first sign of overload, then grows by one a round trip. A failed
+    request, or latency over tolerance times the lowest seen plus slack seconds, halves
+    it, at most once a round trip. Waiting callers get free slots in priority order.
+    """
+
+    def __init__(self, maximum, minimum=1, tolerance=2.0, slack=0.005, clock=time.monotonic):
+        super(AdaptiveLimit, self).__init__()
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.tolerance = tolerance
+        self.slack = slack
+        self.clock = clock
+        self.limit = float(minimum)
+        self.in_flight = 0
+        self.slow_start = True
+        self.baseline = None
+        self.latency = None
+        self.decreased = 0.0
+
+    def acquire(self, value=None):
+        value = PRIORITY.get() if value is None else value
+        with self.turn(value) as entry:
+            while not (self.is_first(entry) and self.in_flight < int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds=None, failed=False):
+        """
+        :param seconds: the request's latency, None when it should not count, e.g. a big upload
+        :param failed: the server was overloaded, a 5xx, a 429 or no response at all
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if seconds is not None:
+                self.baseline = seconds if self.baseline is None else min(seconds, self.baseline)
+                self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+            overloaded = failed or (self.latency is not None
+                                    and self.latency > self.tolerance * self.baseline + self.slack)
+            if overloaded:
+                now = self.clock()
+                if now - self.decreased > (self.latency or 0.0):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.slow_start = False
+                    self.decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + (1 if self.slow_start else 1 / self.limit))
+                if self.latency is not None and seconds is not None:
+                    # let the baseline follow a server that got slower for good
+                    self.baseline += (seconds - self.baseline) * 0.01
+            self.condition.notify_all()
+
+
+class Throttle:
+    """
+    A Transport hook that caps the bytes a second CouchDBClient moves and, when adaptive,
+    the requests in flight, finding the best count from their latency and failures.
+    Requests are counted in flight until their response headers arrive, and only those
+    sending at most measure_bytes count towards latency, a big upload is slow anyway.
+    """
+    FAILED_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, bandwidth=0, max_in_flight=0, adaptive=False, measure_bytes=64 * 1024):
+        """
+        :param bandwidth: bytes a second, 0 for no cap
+        :param max_in_flight: the most requests the adaptive limit lets through at once
+        :param adaptive: limit the requests in flight with an AdaptiveLimit
+        """
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self.limit = AdaptiveLimit(max_in_flight) if adaptive else None
+        self.measure_bytes = measure_bytes
+
+    def consume(self, count):
+        """
+        Waits until count more bytes may be moved, a no-op without a bandwidth cap.
+        """
+        if self.bucket is not None:
+            self.bucket.consume(count)
+
+    def request_started(self, method, url):
+        if self.limit is not None:
+            self.limit.acquire()
+        return time.monotonic()
+
+    def request_finished(self, method, url, started, response=None, error=None):
+        if self.limit is None:
+            return
+        failed = response is None or response.status_code in self.FAILED_STATUSES
+        measured = response is not None and content_length(response.request.headers) <= self.measure_bytes
+        self.limit.release(time.monotonic() - started if measured else None, failed)
@@ -0,0 +1,204 @@
+"""
+The HTTP transport used by CouchDBClient
+
+"""
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# the RetryCount of the transfer being made, see counting_retries
+RETRY_COUNT = contextvars.ContextVar('couchfs_retry_count', default=None)
+
+
+class RetryCount:
+    def __init__(self):
+        self.count = 0
+
+
+@contextmanager
+def counting_retries():
+    """
+    Counts the retries made inside the block, which are also added to any enclosing count.
+    :return: RetryCount
+    """
+    retries = RetryCount()
+    token = RETRY_COUNT.set(retries)
+    try:
+        yield retries
+    finally:
+        RETRY_COUNT.reset(token)
+        if RETRY_COUNT.get() is not None:
+            RETRY_COUNT.get().count += retries.count
+
+
+def note_retry():
+    if RETRY_COUNT.get() is not None:
+        RETRY_COUNT.get().count += 1
+
+
+class RetryPolicy:
+    """
+    How often, and after how long, to send a request again. Connection errors, timeouts
+    and the statuses in RETRY_STATUSES are retried up to retries times by the Transport,
+    conflicts up to conflicts times by CouchDBClient after refreshing the doc's rev. The
+    waits are jittered exponential backoff, a random time up to backoff * 2 ** attempt
+    seconds but no more than max_backoff, or what a Retry-After header asks for.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=3, conflicts=5, backoff=0.5, max_backoff=30.0, sleep=time.sleep):
+        self.retries = retries
+        self.conflicts = conflicts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    def delay(self, attempt, response=None):
+        """
+        :param attempt: 1 for the first retry
+        :return: seconds to wait before it
+        """
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(self.max_backoff, float(retry_after))
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def wait(self, attempt, response=None):
+        note_retry()
+        self.sleep(self.delay(attempt, response))
+
+    def conflict_wait(self, attempt):
+        """
+        Before the attempt-th write after a conflict. The first goes straight away, refreshing the rev
+        takes a round trip anyway, later ones back off so concurrent writers stop colliding.
+        """
+        note_retry()
+        if attempt > 1:
+            self.sleep(self.delay(attempt - 1))
+
+
+def release(response):
+    """
+    Reads what is left of a streamed response and closes it, so its connection goes back to
+    the pool before another request is made, with every connection taken that one would wait.
+    """
+    response.content
+    response.close()
+
+
+class Transport:
+    """
+    Owns a pooled, keep-alive requests.Session that every CouchDBClient call goes through.
+    To change how couchfs talks to couchdb pass CouchDBClient(transport=...) any object with
+    head, get, put, post, delete and copy(url, **kwargs) returning requests.Response like
+    objects, and a hooks list that CouchDBClient.add_hook and the adaptive throttle add to.
+    Subclassing it and overriding request(method, url, **kwargs), which the verbs all call,
+    keeps the retries and the hooks.
+    """
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_POOL_CONNECTIONS = 4
+    DEFAULT_CONNECT_TIMEOUT = 10.0
+
+    def __init__(self, auth=None, pool_size=DEFAULT_POOL_SIZE, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 keep_alive=True, timeout=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT, hooks=None, retry=None):
+        """
+        :param auth: (userid, password) or None
+        :param pool_size: connections kept open per host, when that many are busy another
+            request opens a new one, closed after it, rather than waiting for one of them
+        :param pool_connections: number of host pools to keep
+        :param keep_alive: reuse connections between requests
+        :param timeout: read timeout in seconds, None waits forever
+        :param connect_timeout: connect timeout in seconds
+        :param hooks: objects with request_started(method, url), returning a token, and
+            request_finished(method, url, token, response=None, error=None), called around every request,
+            and optionally retried(method, url) when one is sent again
+        :param retry: RetryPolicy, None sends every request once
+        """
+        self.retry = retry
+        self.hooks = list(hooks or [])
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, timeout)
+        self.session = requests.Session()
+        self.session.auth = auth
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        # not blocking, a request made while this thread still streams a response would otherwise
+        # wait forever for a connection once every one is taken
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request, again after a connection error, a timeout or a RETRY_STATUSES response
+        when there is a retry policy. A file like body is rewound first, any other is only sent once.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        if self.retry is None or not self.retry.retries:
+            return self.send(method, url, **kwargs)
+        body = kwargs.get('data')
+        rewind = body.tell() if hasattr(body, 'seek') and hasattr(body, 'tell') else None
+        replayable = body is None or isinstance(body, (bytes, str, dict, list, tuple)) or rewind is not None
+        attempt = 0
+        while True:
+            try:
+                response = self.send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retry.retries or not replayable:
+                    raise
+                response = None
+            else:
+                if (response.status_code not in self.retry.RETRY_STATUSES
+                        or attempt >= self.retry.retries or not replayable):
+                    return response
+                response.close()
+            attempt += 1
+            for hook in self.hooks:
+                if hasattr(hook, 'retried'):
+                    hook.retried(method, url)
+            self.retry.wait(attempt, response)
+            if rewind is not None:
+                body.seek(rewind)
+
+    def send(self, method, url, **kwargs):
+        # a copy, hooks may be added or removed by another thread while the request is out
+        hooks = list(self.hooks)
+        if not hooks:
+            return self.session.request(method, url, **kwargs)
+        tokens = [hook.request_started(method, url) for hook in hooks]
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception as error:
+            for hook, token in zip(hooks, tokens):
+                hook.request_finished(method, url, token, error=error)
+            raise
+        for hook, token in zip(hooks, tokens):
+            hook.request_finished(method, url, token, response=response)
+        return response
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def copy(self, url, **kwargs):
+        return self.request('COPY', url, **kwargs)
+
+    def close(self):
+        self.session.close()
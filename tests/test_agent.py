@@ -0,0 +1,99 @@
+"""Tests for `couchfs.agent`."""
+import io
+import os
+import stat
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+from benchmarks.fake_couchdb import FakeCouchDB
+from couchfs import cli
+from couchfs.agent import Agent, forward, socket_path, stop
+from couchfs.api import CouchDBClient
+
+
+@pytest.fixture
+def server():
+    with FakeCouchDB() as server:
+        client = CouchDBClient(server.uri('test'))
+        client.create_db()
+        client.save_doc(client.COUCHFS_VIEWS)
+        client.upload_bytes_file(b'hello', 'DOC/a.txt')
+        client.upload_bytes_file(b'x' * 2000, 'DOC/dir/b.bin')
+        yield server
+
+
+@pytest.fixture
+def agent(server, tmp_path):
+    client = CouchDBClient(server.uri('test'))
+    resident = Agent(client, str(tmp_path / 'agent.sock'), index_path=str(tmp_path / 'index.db'))
+    thread = threading.Thread(target=resident.serve_forever, daemon=True)
+    thread.start()
+    assert resident.ready.wait(5)
+    yield resident
+    stop(resident.path)
+    thread.join(5)
+    resident.close()
+
+
+def run(agent, *argv):
+    out, err = io.StringIO(), io.StringIO()
+    code = forward(list(argv), agent.path, out, err)
+    return code, out.getvalue(), err.getvalue()
+
+
+def test_socket_path_per_database(monkeypatch):
+    monkeypatch.delenv('COUCHFS_AGENT_SOCKET', raising=False)
+    monkeypatch.setenv('XDG_RUNTIME_DIR', '/run/user/1000')
+    assert socket_path('couchdb://h:5984/a') != socket_path('couchdb://h:5984/b')
+    assert socket_path('couchdb://h:5984/a').startswith('/run/user/1000/couchfs/agent-')
+    monkeypatch.delenv('COUCHDB_URI', raising=False)
+    assert socket_path() is None
+
+
+def test_forward_without_agent(tmp_path):
+    assert forward(['ls'], str(tmp_path / 'missing.sock')) is None
+    assert forward(['mount', '/mnt'], str(tmp_path / 'missing.sock')) is None
+
+
+def test_agent_output_matches_local(agent, server, monkeypatch, tmp_path):
+    monkeypatch.setenv('COUCHDB_URI', server.uri('test'))
+    monkeypatch.setenv('COUCHFS_NO_AGENT', '')
+    # '/' sorts after '.' and '-' in a path but a view key compares segment by segment
+    client = CouchDBClient(server.uri('test'))
+    client.upload_bytes_file(b'x', 'DOC/a/x.txt')
+    client.upload_bytes_file(b'b', 'DOC/a-b.txt')
+    # and couchdb collates case insensitively first, B after a and A right after a
+    client.upload_bytes_file(b'B', 'DOC/B.txt')
+    client.upload_bytes_file(b'A', 'DOC/A.txt')
+    for argv in (['ls', 'DOC'], ['du', 'DOC', '-d', '1'], ['ls', 'DOC/a'], ['ls', 'DOC/A']):
+        local = CliRunner().invoke(cli.couchfs, argv)
+        assert run(agent, *argv) == (0, local.output, '')
+    local = CliRunner().invoke(cli.couchfs, ['ls', 'DOC']).output
+    assert [local.index(f'DOC/{name}') for name in ('a/x.txt', 'a-b.txt', 'a.txt', 'A.txt', 'B.txt')] == sorted(
+        local.index(f'DOC/{name}') for name in ('a/x.txt', 'a-b.txt', 'a.txt', 'A.txt', 'B.txt'))
+
+
+def test_agent_socket_is_only_open_to_its_user(server, tmp_path):
+    umask = os.umask(0)
+    try:
+        resident = Agent(CouchDBClient(server.uri('test')), str(tmp_path / 'agent.sock'),
+                         index_path=str(tmp_path / 'index.db'))
+        assert os.umask(0) == 0
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(resident.path).st_mode) == 0o600
+    resident.close()
+
+
+def test_agent_runs_transfers_in_the_callers_directory(agent, tmp_path, monkeypatch):
+    (tmp_path / 'up').mkdir()
+    (tmp_path / 'up' / 'c.txt').write_bytes(b'new')
+    monkeypatch.chdir(tmp_path)
+    code, out, _ = run(agent, 'upload', 'up', 'DOC')
+    assert code == 0 and 'DOC/up/c.txt 201' in out
+    # the upload is in the agent's index straight away
+    assert 'DOC/up/c.txt' in run(agent, 'ls', 'DOC/up')[1]
+    code, out, err = run(agent, 'upload')
+    assert code == 2 and 'Missing argument' in err
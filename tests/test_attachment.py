@@ -0,0 +1,82 @@
+"""Tests for `couchfs.attachment`."""
+import io
+import zipfile
+
+import requests_mock
+
+from couchfs.api import CouchDBClient
+
+URL = 'http://127.0.0.1:5984/test/DOC/archive.zip'
+
+
+def serve(m, content, honour_range=True):
+    def body(request, context):
+        header = request.headers.get('Range')
+        if not header or not honour_range:
+            context.headers['Content-Length'] = str(len(content))
+            return content
+        start = int(header[len('bytes='):].rstrip('-'))
+        if start >= len(content):
+            context.status_code = 416
+            return b''
+        context.status_code = 206
+        context.headers['Content-Range'] = f'bytes {start}-{len(content) - 1}/{len(content)}'
+        return content[start:]
+
+    m.get(URL, content=body)
+    m.head(URL, headers={'Content-Length': str(len(content))})
+
+
+def test_open_is_lazy_and_streams_sequential_reads():
+    content = bytes(range(256)) * 64
+    with requests_mock.Mocker() as m:
+        serve(m, content)
+        fp = CouchDBClient('couchdb://127.0.0.1:5984/test').open_attachment(URL)
+        assert m.call_count == 0
+        assert b''.join(iter(lambda: fp.read(1000), b'')) == content
+        assert m.call_count == 1
+        assert 'Range' not in m.last_request.headers
+        fp.close()
+
+
+def test_seek_uses_range_requests():
+    content = bytes(range(256)) * 64
+    with requests_mock.Mocker() as m:
+        serve(m, content)
+        raw = CouchDBClient('couchdb://127.0.0.1:5984/test').open_attachment(URL, buffering=0)
+        raw.seek(-10, io.SEEK_END)
+        buffer = bytearray(4)
+        assert raw.readinto(buffer) == 4 and bytes(buffer) == content[-10:-6]
+        assert m.last_request.headers['Range'] == f'bytes={len(content) - 10}-'
+        raw.seek(100)
+        assert raw.read(3) == content[100:103]
+        raw.seek(len(content))
+        assert raw.read(3) == b''
+        assert [request.method for request in m.request_history] == ['HEAD', 'GET', 'GET']
+
+
+def test_server_ignoring_range():
+    content = b'0123456789' * 10
+    with requests_mock.Mocker() as m:
+        serve(m, content, honour_range=False)
+        fp = CouchDBClient('couchdb://127.0.0.1:5984/test').open_attachment(URL, size=len(content))
+        fp.seek(95)
+        assert fp.read() == content[95:]
+
+
+def test_zipfile_reads_only_what_it_needs():
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        zip_file.writestr('small.txt', b'hello')
+        zip_file.writestr('big.bin', bytes(1024 * 1024))
+    content = archive.getvalue()
+    with requests_mock.Mocker() as m:
+        serve(m, content)
+        client = CouchDBClient('couchdb://127.0.0.1:5984/test')
+        with client.get_attachment(URL, lazy=True) as fp:
+            with zipfile.ZipFile(fp) as zip_file:
+                assert zip_file.read('small.txt') == b'hello'
+        # the central directory is read from the end, then the member from the start
+        methods = [(request.method, request.headers.get('Range')) for request in m.request_history]
+        assert methods[0] == ('HEAD', None)
+        assert methods[1][0] == 'GET' and methods[1][1].startswith('bytes=')
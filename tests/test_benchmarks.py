@@ -0,0 +1,37 @@
+"""Tests for the benchmark suite and its fake couchdb."""
+import json
+
+from benchmarks.fake_couchdb import FakeCouchDB
+from benchmarks.run import SCENARIOS, report, run_case
+from couchfs.api import CouchDBClient
+
+
+def test_run_case_covers_every_scenario():
+    rows = run_case(files=12, size=300, jobs=2, latency=0.0)
+    assert [row['scenario'] for row in rows] == list(SCENARIOS)
+    assert all(row['errors'] == 0 for row in rows)
+    upload = rows[0]
+    # a tree goes into one doc, with jobs it is batched rather than written a file at a time
+    assert upload['bytes'] == 12 * 300 and upload['requests'] < 12
+
+
+def test_fake_couchdb_speaks_the_client_api(tmp_path):
+    with FakeCouchDB() as server:
+        client = CouchDBClient(server.uri('test'), chunk_threshold=500, chunk_size=200,
+                               index=str(tmp_path / 'index.db'))
+        client.create_db()
+        client.save_doc(client.COUCHFS_VIEWS)
+        client.upload_bytes_file(b'a' * 100, 'DOC/small.txt')
+        client.upload_bytes_file(bytes(range(250)) * 4, 'DOC/big/large.bin')
+        assert sorted(client.list_attachments()) == [('DOC/big/large.bin', 1000), ('DOC/small.txt', 100)]
+        assert client.read_range(f'{client.db_uri}/DOC/big/large.bin', 150, 100) == (bytes(range(250)) * 4)[150:250]
+        assert client.delete_attachment('DOC/small.txt').status == 200
+        assert list(client.list_attachments()) == [('DOC/big/large.bin', 1000)]
+
+
+def test_report_is_json(tmp_path):
+    output = tmp_path / 'bench.json'
+    report([{'scenario': 'ls', 'seconds': 0.1}], str(output))
+    document = json.loads(output.read_text())
+    assert document['results'] == [{'scenario': 'ls', 'seconds': 0.1}]
+    assert {'couchfs', 'python', 'platform', 'created'} <= set(document)
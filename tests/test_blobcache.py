@@ -0,0 +1,102 @@
+"""Tests for `couchfs.blobcache`."""
+import hashlib
+import os
+import threading
+
+import pytest
+import requests_mock
+
+from couchfs.api import CouchDBClient
+from couchfs.blobcache import BlobCache, DigestMismatch
+from couchfs.manifest import md5_digest
+
+DB = 'http://127.0.0.1:5984/test'
+
+
+def digest_of(data):
+    return md5_digest(hashlib.md5(data))
+
+
+def test_fetch_is_atomic_and_checked(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    data = b'hello world'
+    path = cache.fetch(digest_of(data), lambda fp: fp.write(data))
+    assert open(path, 'rb').read() == data
+    assert cache.get(digest_of(data)) == path
+    assert cache.fetch(digest_of(data), lambda fp: pytest.fail('fetched twice')) == path
+    with pytest.raises(DigestMismatch):
+        cache.fetch(digest_of(b'other'), lambda fp: fp.write(b'corrupt'))
+    assert cache.get(digest_of(b'other')) is None
+    assert [name for _, _, names in os.walk(str(tmp_path)) for name in names] == [os.path.basename(path)]
+    assert cache.get(None) is None
+
+
+def test_concurrent_fetches_share_one(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    data = b'x' * 1000
+    started, release, calls = threading.Event(), threading.Event(), []
+
+    def fill(fp):
+        calls.append(1)
+        started.set()
+        release.wait()
+        fp.write(data)
+
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(cache.fetch(digest_of(data), fill))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(set(paths)) == 1
+
+
+def test_fetch_finished_between_lookups_is_not_fetched_again(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    data, calls = b'y' * 100, []
+    get = cache.get
+
+    def racing_get(digest):
+        # another thread's fetch completes between this miss and taking the lock
+        cache.get = get
+        path = get(digest)
+        cache.fetch(digest, lambda fp: (calls.append('other'), fp.write(data)))
+        return path
+
+    cache.get = racing_get
+    path = cache.fetch(digest_of(data), lambda fp: (calls.append('this'), fp.write(data)))
+    assert calls == ['other']
+    assert open(path, 'rb').read() == data
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=25)
+    blobs = [bytes([index]) * 10 for index in range(3)]
+    first = cache.fetch(digest_of(blobs[0]), lambda fp: fp.write(blobs[0]))
+    os.utime(first, ns=(0, 0))
+    cache.fetch(digest_of(blobs[1]), lambda fp: fp.write(blobs[1]))
+    cache.fetch(digest_of(blobs[2]), lambda fp: fp.write(blobs[2]))
+    assert cache.get(digest_of(blobs[0])) is None
+    assert cache.size == 20
+    assert BlobCache(str(tmp_path), max_bytes=25).size == 20
+
+
+def test_client_fetches_identical_content_once(tmp_path):
+    data = b'same bytes in two docs'
+    etag = f'"{digest_of(data)[4:]}"'
+    client = CouchDBClient('couchdb://127.0.0.1:5984/test', blob_cache=str(tmp_path / 'blobs'))
+    with requests_mock.Mocker() as m:
+        for doc_id in ('a', 'b'):
+            m.head(f'{DB}/{doc_id}/file.bin', headers={'ETag': etag})
+            m.get(f'{DB}/{doc_id}/file.bin', content=data)
+        with client.get_attachment(f'{DB}/a/file.bin', in_memory=True) as body:
+            assert body == data
+        with client.get_attachment(f'{DB}/b/file.bin') as fp:
+            assert fp.read() == data
+        result = client.download_path('b/file.bin', str(tmp_path / 'file.bin'))
+        assert result.status == 200 and result.digest == digest_of(data)
+        assert open(tmp_path / 'file.bin', 'rb').read() == data
+        assert [request.method for request in m.request_history] == ['HEAD', 'GET', 'HEAD', 'HEAD']
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
 """Tests for `couchfs` package."""
+import json
+import re
 
 import pytest
+import requests_mock
 from click.testing import CliRunner
 
-from couchfs import cli
+from couchfs import api, cli
 
 
 @pytest.fixture
@@ -32,4 +35,40 @@ def test_command_line_interface():
     assert 'couchfs' in result.output
     help_result = runner.invoke(cli.couchfs, ['--help'])
     assert help_result.exit_code == 0
-    assert '--help  Show this message and exit.' in help_result.output
+    assert re.search(r'--help +Show this message and exit.', help_result.output)
+    assert '--stats' in help_result.output
+
+
+def test_stats_flag(tmp_path, monkeypatch):
+    monkeypatch.setenv('COUCHDB_URI', 'couchdb://127.0.0.1:5984/test')
+    trace = tmp_path / 'trace.json'
+    with requests_mock.Mocker() as m:
+        m.get('http://127.0.0.1:5984/test/_design/couchfs_views/_view/attachment_list',
+              json={'rows': [{'key': ['DOC', 'a.txt'], 'value': 3}]})
+        result = CliRunner(mix_stderr=False).invoke(cli.couchfs, ['--stats', '--trace', str(trace), 'ls', 'DOC'])
+    assert result.exit_code == 0, result.output
+    assert 'DOC/a.txt' in result.stdout
+    assert 'GET view' in result.stderr
+    events = json.loads(trace.read_text())['traceEvents']
+    assert [event['name'] for event in events] == ['GET view']
+
+
+def test_stats_flag_hooks_only_the_commands_client(monkeypatch):
+    monkeypatch.setenv('COUCHDB_URI', 'couchdb://127.0.0.1:5984/test')
+    client = api.CouchDBClient()
+    with requests_mock.Mocker() as m:
+        m.get('http://127.0.0.1:5984/test/_design/couchfs_views/_view/attachment_list', json={'rows': []})
+        result = CliRunner(mix_stderr=False).invoke(cli.couchfs, ['--stats', 'ls', 'DOC'], obj=client)
+    assert result.exit_code == 0, result.output
+    assert 'GET view' in result.stderr
+    assert client.transport.hooks == []
+    assert api.CouchDBClient().transport.hooks == []
+
+
+def test_rm_refuses_an_empty_pattern(monkeypatch):
+    monkeypatch.setenv('COUCHDB_URI', 'couchdb://127.0.0.1:5984/test')
+    with requests_mock.Mocker() as m:
+        result = CliRunner().invoke(cli.couchfs, ['rm', 'DOC/a.txt', '/'])
+    assert result.exit_code == 2
+    assert 'use * to mean that' in result.output
+    assert m.call_count == 0
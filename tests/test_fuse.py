@@ -0,0 +1,240 @@
+"""Tests for `couchfs.fuse`."""
+import stat
+import os
+import threading
+import time
+from errno import EBUSY, EIO, EISDIR, ENOENT, ENOTEMPTY
+
+import pytest
+
+from couchfs.api import TransferResult
+from couchfs.fuse import BlockCache, FuseOperations, FuseOSError
+
+ROWS = [
+    ('TAKIS/takis/asgi.py', 387),
+    ('TAKIS/takis/media/t126.jpg', 1024),
+    ('TAKIS_1/takis/urls.py', 470),
+    ('EMPTY', 0),
+]
+
+
+class FakeStorage:
+    db_uri = 'http://127.0.0.1:5984/test'
+
+    def __init__(self, rows=ROWS, content=None):
+        self.rows = rows
+        self.queries = []
+        self.content = content or {}
+        self.ranges = []
+        self.uploads = []
+        self.fail_uploads = False
+        self.downloads = 0
+        self.download_seconds = 0
+        self.calls = []
+
+    def read_range(self, url, offset, size):
+        self.ranges.append((offset, size))
+        return self.content[url[len(self.db_uri) + 1:]][offset:offset + size]
+
+    def upload_file(self, src, dst):
+        self.uploads.append((dst, src.read()))
+        # like CouchDBClient, which reports most failures in its result
+        if self.fail_uploads:
+            return TransferResult(dst, dst, 403, 'Forbidden')
+        self.content[dst] = self.uploads[-1][1]
+        return TransferResult(dst, dst, 201, 'Created')
+
+    def download_to_file(self, url, file_obj):
+        self.downloads += 1
+        time.sleep(self.download_seconds)
+        file_obj.write(self.content[url[len(self.db_uri) + 1:]])
+
+    def remove(self, pattern, dry_run=False, glob=True):
+        self.calls.append(('remove', pattern, glob))
+        removed = [path for path, _ in self.rows if path == pattern or path.startswith(pattern + '/')]
+        self.rows = [(path, size) for path, size in self.rows if path not in removed]
+        return [TransferResult(path, path, 200, 'Deleted') for path in removed]
+
+    def move(self, src, dst, dry_run=False, max_workers=1, glob=True):
+        self.calls.append(('move', src, dst, glob))
+        moved = [(path, dst + path[len(src):], size) for path, size in self.rows
+                 if path == src or path.startswith(src + '/')]
+        self.rows = [row for row in self.rows if row[0] not in [path for path, _, _ in moved]]
+        self.rows += [(dest_path, size) for _, dest_path, size in moved]
+        return [TransferResult(path, dest_path, 201, 'Created') for path, dest_path, _ in moved]
+
+    def run_view(self, **args):
+        self.queries.append(args)
+        if 'depth' in args:
+            return [(doc_id, {}) for doc_id in sorted({path.split('/')[0] for path, _ in self.rows})]
+        doc_id = args['startkey'][0]
+        return [(path, size) for path, size in self.rows if path.split('/')[0] == doc_id]
+
+
+def test_getattr_and_readdir():
+    storage = FakeStorage()
+    fs = FuseOperations(storage)
+    assert sorted(fs.readdir('/', None)) == ['.', '..', 'EMPTY', 'TAKIS', 'TAKIS_1']
+    assert fs.readdir('/TAKIS/takis', None) == ['.', '..', 'asgi.py', 'media']
+    assert fs.readdir('/EMPTY', None) == ['.', '..']
+    assert stat.S_ISDIR(fs.getattr('/TAKIS/takis/media')['st_mode'])
+    attrs = fs.getattr('/TAKIS/takis/media/t126.jpg')
+    assert stat.S_ISREG(attrs['st_mode'])
+    assert attrs['st_size'] == 1024
+    with pytest.raises(FuseOSError) as error:
+        fs.getattr('/TAKIS/nope')
+    assert error.value.errno == ENOENT
+
+
+def test_metadata_is_cached_until_ttl():
+    now = [0.0]
+    storage = FakeStorage()
+    fs = FuseOperations(storage, ttl=10, negative_ttl=1)
+    fs.metadata.clock = lambda: now[0]
+    for path in ('/TAKIS', '/TAKIS/takis', '/TAKIS/takis/asgi.py', '/TAKIS/takis/media/t126.jpg'):
+        fs.getattr(path)
+    assert len(storage.queries) == 2
+    for _ in range(3):
+        with pytest.raises(FuseOSError):
+            fs.getattr('/TAKIS/missing')
+    assert len(storage.queries) == 2
+    storage.rows = ROWS + [('TAKIS/missing', 1)]
+    now[0] = 2.0
+    with pytest.raises(FuseOSError):
+        fs.getattr('/TAKIS/missing')
+    now[0] = 11.0
+    assert fs.getattr('/TAKIS/missing')['st_size'] == 1
+    assert len(storage.queries) == 4
+
+
+def big_file_storage(size):
+    content = bytes(range(256)) * (size // 256)
+    return FakeStorage([('DOC/big.bin', len(content))], {'DOC/big.bin': content}), content
+
+
+def test_read_header_fetches_one_block():
+    storage, content = big_file_storage(1024 * 1024)
+    fs = FuseOperations(storage, block_size=4096)
+    assert fs.read('/DOC/big.bin', 16, 0, None) == content[:16]
+    assert fs.read('/DOC/big.bin', 100, 500000, None) == content[500000:500100]
+    assert storage.ranges == [(0, 4096), (499712, 4096)]
+    assert fs.read('/DOC/big.bin', 16, 8, None) == content[8:24]
+    assert len(storage.ranges) == 2
+    assert fs.read('/DOC/big.bin', 100, len(content) - 10, None) == content[-10:]
+    assert fs.read('/DOC/big.bin', 100, len(content), None) == b''
+
+
+def test_sequential_reads_grow_readahead():
+    storage, content = big_file_storage(1024 * 1024)
+    fs = FuseOperations(storage, block_size=4096, max_readahead=64 * 1024)
+    data = b''.join(fs.read('/DOC/big.bin', 4096, offset, None) for offset in range(0, len(content), 4096))
+    assert data == content
+    assert len(storage.ranges) < len(content) // 4096 // 8
+    assert max(size for _, size in storage.ranges) == 4096 + 64 * 1024
+
+
+def test_block_cache_is_bounded():
+    cache = BlockCache(block_size=10, max_bytes=30)
+    for index in range(5):
+        cache.put('/a', index, b'x' * 10)
+    assert cache.size == 30
+    assert cache.get('/a', 0) is None
+    assert cache.get('/a', 4) == b'x' * 10
+    cache.invalidate('/a')
+    assert cache.size == 0
+
+
+def test_writes_are_spooled_and_uploaded_once():
+    storage = FakeStorage()
+    fs = FuseOperations(storage)
+    fh = fs.create('/NEW/dir/file.txt', 0o644)
+    for offset in range(0, 1000, 100):
+        assert fs.write('/NEW/dir/file.txt', b'x' * 100, offset, fh) == 100
+    assert fs.getattr('/NEW/dir/file.txt')['st_size'] == 1000
+    assert stat.S_ISDIR(fs.getattr('/NEW/dir')['st_mode'])
+    assert 'NEW' in fs.readdir('/', None)
+    assert fs.read('/NEW/dir/file.txt', 10, 995, fh) == b'x' * 5
+    assert storage.uploads == []
+    fs.fsync('/NEW/dir/file.txt', 0, fh)
+    fs.release('/NEW/dir/file.txt', fh)
+    fs.destroy('/')
+    assert storage.uploads == [('NEW/dir/file.txt', b'x' * 1000)]
+    assert fs.spools == {}
+
+
+def test_open_for_write_prefills_unless_truncated():
+    storage, content = big_file_storage(1024)
+    fs = FuseOperations(storage)
+    fh = fs.open('/DOC/big.bin', os.O_RDWR)
+    fs.write('/DOC/big.bin', b'abc', 0, fh)
+    fs.release('/DOC/big.bin', fh)
+    fs.destroy('/')
+    assert storage.uploads == [('DOC/big.bin', b'abc' + content[3:])]
+    fs = FuseOperations(storage)
+    fh = fs.open('/DOC/big.bin', os.O_WRONLY | os.O_TRUNC)
+    fs.write('/DOC/big.bin', b'abc', 0, fh)
+    fs.truncate('/DOC/big.bin', 2, fh)
+    fs.release('/DOC/big.bin', fh)
+    fs.destroy('/')
+    assert storage.uploads[-1] == ('DOC/big.bin', b'ab')
+
+
+def test_fsync_reports_failed_upload():
+    storage = FakeStorage()
+    storage.fail_uploads = True
+    fs = FuseOperations(storage)
+    fh = fs.create('/DOC/a.txt', 0o644)
+    fs.write('/DOC/a.txt', b'data', 0, fh)
+    with pytest.raises(FuseOSError) as error:
+        fs.fsync('/DOC/a.txt', 0, fh)
+    assert error.value.errno == EIO
+    storage.fail_uploads = False
+    fs.fsync('/DOC/a.txt', 0, fh)
+    assert storage.content['DOC/a.txt'] == b'data'
+    assert fs.dirty_bytes == 0
+
+
+def test_unlink_rename_and_rmdir_go_to_storage():
+    storage = FakeStorage(list(ROWS))
+    fs = FuseOperations(storage)
+    fs.rename('/TAKIS/takis/media', '/TAKIS/pics')
+    assert fs.readdir('/TAKIS/pics', None) == ['.', '..', 't126.jpg']
+    fs.unlink('/TAKIS/takis/asgi.py')
+    with pytest.raises(FuseOSError) as error:
+        fs.getattr('/TAKIS/takis/asgi.py')
+    assert error.value.errno == ENOENT
+    fs.rmdir('/EMPTY')
+    assert storage.calls == [('move', 'TAKIS/takis/media', 'TAKIS/pics', False),
+                             ('remove', 'TAKIS/takis/asgi.py', False), ('remove', 'EMPTY', False)]
+    assert 'EMPTY' not in fs.readdir('/', None)
+
+
+def test_unlink_and_rmdir_refuse_what_they_can_not_remove():
+    fs = FuseOperations(FakeStorage(list(ROWS)))
+    fh = fs.create('/TAKIS/new.txt', 0o644)
+    for operation, path, errno in [(fs.unlink, '/TAKIS/takis', EISDIR), (fs.unlink, '/TAKIS/new.txt', EBUSY),
+                                   (fs.rmdir, '/TAKIS_1', ENOTEMPTY), (fs.unlink, '/TAKIS/missing', ENOENT)]:
+        with pytest.raises(FuseOSError) as error:
+            operation(path)
+        assert error.value.errno == errno
+    fs.release('/TAKIS/new.txt', fh)
+    fs.destroy('/')
+
+
+def test_concurrent_opens_share_one_prefilled_spool():
+    storage, content = big_file_storage(1024)
+    storage.download_seconds = 0.05
+    fs = FuseOperations(storage)
+    handles = []
+    threads = [threading.Thread(target=lambda: handles.append(fs.open('/DOC/big.bin', os.O_RDWR))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert storage.downloads == 1 and len(fs.spools) == 1
+    assert {id(fs.handles[fh]) for fh in handles} == {id(fs.spools['/DOC/big.bin'])}
+    assert fs.read('/DOC/big.bin', 1024, 0, handles[0]) == content
+    for fh in handles:
+        fs.release('/DOC/big.bin', fh)
+    fs.destroy('/')
+    assert fs.spools == {} and fs.handles == {}
@@ -0,0 +1,123 @@
+"""Tests for `couchfs.index`."""
+import sqlite3
+import threading
+
+import requests_mock
+
+from couchfs.api import CouchDBClient, key_range
+from couchfs.index import collation_key
+
+URI = 'couchdb://127.0.0.1:5984/test'
+CHANGES = 'http://127.0.0.1:5984/test/_changes'
+
+
+def attachment(length, digest='md5-x'):
+    return {'length': length, 'digest': digest, 'content_type': 'text/plain', 'stub': True}
+
+
+FIRST = {'results': [
+    {'id': '_design/couchfs_views', 'changes': [], 'doc': {'_id': '_design/couchfs_views'}},
+    {'id': 'TAKIS', 'changes': [], 'doc': {'_id': 'TAKIS', '_rev': '1-a', '_attachments': {
+        'takis/asgi.py': attachment(387), 'takis/media/t126.jpg': attachment(1024)}}},
+    {'id': 'EMPTY', 'changes': [], 'doc': {'_id': 'EMPTY', '_rev': '1-b'}},
+], 'last_seq': '3-abc'}
+
+SECOND = {'results': [
+    {'id': 'EMPTY', 'deleted': True, 'changes': [], 'doc': {'_id': 'EMPTY', '_rev': '2-b', '_deleted': True}},
+    {'id': 'TAKIS', 'changes': [], 'doc': {'_id': 'TAKIS', '_rev': '2-a', '_attachments': {
+        'takis/asgi.py': attachment(400, 'md5-y')}}},
+], 'last_seq': '5-def'}
+
+
+def test_index_follows_changes(tmp_path):
+    with requests_mock.Mocker() as m:
+        m.get(CHANGES, [{'json': FIRST}, {'json': SECOND}])
+        client = CouchDBClient(URI, index=str(tmp_path / 'index.db'))
+        assert sorted(client.list_attachments()) == [('EMPTY', 0), ('TAKIS/takis/asgi.py', 387),
+                                                      ('TAKIS/takis/media/t126.jpg', 1024)]
+        assert m.last_request.qs['since'] == ['0']
+        assert client.index.stat('/TAKIS/takis/asgi.py') == (387, 'md5-x', 'text/plain', '1-a')
+        assert list(client.list_attachments('TAKIS/takis/a*')) == [('TAKIS/takis/asgi.py', 400)]
+        assert m.last_request.qs['since'] == ['3-abc']
+        assert list(client.run_view(startkey=['TAKIS'], endkey=['TAKIS', {}])) == [('TAKIS/takis/asgi.py', 400)]
+        assert client.index.stat('EMPTY') is None
+        assert m.call_count == 3
+
+
+def test_index_disk_usage(tmp_path):
+    with requests_mock.Mocker() as m:
+        m.get(CHANGES, json=FIRST)
+        client = CouchDBClient(URI, index=str(tmp_path / 'index.db'))
+        assert list(client.disk_usage('TAKIS', depth=1)) == [('TAKIS/takis', 2, 1411, 387, 1024)]
+        assert dict((path, count) for path, count, *_ in client.disk_usage(depth=1)) == {'EMPTY': 1, 'TAKIS': 2}
+        startkey, endkey = key_range('TAKIS/takis/m')
+        assert list(client.index.run_view(startkey=startkey, endkey=endkey)) == [('TAKIS/takis/media/t126.jpg', 1024)]
+
+
+def test_index_is_kept_between_clients(tmp_path):
+    path = str(tmp_path / 'index.db')
+    with requests_mock.Mocker() as m:
+        m.get(CHANGES, json=FIRST)
+        CouchDBClient(URI, index=path).index.update()
+        m.get(CHANGES, json={'results': [], 'last_seq': '3-abc'})
+        client = CouchDBClient(URI, index=path)
+        assert len(list(client.list_attachments())) == 3
+        assert m.last_request.qs['since'] == ['3-abc']
+        other = CouchDBClient('couchdb://127.0.0.1:5984/other', index=path)
+        assert other.index.since == 0
+
+
+def test_follow_reports_changed_docs(tmp_path):
+    stop = threading.Event()
+    changed = []
+
+    def on_change(doc_ids):
+        changed.append(doc_ids)
+        stop.set()
+
+    with requests_mock.Mocker() as m:
+        m.get(CHANGES, json=SECOND)
+        client = CouchDBClient(URI, index=str(tmp_path / 'index.db'))
+        client.index.follow(on_change, stop)
+        assert m.last_request.qs['feed'] == ['longpoll']
+    assert changed == [{'EMPTY', 'TAKIS'}]
+    assert not client.index.following
+
+
+def test_index_rows_sort_like_the_view_keys(tmp_path):
+    mixed = {'results': [{'id': 'DOC', 'changes': [], 'doc': {'_id': 'DOC', '_rev': '1-a', '_attachments': {
+        'a.txt': attachment(1), 'a/x.txt': attachment(2), 'a-b.txt': attachment(3), 'B.txt': attachment(4),
+        'a_b.txt': attachment(5), 'A.txt': attachment(6)}}}], 'last_seq': '1-a'}
+    with requests_mock.Mocker() as m:
+        m.get(CHANGES, json=mixed)
+        client = CouchDBClient(URI, index=str(tmp_path / 'index.db'))
+        assert [path for path, _ in client.list_attachments('DOC')] == [
+            'DOC/a/x.txt', 'DOC/a_b.txt', 'DOC/a-b.txt', 'DOC/a.txt', 'DOC/A.txt', 'DOC/B.txt']
+        assert [path for path, *_ in client.disk_usage('DOC', depth=1)] == [
+            'DOC/a', 'DOC/a_b.txt', 'DOC/a-b.txt', 'DOC/a.txt', 'DOC/A.txt', 'DOC/B.txt']
+
+
+def test_collation_key_follows_couchdbs_icu_order():
+    # the ascii order of couchdb's view collation documentation
+    documented = '_-,;:!?.\'"()[]{}@*/\\&#%`^+<=>|~$0123456789aAbBcCdDeEfFgGhHiIjJkKlLmMnNoOpPqQrRsStTuUvVwWxXyYzZ'
+    assert sorted(documented, key=collation_key) == list(documented)
+    # letters before case, accents before case, a prefix before what it starts
+    words = ['a', 'A', 'aa', 'Aa', 'ab', 'aB', 'b', 'e', 'E', 'é', 'f']
+    assert sorted(reversed(words), key=collation_key) == words
+
+
+def test_index_of_an_older_version_is_read_again(tmp_path):
+    path = str(tmp_path / 'index.db')
+    db = sqlite3.connect(path)
+    with db:
+        db.executescript('CREATE TABLE files (path TEXT PRIMARY KEY, doc_id TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'digest TEXT, content_type TEXT, rev TEXT);'
+                         'CREATE TABLE state (name TEXT PRIMARY KEY, value TEXT);')
+        db.executemany('INSERT INTO state VALUES (?, ?)', [('db_uri', 'http://127.0.0.1:5984/test'),
+                                                           ('version', '2'), ('since', '"3-abc"')])
+    db.close()
+    with requests_mock.Mocker() as m:
+        m.get(CHANGES, json=FIRST)
+        client = CouchDBClient(URI, index=path)
+        assert client.index.since == 0
+        assert len(list(client.list_attachments())) == 3
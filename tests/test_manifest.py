@@ -0,0 +1,31 @@
+"""Tests for `couchfs.manifest`."""
+import base64
+import hashlib
+import os
+
+from couchfs.manifest import Manifest, file_digest
+
+
+def test_file_digest(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'hello')
+    assert file_digest(str(path)) == 'md5-' + base64.b64encode(hashlib.md5(b'hello').digest()).decode()
+
+
+def test_manifest_reuses_digest_until_file_changes(tmp_path, monkeypatch):
+    from couchfs import manifest as manifest_module
+    (tmp_path / 'tree').mkdir()
+    path = tmp_path / 'tree' / 'a.txt'
+    path.write_bytes(b'hello')
+    with Manifest(str(tmp_path / 'tree'), str(tmp_path / 'manifests')) as manifest:
+        digest = manifest.digest(str(path))
+    assert os.path.exists(manifest.path)
+
+    hashed = []
+    monkeypatch.setattr(manifest_module, 'file_digest', lambda p: hashed.append(p) or 'md5-new')
+    manifest = Manifest(str(tmp_path / 'tree'), str(tmp_path / 'manifests'))
+    assert manifest.digest(str(path)) == digest
+    assert hashed == []
+    path.write_bytes(b'hello world')
+    assert manifest.digest(str(path)) == 'md5-new'
+    assert hashed == [str(path)]
@@ -0,0 +1,70 @@
+"""Tests for `couchfs.stats`."""
+import json
+
+import pytest
+import requests
+import requests_mock
+
+from couchfs.api import CouchDBClient
+from couchfs.stats import RequestStats, endpoint
+
+DB = 'http://127.0.0.1:5984/test'
+
+
+@pytest.mark.parametrize('method, url, expected', [
+    ('HEAD', DB, 'HEAD db'),
+    ('GET', f'{DB}/DOC', 'GET doc'),
+    ('PUT', f'{DB}/DOC/dir/a.txt', 'PUT attachment'),
+    ('PUT', f'{DB}/couchfs-chunk-0a1b', 'PUT chunk'),
+    ('GET', f'{DB}/_design/couchfs_views/_view/attachment_list?startkey=1', 'GET view'),
+    ('POST', f'{DB}/_all_docs', 'POST _all_docs'),
+    ('POST', f'{DB}/_bulk_docs', 'POST _bulk_docs'),
+    ('GET', f'{DB}/_changes?feed=longpoll', 'GET _changes'),
+])
+def test_endpoint(method, url, expected):
+    assert endpoint(method, url) == expected
+
+
+def test_collect_stats(tmp_path):
+    client = CouchDBClient('couchdb://127.0.0.1:5984/test', retries=0)
+    stats = client.collect_stats(trace=True)
+    with requests_mock.Mocker() as m:
+        m.get(f'{DB}/DOC/a.txt', content=b'hello', headers={'Content-Length': '5'})
+        m.put(f'{DB}/DOC/b.txt', status_code=409, json={'error': 'conflict'})
+        m.head(f'{DB}/DOC', exc=requests.ConnectionError)
+        client.transport.get(f'{DB}/DOC/a.txt')
+        client.transport.get(f'{DB}/DOC/a.txt')
+        client.transport.put(f'{DB}/DOC/b.txt', data=b'abc')
+        with pytest.raises(requests.ConnectionError):
+            client.transport.head(f'{DB}/DOC')
+    summary = stats.summary()
+    assert summary['GET attachment']['count'] == 2
+    assert summary['GET attachment']['bytes_received'] == 10
+    assert summary['GET attachment']['errors'] == 0
+    assert sum(summary['GET attachment']['histogram_ms'].values()) == 2
+    assert summary['PUT attachment']['bytes_sent'] == 3
+    assert summary['PUT attachment']['statuses'] == {'409': 1}
+    assert summary['PUT attachment']['errors'] == 1
+    assert summary['HEAD doc']['statuses'] == {'error': 1}
+    assert 'GET attachment' in stats.format()
+
+    stats.dump_json(tmp_path / 'stats.json')
+    assert json.loads((tmp_path / 'stats.json').read_text())['endpoints'] == summary
+    stats.dump_trace(tmp_path / 'trace.json')
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    assert [event['name'] for event in events] == ['GET attachment', 'GET attachment', 'PUT attachment', 'HEAD doc']
+    assert events[-1]['args']['error']
+
+
+def test_percentiles():
+    ticks = iter([0.0, 0.0, 0.003, 1.3])
+    stats = RequestStats(clock=lambda: next(ticks))
+    with requests_mock.Mocker() as m:
+        m.get(f'{DB}/DOC', json={})
+        response = requests.get(f'{DB}/DOC')
+    stats.request_finished('GET', f'{DB}/DOC', stats.request_started('GET', f'{DB}/DOC'), response=response)
+    stats.request_finished('GET', f'{DB}/DOC', 1.0, response=response)
+    doc = stats.summary()['GET doc']
+    assert doc['p50_ms'] == 5
+    assert doc['p99_ms'] == 500
+    assert round(doc['max_ms']) == 300
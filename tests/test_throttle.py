@@ -0,0 +1,111 @@
+"""Tests for `couchfs.throttle`."""
+import threading
+import time
+
+import requests_mock
+
+from couchfs.api import CouchDBClient, map_unordered
+from couchfs.throttle import BULK, INTERACTIVE, PRIORITY, AdaptiveLimit, TokenBucket, priority, prioritized
+
+DB = 'http://127.0.0.1:5984/test'
+
+
+def test_token_bucket_caps_the_rate():
+    bucket = TokenBucket(200000, burst=20000)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.consume(20000)
+    assert 0.4 < time.monotonic() - started < 2
+
+
+def test_token_bucket_serves_higher_priority_first():
+    bucket = TokenBucket(1000, burst=100)
+    bucket.consume(100)
+    order = []
+
+    def consume(name, value):
+        bucket.consume(100, value)
+        order.append(name)
+
+    bulk = threading.Thread(target=consume, args=('bulk', BULK))
+    bulk.start()
+    time.sleep(0.02)
+    interactive = threading.Thread(target=consume, args=('interactive', INTERACTIVE))
+    interactive.start()
+    bulk.join(2)
+    interactive.join(2)
+    assert order == ['interactive', 'bulk']
+
+
+def test_adaptive_limit_aimd():
+    now = [0.0]
+    limit = AdaptiveLimit(maximum=16, clock=lambda: now[0])
+    assert limit.limit == 1
+    # slow start, +1 a success
+    for _ in range(5):
+        limit.acquire()
+        limit.release(0.01)
+    assert limit.limit == 6
+    now[0] = 1.0
+    limit.acquire()
+    limit.release(None, failed=True)
+    assert limit.limit == 3 and not limit.slow_start
+    # no second halving within a round trip
+    limit.acquire()
+    limit.release(None, failed=True)
+    assert limit.limit == 3
+    limit.acquire()
+    limit.release(0.01)
+    assert 3 < limit.limit < 4
+    # latency well over the lowest seen counts as overload
+    now[0] = 2.0
+    for _ in range(3):
+        limit.acquire()
+        limit.release(0.5)
+    assert limit.limit < 2
+    for _ in range(100):
+        limit.acquire()
+        limit.release(0.5 if limit.latency > 0.2 else 0.01)
+    assert limit.limit <= 16
+
+
+def test_adaptive_limit_blocks_at_the_limit():
+    limit = AdaptiveLimit(maximum=4)
+    limit.acquire()
+    waiter = threading.Thread(target=limit.acquire)
+    waiter.start()
+    waiter.join(0.05)
+    assert waiter.is_alive()
+    limit.release(0.01)
+    waiter.join(1)
+    assert not waiter.is_alive() and limit.in_flight == 1
+
+
+def test_priority_reaches_map_unordered_workers():
+    seen = []
+
+    def job(index):
+        seen.append(PRIORITY.get())
+        return index
+
+    assert sorted(map_unordered(prioritized(job, BULK), [(i,) for i in range(6)], 3)) == list(range(6))
+    with priority(BULK):
+        list(map_unordered(job, [(i,) for i in range(6)], 3))
+    assert seen == [BULK] * 12
+    assert PRIORITY.get() == INTERACTIVE
+
+
+def test_client_adapts_to_overload():
+    client = CouchDBClient('couchdb://127.0.0.1:5984/test?adaptive=1&bandwidth=1000000&retries=0')
+    assert client.throttle.bucket.rate == 1000000
+    assert client.transport.hooks[0] is client.throttle
+    with requests_mock.Mocker() as m:
+        m.get(f'{DB}/DOC', json={})
+        for _ in range(4):
+            client.transport.get(f'{DB}/DOC')
+        assert client.throttle.limit.limit == 5
+        m.get(f'{DB}/DOC', status_code=503)
+        client.transport.get(f'{DB}/DOC')
+        assert client.throttle.limit.limit < 5
+    assert client.throttle.limit.in_flight == 0
+    assert CouchDBClient('couchdb://127.0.0.1:5984/test').throttle.limit is None